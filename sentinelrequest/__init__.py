@@ -4,23 +4,29 @@ import os
 import sys
 import datetime
 import time
-import requests
 from lxml import etree, html, objectify
 import logging
 from collections import OrderedDict
 import hashlib
-from io import StringIO
+from io import StringIO, BytesIO
 import geopandas as gpd
 import pandas as pd
 import shapely.wkt as wkt
 import shapely.ops as ops
-from shapely.geometry import GeometryCollection, MultiPolygon, Polygon, LineString, box
+from shapely.geometry import GeometryCollection, MultiPolygon, Polygon, LineString, MultiLineString, box
 from shapely.ops import transform
 import shapely
 import math
+import numpy as np
 import pyproj
 from . import geo_shapely as geoshp
 from . import geopandas_coloc
+from .scihub_session import ScihubSession, get_session, configure_session
+from . import scihub_cache
+from .scihub_cache import cache_stats, cache_prune
+from .scihub_query import ScihubQuery
+from . import scihub_catalog
+from .scihub_pairs import ColocPairs
 import warnings
 from tqdm.auto import tqdm
 import pytz
@@ -29,6 +35,14 @@ import tempfile
 import re
 import string
 import zipfile
+import asyncio
+import contextlib
+import functools
+import collections
+import multiprocessing
+import threading
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 
 logger = logging.getLogger("sentinelRequest")
 logger.addHandler(logging.NullHandler())
@@ -48,6 +62,12 @@ except:
     logger.info("html2text not found. Consider 'pip install html2text' for better error messages.")
     html2text = lambda x: x
 
+try:
+    import aiohttp
+except ImportError:
+    # only needed by the async api (scihubQuery_async)
+    aiohttp = None
+
 # default values (user may change them)
 default_user = 'guest'
 default_password = 'guest'
@@ -56,6 +76,47 @@ default_alt_path = None
 default_cacherefreshrecent = datetime.timedelta(days=7)
 default_timedelta_slice = datetime.timedelta(weeks=1)
 default_filename = 'S1*'
+default_page_workers = 4
+# 'slice', 'grid' or 'adaptive' (see scihubQuery)
+default_planner = 'slice'
+# adaptive planner max products per request
+default_adaptive_max_results = 1000
+# one request per spatial cluster of rows in time slices (see _spatial_clusters).
+# opt-in: smaller answers for sparse slices, but more requests
+default_spatial_clustering = False
+# grid planner cell size, in degrees
+default_grid_tile = 10
+# True, False or 'auto' (see scihubQuery)
+default_track = False
+default_async_concurrency = 16
+# max slices in flight in scihubQuery_async (requested or colocated, and not yet collected), so memory is bounded
+default_async_slices = 32
+# start method of colocation processes, when n_workers > 1 (not 'fork': the parent has threads and open sessions)
+default_mp_start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# keep raw xml answers in cache, as an audit copy of the decoded (parquet) cache
+default_cache_xml = True
+# cache size limits (None for no limit). Least recently used entries are evicted after each query
+default_cache_max_bytes = None
+default_cache_max_entries = None
+# 'page' or 'incremental' (see scihubQuery_raw)
+default_cache_refresh = 'page'
+# in memory cache lifetime of answers with products more recent than cacherefreshrecent
+default_memo_ttl_recent = datetime.timedelta(minutes=10)
+# 'hub', 'local' or 'hybrid' (see scihubQuery_raw)
+default_source = 'hub'
+
+# scihub answer page size
+page_rows = 100
+# scihub max query length (https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/OpenSearchAPI#Discover_the_products_over_a_pre)
+max_query_length = 8000
+# adaptive planner doesn't split rows under this duration
+min_slice_duration = datetime.timedelta(hours=1)
+# origin of the calendar grid used to align time slices (a monday)
+grid_origin = pd.Timestamp('2000-01-03', tz='UTC')
+# track mode: the corridor is split where consecutive track points are farther than this (degrees)
+track_max_step = 10
+# in memory LRU cache of scihubQuery_raw answers, keyed by normalized query
+query_memo = scihub_cache.MemoryCache()
 
 # all wkt objects feeded to scihub will keep rounding_precision digits (1 = 0.1 )
 # this will allow to not have too long requests
@@ -71,12 +132,23 @@ answer_fields = [u'acquisitiontype', u'beginposition', u'endposition', u'filenam
                  u'slicenumber', u'status', u'swathidentifier', u'url',
                  u'url_alternative', u'url_icon', u'uuid']
 
+# decoding type of answer_fields (str if not listed)
+answer_fields_types = {
+    u'beginposition': 'date', u'endposition': 'date', u'ingestiondate': 'date',
+    u'lastorbitnumber': 'int', u'lastrelativeorbitnumber': 'int', u'missiondatatakeid': 'int',
+    u'orbitnumber': 'int', u'relativeorbitnumber': 'int', u'slicenumber': 'int',
+    u'footprint': 'wkt'
+}
+
 dateformat = "%Y-%m-%dT%H:%M:%S.%fZ"
 dateformat_alt = "%Y-%m-%dT%H:%M:%S"
 
 urlapi = 'https://apihub.copernicus.eu/apihub/search'
 #urlapi = 'https://scihub.copernicus.eu/dhus/search'
 
+# scihub answer when the request is too long to process (request will be retried)
+scihub_timeout_message = b'Timeout occured while waiting response from server'
+
 # earth as multi poly
 earth = GeometryCollection(list(gpd.read_file(gpd.datasets.get_path('naturalearth_lowres')).geometry)).buffer(0)
 
@@ -97,33 +169,6 @@ class ScihubError(UserWarning):
     pass
 
 
-# remove_dom
-xslt = '''<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
-<xsl:output method="xml" indent="no"/>
-
-<xsl:template match="/|comment()|processing-instruction()">
-    <xsl:copy>
-      <xsl:apply-templates/>
-    </xsl:copy>
-</xsl:template>
-
-<xsl:template match="*">
-    <xsl:element name="{local-name()}">
-      <xsl:apply-templates select="@*|node()"/>
-    </xsl:element>
-</xsl:template>
-
-<xsl:template match="@*">
-    <xsl:attribute name="{local-name()}">
-      <xsl:value-of select="."/>
-    </xsl:attribute>
-</xsl:template>
-</xsl:stylesheet>
-'''
-
-remove_dom = etree.XSLT(etree.fromstring(xslt))
-
-
 def is_geographic(crs):
     """ return True if crs is geographic. 
         once old pyproj/geopandas deprecated, this function should be replaced
@@ -182,28 +227,29 @@ def wget(url, outfile, progress=True, user=None, password=None, desc=''):
     if os.path.exists(outfile):
         return 303, outfile
 
-    response = requests.get(url, stream=True, auth=(user, password))
-    if response.status_code == 202:
-        # not online
-        return response.status_code, None
-    elif response.status_code != 200:
-        logger.debug('strange status %d for %s' % (response.status_code, outfile))
-
-    length = int(response.headers.get('content-length', 0))
-
-    # make a tempfile
-    basename = os.path.basename(outfile)
-    dirname = os.path.dirname(outfile)
-    prefix, suffix = os.path.splitext(basename)
-    progress_bar = tqdm(total=length, unit='iB', unit_scale=True, desc=desc, leave=False, disable=not progress)
-    with tempfile.NamedTemporaryFile(suffix='.tmp', prefix=prefix, dir=dirname, delete=False) as handle:
-        chunk_size = 10*1024**2
-        for data in response.iter_content(chunk_size=chunk_size):
-            progress_bar.update(len(data))
-            handle.write(data)
-        os.rename(handle.name, outfile)
-    progress_bar.close()
-    return response.status_code, outfile
+    # streamed response must be closed, to release the pool connection
+    with get_session().get(url, stream=True, auth=(user, password)) as response:
+        if response.status_code == 202:
+            # not online
+            return response.status_code, None
+        elif response.status_code != 200:
+            logger.debug('strange status %d for %s' % (response.status_code, outfile))
+
+        length = int(response.headers.get('content-length', 0))
+
+        # make a tempfile
+        basename = os.path.basename(outfile)
+        dirname = os.path.dirname(outfile)
+        prefix, suffix = os.path.splitext(basename)
+        progress_bar = tqdm(total=length, unit='iB', unit_scale=True, desc=desc, leave=False, disable=not progress)
+        with tempfile.NamedTemporaryFile(suffix='.tmp', prefix=prefix, dir=dirname, delete=False) as handle:
+            chunk_size = 10*1024**2
+            for data in response.iter_content(chunk_size=chunk_size):
+                progress_bar.update(len(data))
+                handle.write(data)
+            os.rename(handle.name, outfile)
+        progress_bar.close()
+        return response.status_code, outfile
 
 
 def safe_dir(filename, path='.', only_exists=False):
@@ -296,7 +342,7 @@ def get_scihub_odata(odata_url):
     odata result are not cached, because they are volatiles (ie online status)
     """
     odata = {}
-    xmlout = requests.get(odata_url, auth=(default_user, default_password))
+    xmlout = get_session().get(odata_url, auth=(default_user, default_password))
     root = objectify.fromstring(xmlout.content)
     odata['Online'] = root.find('*/d:Online', namespaces=root.nsmap).pyval
     odata['OnDemand'] = root.find('*/d:OnDemand', namespaces=root.nsmap).pyval
@@ -398,12 +444,637 @@ def download_from_df(safes, destination='.', progress=True):
     return safes
 
 
+def _page_key(params, canonical=True):
+    """
+    md5 key of request params. If canonical, the query is replaced by its canonical form (see `ScihubQuery.key`),
+    so same queries (ie with clauses in another order) share cache entries.
+    """
+    if canonical:
+        params = OrderedDict(params)
+        params['q'] = ScihubQuery.parse(params['q']).key()
+    return hashlib.md5(("%s" % params).encode('utf-8')).hexdigest()
+
+
+def _page_cache(cachedir, params):
+    """
+    return a tuple (index, key, cachefiles) for request params, where index is the `scihub_cache.CacheIndex`
+    of cachedir, key the request md5, and cachefiles a dict with cache file path for each cache tier
+    ('xml', and 'parquet' if pyarrow is available).
+    return (None, None, {}) if no cachedir.
+    """
+    if not cachedir:
+        return None, None, {}
+    index = scihub_cache.get_index(cachedir)
+    key = _page_key(params)
+    tiers = ['xml']
+    if scihub_cache.pq is not None:
+        tiers.append('parquet')
+    cachefiles = OrderedDict((tier, index.cachefile(key, tier)) for tier in tiers)
+    return index, key, cachefiles
+
+
+def _write_parquet_page(parquet_cachefile, page, params):
+    """
+    write a page (chunk_safes, count) to the decoded (geoparquet) cache tier.
+    return True on success
+    """
+    chunk_safes, count = page
+    if chunk_safes is None:
+        chunk_safes = safes_empty
+    try:
+        os.makedirs(os.path.dirname(parquet_cachefile), exist_ok=True)
+        scihub_cache.write_parquet(parquet_cachefile, chunk_safes, metadata={
+            'totalResults': count, 'start': params['start'], 'rows': params['rows'], 'q': params['q']})
+    except Exception as e:
+        logger.warning('unable to write parquet cachefile %s : %s' % (parquet_cachefile, str(e)))
+        return False
+    return True
+
+
+def _index_page(cache, page, params, tiers):
+    """add cached page tiers to the cache index"""
+    index, key, cachefiles = cache
+    chunk_safes, count = page
+    max_beginposition = chunk_safes['beginposition'].max() if chunk_safes is not None else None
+    index.add(key, tiers, query=params['q'], start=params['start'], max_beginposition=max_beginposition)
+
+
+def _decode_dates(values):
+    """decode a serie of scihub str dates to utc datetimes"""
+    # date format can change ..
+    dates = pd.to_datetime(values, format=dateformat, utc=True, errors='coerce')
+    fallback = dates.isna() & values.notna()
+    if fallback.any():
+        dates[fallback] = pd.to_datetime(values[fallback].str[0:19], format=dateformat_alt, utc=True)
+    return dates
+
+
+def _decode_ints(values):
+    """decode a serie of scihub str int, as an object serie of python int (like in previous versions)"""
+    ints = pd.to_numeric(values)
+    if ints.notna().all():
+        ints = ints.astype('int64')
+    return ints.astype(object)
+
+
+def _int_columns_as_object(safes):
+    """int answer fields of safes read from the decoded (parquet) cache tier, back to object dtype (see `_decode_ints`)"""
+    for field, field_type in answer_fields_types.items():
+        if field_type == 'int' and field in safes and safes[field].dtype != object:
+            safes[field] = safes[field].astype(object)
+    return safes
+
+
+def _decode_footprints(values):
+    """decode a serie of wkt footprints. Invalid footprints are corrected with buffer(0)"""
+    footprints = gpd.GeoSeries.from_wkt(values, index=values.index, crs=scihub_crs)
+    invalid = ~footprints.is_valid & footprints.notna()
+    if invalid.any():
+        footprints[invalid] = footprints[invalid].buffer(0)
+    return footprints
+
+
+# decoders for answer_fields_types
+answer_decoders = {
+    'date': _decode_dates,
+    'int': _decode_ints,
+    'wkt': _decode_footprints
+}
+
+
+def _iterparse_page(content):
+    """
+    single pass streaming parser for a scihub opensearch answer page. Namespaces are ignored.
+
+    return a tuple (count, columns, found):
+        count: totalResults (None if not found)
+        columns: dict with a list of str values for each field in answer_fields (None if missing)
+        found: set of fields found in at least one entry
+    """
+    count = None
+    columns = OrderedDict((field, []) for field in answer_fields)
+    found = set()
+    for _, elem in etree.iterparse(BytesIO(content), events=('end',),
+                                   tag=('{*}entry', '{*}totalResults', '{*}subtitle')):
+        name = etree.QName(elem).localname
+        if name == 'entry':
+            entry = {}
+            for child in elem:
+                if not isinstance(child.tag, str):
+                    # comment or processing instruction
+                    continue
+                tag = etree.QName(child).localname
+                if tag == 'link':
+                    rel = child.get('rel')
+                    field = 'url' if rel is None else 'url_%s' % rel
+                    entry[field] = child.get('href')
+                else:
+                    field = child.get('name')
+                    entry[field] = child.text
+            for field, values in columns.items():
+                values.append(entry.get(field))
+            found.update(entry)
+            # free already parsed entries
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        elif name == 'totalResults':
+            count = int(elem.text)
+        else:
+            logger.debug("%s" % elem.text)
+    return count, columns, found.intersection(columns)
+
+
+def _parse_page(content):
+    """
+    parse a scihub answer page.
+
+    return a tuple (chunk_safes, count). chunk_safes is None if the page has no entry.
+    raise ValueError if the answer is not a valid scihub answer.
+    """
+    t = time.time()
+    try:
+        count, columns, found = _iterparse_page(content)
+    except etree.XMLSyntaxError as e:
+        raise ValueError('invalid xml : %s' % str(e))
+    if count is None:
+        raise ValueError('totalResults not found')
+    if not columns['uuid'] and not columns['filename']:
+        return None, count
+
+    chunk_safes = _decode_columns(columns, found)
+    logger.debug("xml parsed in %.2f secs" % (time.time() - t))
+    return chunk_safes, count
+
+
+def _decode_columns(columns, found):
+    """
+    decode columns (dict with a list of str values for each field in answer_fields) to a safes geodataframe.
+    fields not in `found` are nan.
+    """
+    decoded = OrderedDict()
+    for field in answer_fields:
+        if field not in found:
+            logger.debug("Ignoring field %s (not found)." % field)
+            decoded[field] = pd.Series(np.nan, index=pd.RangeIndex(len(columns[field])), dtype=object)
+            continue
+        values = pd.Series(columns[field], dtype=object)
+        field_type = answer_fields_types.get(field, 'str')
+        if field_type in answer_decoders:
+            values = answer_decoders[field_type](values)
+        decoded[field] = values
+    return gpd.GeoDataFrame(decoded, geometry='footprint', crs=scihub_crs)
+
+
+def _read_cached_page(cache, params):
+    """
+    read a page from cache files found in cache index. The decoded tier (parquet) is read first.
+    A page only found in the xml tier is copied to the decoded tier.
+
+    return a tuple (chunk_safes, count) (see `_parse_page`), or None if not cached
+    """
+    index, key, cachefiles = cache
+    if index is None:
+        return None
+    tiers = index.lookup(key)
+    if not tiers:
+        # pages cached before canonical keys are moved to their canonical key
+        tiers = index.rename(_page_key(params, canonical=False), key, query=params['q'], start=params['start'])
+    tiers = [tier for tier in tiers if tier in cachefiles]
+    if not tiers:
+        return None
+
+    parquet_cachefile = cachefiles.get('parquet')
+    if 'parquet' in tiers:
+        logger.debug("reading from parquet cachefile %s" % parquet_cachefile)
+        try:
+            chunk_safes, metadata = scihub_cache.read_parquet(parquet_cachefile)
+            chunk_safes = _int_columns_as_object(chunk_safes)
+            count = int(metadata['totalResults'])
+            if chunk_safes.empty:
+                chunk_safes = None
+            return chunk_safes, count
+        except Exception as e:
+            logger.warning('removing invalid parquet cachefile %s : %s' % (parquet_cachefile, str(e)))
+            tiers.remove('parquet')
+            if os.path.exists(parquet_cachefile):
+                os.unlink(parquet_cachefile)
+
+    page = None
+    xml_cachefile = cachefiles.get('xml')
+    if 'xml' in tiers:
+        logger.debug("reading from xml cachefile %s" % xml_cachefile)
+        try:
+            with open(xml_cachefile, 'rb') as f:
+                page = _parse_page(f.read())
+        except Exception as e:
+            logger.warning('removing invalid xml_cachefile %s : %s' % (xml_cachefile, str(e)))
+            tiers.remove('xml')
+
+    if page is None:
+        index.remove(key)
+        return None
+    if parquet_cachefile is not None and _write_parquet_page(parquet_cachefile, page, params):
+        tiers.append('parquet')
+        _index_page(cache, page, params, tiers)
+    return page
+
+
+def _page_from_answer(content, str_query, cache, params):
+    """
+    parse scihub answer content, and write it to cache files if valid.
+    The raw xml is only written if `default_cache_xml` is True (or if there is no decoded tier).
+
+    return a tuple (chunk_safes, count) (see `_parse_page`). count is None if the answer is invalid
+    """
+    try:
+        page = _parse_page(content)
+    except ValueError as e:
+        logger.critical("Error while parsing xml answer : %s" % str(e))
+        logger.critical("query was: %s" % str_query)
+        logger.critical("answer is: \n {}".format(nice_string(content)))
+        warnings.warn('invalid request %s ' % str_query, ScihubError)
+        return None, None
+
+    index, key, cachefiles = cache
+    tiers = []
+    xml_cachefile = cachefiles.get('xml')
+    parquet_cachefile = cachefiles.get('parquet')
+    if xml_cachefile is not None and (default_cache_xml or parquet_cachefile is None):
+        try:
+            os.makedirs(os.path.dirname(xml_cachefile), exist_ok=True)
+            with open(xml_cachefile, 'wb') as f:
+                f.write(content)
+            tiers.append('xml')
+        except Exception as e:
+            logger.warning('unable to write xml_cachefile %s : %s' % (xml_cachefile, str(e)))
+    if parquet_cachefile is not None and _write_parquet_page(parquet_cachefile, page, params):
+        tiers.append('parquet')
+    if tiers:
+        _index_page(cache, page, params, tiers)
+    return page
+
+
+def _refresh_recent(chunk_safes, cache, cacherefreshrecent, str_query):
+    """
+    remove page from cache if some safes are recents.
+    A page without safes (ie empty answer, or count only page with rows=0) is removed if str_query
+    date range is recent (see `_needs_refresh`), as its count may still change.
+    """
+    index, key, cachefiles = cache
+    if index is None:
+        return
+    now = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+    if chunk_safes is None:
+        recent = _needs_refresh(ScihubQuery.parse(str_query), now, cacherefreshrecent)
+    else:
+        dateage = now - chunk_safes['beginposition'].max()  # used for cache age
+        recent = dateage < cacherefreshrecent
+    if recent:
+        logger.debug("To recent answer. Removing cache entry %s" % key)
+        index.remove(key)
+
+
+def _prune_cache(cachedir):
+    """
+    evict least recently used cache entries, if the cache is over `default_cache_max_bytes`
+    or `default_cache_max_entries`
+    """
+    if cachedir and (default_cache_max_bytes is not None or default_cache_max_entries is not None):
+        index = scihub_cache.get_index(cachedir)
+        if index.over_limits(max_bytes=default_cache_max_bytes, max_entries=default_cache_max_entries):
+            # evict down to 90% of the limits, so the cache is not pruned again on next insert
+            index.prune(max_bytes=default_cache_max_bytes and int(default_cache_max_bytes * 0.9),
+                        max_entries=default_cache_max_entries and int(default_cache_max_entries * 0.9))
+
+
+def _scihub_page(str_query, start, user, password, cachedir, cacherefreshrecent, rows=None):
+    """
+    get one page of `rows` entries (default to `page_rows`) of scihub answer, from cache if available.
+
+    return a tuple (chunk_safes, count, cache_status).
+    chunk_safes is None if the page has no entry, count is None if the request failed.
+    """
+    if rows is None:
+        rows = page_rows
+    params = OrderedDict([("start", start), ("rows", rows), ("q", str_query)])
+    cache = _page_cache(cachedir, params)
+    page = _read_cached_page(cache, params)
+    cache_status = page is not None
+    if page is None:
+        # request not cached
+        try:
+            # scihub timeout are retried by the session
+            xmlout = get_session().get(urlapi, auth=(user, password), params=params, retry_on=scihub_timeout_message)
+        except:
+            raise_from(ConnectionError("Unable to connect to %s" % urlapi), None)
+        if scihub_timeout_message in xmlout.content:
+            logger.warning('Timeout while processing request : %s' % str_query)
+            warnings.warn('Giving up trying to connect %s ' % urlapi, ScihubError)
+            return None, None, False
+        page = _page_from_answer(xmlout.content, str_query, cache, params)
+
+    chunk_safes, count = page
+    _refresh_recent(chunk_safes, cache, cacherefreshrecent, str_query)
+    return chunk_safes, count, cache_status
+
+
+def _merge_pages(chunks):
+    """merge pages from _scihub_page into one geodataframe sorted by sensing date"""
+    chunks = [chunk for chunk in chunks if chunk is not None]
+    if chunks:
+        # sort by sensing date
+        safes = pd.concat(chunks, ignore_index=True, sort=False)
+        safes = safes.sort_values('beginposition')
+        safes.reset_index(drop=True, inplace=True)
+        safes = safes.set_geometry('footprint')
+    else:
+        safes = safes_empty.copy()
+
+    safes.crs = scihub_crs
+    return safes
+
+
+def _memo_put(query, safes, cacherefreshrecent):
+    """
+    put safes, answer of `ScihubQuery` query, in `query_memo`.
+    Answers with recent (or no) products expire after `default_memo_ttl_recent`
+    """
+    ttl = None
+    if _needs_refresh(query, datetime.datetime.utcnow().replace(tzinfo=pytz.UTC), cacherefreshrecent):
+        ttl = default_memo_ttl_recent.total_seconds()
+    query_memo.put(query.key(), safes, ttl=ttl, meta=query)
+
+
+def _cached_answer(query, cachedir, cacherefreshrecent):
+    """
+    answer to `ScihubQuery` query from cached answers, without http request:
+    from `query_memo`, or by filtering a cached answer of a query that covers this one
+    (in `query_memo`, or in incremental query cache entries).
+
+    return None if not found
+    """
+    safes = query_memo.get(query.key())
+    if safes is not None:
+        logger.debug('in memory cache hit for %s' % query.key())
+        return safes
+    safes = query_memo.find(lambda cached_query: cached_query.covers(query))
+    if safes is None and cachedir and scihub_cache.pq is not None:
+        index = scihub_cache.get_index(cachedir)
+        for key, str_cached_query in index.query_entries():
+            if not ScihubQuery.parse(str_cached_query).covers(query):
+                continue
+            cached = _read_query_entry((index, key, {'parquet': index.cachefile(key, 'parquet')}))
+            if cached is not None and not _needs_refresh(query, cached[2], cacherefreshrecent):
+                safes = cached[0]
+                break
+    if safes is None:
+        return None
+    logger.debug('answer filtered from a cached superset query for %s' % query.key())
+    safes = query.filter(safes)
+    _memo_put(query, safes, cacherefreshrecent)
+    return safes
+
+
+def _query_pages(str_query, user, password, cachedir, cacherefreshrecent, page_workers):
+    """
+    fetch all pages of str_query (see `_scihub_page`). The first page gives the total results count.
+    Remaining pages are then fetched concurrently by `page_workers` threads.
+
+    return a tuple (safes, cache_status, complete, fetched). complete is False if some pages are missing,
+    and fetched is False if all pages were read from cache.
+    """
+    chunk_safes, count, cache_status = _scihub_page(str_query, 0, user, password, cachedir, cacherefreshrecent)
+    chunks = [chunk_safes]
+    complete = count is not None
+    fetched = not cache_status
+
+    if chunk_safes is not None and count is not None and count > len(chunk_safes):
+        starts = range(page_rows, count, page_rows)
+        logger.debug("fetching %d more pages with %d workers" % (len(starts), page_workers))
+        with ThreadPoolExecutor(max_workers=max(1, page_workers)) as executor:
+            # executor.map keep the pages order
+            pages = executor.map(
+                lambda start: _scihub_page(str_query, start, user, password, cachedir, cacherefreshrecent), starts)
+            for chunk_safes, page_count, page_cache_status in pages:
+                if page_count is None:
+                    logger.warning('missing page in answer for %s' % str_query)
+                    complete = False
+                chunks.append(chunk_safes)
+                cache_status = cache_status or page_cache_status
+                fetched = fetched or not page_cache_status
+
+    return _merge_pages(chunks), cache_status, complete, fetched
+
+
+def _query_cache(cachedir, str_query, cache_refresh):
+    """
+    return a tuple (index, key, cachefiles) for the query level cache entry of str_query (see `_page_cache`),
+    used by the 'incremental' cache_refresh mode. Only the decoded tier is used,
+    so return (None, None, {}) if no cachedir, if pyarrow is not available, or if cache_refresh is 'page'.
+    """
+    if cache_refresh not in ['page', 'incremental']:
+        raise ValueError("cache_refresh must be 'page' or 'incremental', not %s" % cache_refresh)
+    if not cachedir or cache_refresh != 'incremental' or scihub_cache.pq is None:
+        return None, None, {}
+    index = scihub_cache.get_index(cachedir)
+    params = OrderedDict([("q", ScihubQuery.parse(str_query).key()), ("cache_refresh", cache_refresh)])
+    key = hashlib.md5(("%s" % params).encode('utf-8')).hexdigest()
+    return index, key, {'parquet': index.cachefile(key, 'parquet')}
+
+
+def _read_query_entry(cache):
+    """
+    read a query level cache entry.
+    return a tuple (safes, watermark, refresh_time), or None if not cached.
+    watermark is the max ingestiondate of cached products, as a scihub date string (or None if no products).
+    refresh_time is the (utc) time of the last request for this entry (None if unknown).
+    """
+    index, key, cachefiles = cache
+    if index is None or 'parquet' not in index.lookup(key):
+        return None
+    try:
+        safes, metadata = scihub_cache.read_parquet(cachefiles['parquet'])
+        safes = _int_columns_as_object(safes)
+    except Exception as e:
+        logger.warning('removing invalid query cachefile %s : %s' % (cachefiles['parquet'], str(e)))
+        index.remove(key)
+        return None
+    refresh_time = metadata.get('refresh_time')
+    if refresh_time is not None:
+        refresh_time = pd.to_datetime(refresh_time, utc=True)
+    return safes, metadata['watermark'], refresh_time
+
+
+def _write_query_entry(cache, safes, str_query):
+    """write (or update) a query level cache entry, with ingestiondate watermark"""
+    index, key, cachefiles = cache
+    if index is None:
+        return
+    watermark = None
+    max_beginposition = None
+    if not safes.empty:
+        # milliseconds, rounded down: the delta query will include the last cached products
+        watermark = safes['ingestiondate'].max().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        max_beginposition = safes['beginposition'].max()
+    parquet_cachefile = cachefiles['parquet']
+    try:
+        os.makedirs(os.path.dirname(parquet_cachefile), exist_ok=True)
+        scihub_cache.write_parquet(parquet_cachefile, safes, metadata={
+            'q': str_query, 'watermark': watermark,
+            'refresh_time': datetime.datetime.utcnow().strftime(dateformat)})
+    except Exception as e:
+        logger.warning('unable to write query cachefile %s : %s' % (parquet_cachefile, str(e)))
+        return
+    index.add(key, ['parquet'], query=str_query, max_beginposition=max_beginposition)
+
+
+def _needs_refresh(query, refresh_time, cacherefreshrecent):
+    """
+    True if the answer to `ScihubQuery` query, requested at refresh_time, may miss products:
+    if the query has no beginPosition range, or if the range ended less than cacherefreshrecent
+    before refresh_time (scihub may still ingest products).
+    An answer (even empty) for a range that was already older than cacherefreshrecent is never refreshed.
+    """
+    if refresh_time is None or query.end is None:
+        return True
+    return refresh_time - query.end < cacherefreshrecent
+
+
+def _delta_query(str_query, watermark):
+    """query for products of str_query ingested after watermark"""
+    if watermark is None:
+        return str_query
+    return '(%s) AND ingestiondate:[%s TO NOW]' % (str_query, watermark)
+
+
+def _range_query(str_query, begin, end):
+    """str_query, with its beginPosition range replaced by [begin, end]"""
+    date_position = "beginPosition:[%s TO %s]" % (begin.strftime(dateformat), end.strftime(dateformat))
+    return re.sub(r'beginPosition:\[\s*\S+\s+TO\s+\S+\s*\]', lambda match: date_position, str_query, count=1,
+                  flags=re.IGNORECASE)
+
+
+def _catalog_put(cachedir, query, safes, cacherefreshrecent, fetched=None):
+    """
+    upsert fetched, products asked to scihub for safes (complete answer to `ScihubQuery` query), in cachedir
+    product catalog (see `scihub_catalog.ProductCatalog`), and record the query time range as covered,
+    except the last `cacherefreshrecent` (scihub may still ingest products).
+
+    if fetched is None (answer read from cache), the catalog is only updated if the query time range
+    is not yet covered (ie cache written before the catalog), with all safes.
+    """
+    if not cachedir:
+        return
+    try:
+        catalog = scihub_catalog.get_catalog(cachedir)
+        end = None
+        if query.begin is not None and not query.clauses:
+            recent = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC) - cacherefreshrecent
+            end = min(query.end, recent)
+        if fetched is None:
+            if end is None or end < query.begin or not catalog.gaps(ScihubQuery(
+                    begin=query.begin, end=end, filename=query.filename, footprint=query.footprint)):
+                return
+            fetched = safes
+        catalog.upsert(fetched)
+        if end is not None:
+            catalog.add_coverage(query, end=end)
+    except Exception as e:
+        logger.warning('unable to update product catalog in %s : %s' % (cachedir, str(e)))
+
+
+def _catalog_gaps(str_query, query, source, cachedir):
+    """
+    return the list of queries to ask scihub for `ScihubQuery` query (from str_query), for time ranges
+    not yet covered by cachedir product catalog (always empty for 'local' source).
+    return None if the query can't be answered from the catalog in 'hybrid' source
+    (ie no beginPosition range, or clauses other than filename and footprint).
+    """
+    if source not in ['local', 'hybrid']:
+        raise ValueError("source must be 'hub', 'local' or 'hybrid', not %s" % source)
+    if not cachedir:
+        raise ValueError("source '%s' needs a cachedir" % source)
+    if query.begin is None or query.clauses:
+        if source == 'local':
+            raise ValueError("unable to answer from the local catalog : %s" % str_query)
+        logger.debug('query not handled by the local catalog: %s' % str_query)
+        return None
+    if source == 'local':
+        return []
+    gaps = scihub_catalog.get_catalog(cachedir).gaps(query)
+    logger.debug('%d time ranges not covered by the local catalog for %s' % (len(gaps), str_query))
+    return [_range_query(str_query, begin, end) for begin, end in gaps]
+
+
+def _catalog_answer(query, cachedir):
+    """answer to `ScihubQuery` query from cachedir product catalog"""
+    products = scihub_catalog.get_catalog(cachedir).search(query.begin, query.end, footprint=query.footprint)
+    if not products:
+        return _merge_pages([])
+    records, footprints = zip(*products)
+    columns = OrderedDict((field, [record.get(field) for record in records]) for field in answer_fields)
+    found = set(field for field, values in columns.items() if any(value is not None for value in values))
+    found.discard('footprint')
+    safes = _decode_columns(columns, found)
+    safes['footprint'] = gpd.GeoSeries.from_wkb(list(footprints), crs=scihub_crs)
+    return _merge_pages([query.filter(safes)])
+
+
+def _merge_delta(safes, delta):
+    """merge delta products into cached safes, by uuid (delta products replace cached ones)"""
+    logger.debug('%d products in delta query' % len(delta))
+    if delta.empty:
+        return safes
+    safes = pd.concat([safes, delta], ignore_index=True, sort=False)
+    safes = safes.drop_duplicates('uuid', keep='last')
+    return _merge_pages([safes])
+
+
+def _store_answer(query, safes, str_query, query_cache, cachedir, cacherefreshrecent, complete, update_entry,
+                  fetched=None):
+    """
+    store safes, scihub answer to `ScihubQuery` query, in the query level cache entry (if update_entry),
+    in `query_memo` and in the product catalog (if complete), then prune the cache.
+    fetched are the products asked to scihub (None if the answer was read from cache), see `_catalog_put`.
+    """
+    if complete and update_entry:
+        _write_query_entry(query_cache, safes, str_query)
+    if complete:
+        _memo_put(query, safes, cacherefreshrecent)
+        _catalog_put(cachedir, query, safes, cacherefreshrecent, fetched=fetched)
+    _prune_cache(cachedir)
+
+
 def scihubQuery_raw(str_query, user=None, password=None, cachedir=None, cacherefreshrecent=None,
-                    return_cache_status=False):
+                    return_cache_status=False, page_workers=None, cache_refresh=None, source=None):
     """
     real scihub query, as done on https://scihub.copernicus.eu/dhus/#/home
     but with cache handling
-     
+
+    The first page gives the total results count. Remaining pages are then fetched
+    concurrently by `page_workers` threads (default to `default_page_workers`).
+
+    Answers are also kept in memory by `query_memo` (see `scihub_cache.MemoryCache`).
+    If a cached answer is found for a query that covers str_query (see `scihub_query.ScihubQuery.covers`),
+    it is filtered locally, without http request.
+
+    cache_refresh: str or None
+        'page': a cached page is dropped if it has products more recent than `cacherefreshrecent`.
+        'incremental': the whole query answer is cached, and only products ingested since the last
+        request are asked to scihub (needs pyarrow, and cachedir).
+        Default to `default_cache_refresh`.
+
+    Products of complete scihub answers are also kept in a local catalog in cachedir
+    (see `scihub_catalog.ProductCatalog`), with the time ranges they cover.
+
+    source: str or None
+        'hub': ask scihub (with cache handling).
+        'local': answer from the local catalog only (beginPosition, filename and footprint queries only).
+        'hybrid': ask scihub only for time ranges not yet covered by the local catalog, then answer from the
+        catalog. Queries the catalog can't answer are asked to scihub.
+        Default to `default_source`.
+
     return a geodataframe with responses, or tuple (gdf,cache_status) if return_cache_status is True
     """
 
@@ -416,170 +1087,51 @@ def scihubQuery_raw(str_query, user=None, password=None, cachedir=None, cacheref
         cachedir = default_cachedir
     if cacherefreshrecent is None:
         cacherefreshrecent = default_cacherefreshrecent
-
-    def decode_date(strdate):
-        # date format can change ..
-        try:
-            d = datetime.datetime.strptime(strdate, dateformat).replace(tzinfo=pytz.UTC)
-        except:
-            d = datetime.datetime.strptime(strdate[0:19], dateformat_alt).replace(tzinfo=pytz.UTC)
-        return d
-
-    decode_tags = {
-        "int": int,
-        "date": decode_date
-    }
-
-    retry_init = 3
-
-    safes = safes_empty.copy()
-    start = 0
-    count = 1  # arbitrary count > start
-    retry = retry_init
-
-    cache_status = False
-
-    if cachedir: 
-        os.makedirs(os.path.join(cachedir, 'xml'), exist_ok=True)
-
-    while start < count:
-        params = OrderedDict([("start", start), ("rows", 100), ("q", str_query)])
-        root = None
-        xml_cachefile = None
-        if cachedir is not None:
-            md5request = hashlib.md5(("%s" % params).encode('utf-8')).hexdigest()
-            xml_cachedir = os.path.join(cachedir, 'xml', md5request[:2])
-            os.makedirs(xml_cachedir, exist_ok=True)
-            xml_cachefile = os.path.join(xml_cachedir, '%s.xml' % md5request[2:])
-            
-            # legacy stuff that might be removed in few months (now 202012)
-            xml_cachefile_legacy = os.path.join(cachedir, "%s.xml" % md5request)
-            if os.path.exists(xml_cachefile_legacy):
-                logger.debug('migrating old legacy cache file')
-                os.rename(xml_cachefile_legacy, xml_cachefile)
-                
-            if os.path.exists(xml_cachefile):
-                logger.debug("reading from xml cachefile %s" % xml_cachefile)
-                try:
-                    with open(xml_cachefile, 'a'):
-                        os.utime(xml_cachefile, None)
-                except Exception as e:
-                    logger.warning('unable to touch %s : %s' % (xml_cachefile, str(e)))
-
-                try:
-                    root = remove_dom(etree.parse(xml_cachefile))
-                    int(root.find(".//totalResults").text)  # this should enought to test the xml is ok
-                except Exception as e:
-                    logger.warning('removing invalid xml_cachefile %s : %s' % (xml_cachefile, str(e)))
-                    os.unlink(xml_cachefile)
-                    root = None
-
-        if root is not None:
-            cache_status = True
-        else:
-            # request not cached
-            try:
-                xmlout = requests.get(urlapi, auth=(user, password), params=params)
-            except:
-                raise_from(ConnectionError("Unable to connect to %s" % urlapi), None)
-            try:
-                root = remove_dom(etree.fromstring(xmlout.content))
-            except Exception as e:
-                content = nice_string(xmlout.content)
-
-                if 'Timeout occured while waiting response from server' in content:
-                    retry -= 1
-                    logger.warning('Timeout while processing request : %s' % str_query)
-                    logger.warning('left retry : %s' % retry)
-                    if retry == 0:
-                        warnings.warn('Giving up trying to connect %s ' % urlapi, ScihubError)
-                        break
-                    continue
-
-                logger.critical("Error while parsing xml answer")
-                logger.critical("query was: %s" % str_query)
-                logger.critical("answer is: \n {}".format(content))
-                warnings.warn('Schihub query error %s ' % urlapi, ScihubError)
-
-            if xml_cachefile is not None:
-                try:
-                    int(root.find(".//totalResults").text)  # this should enought to test the xml is ok
-                    try:
-                        with open(xml_cachefile, 'w') as f:
-                            f.write(nice_string(root))
-                    except Exception as e:
-                        logger.warning('unable to write xml_cachefile %s : %s' % (xml_cachefile, str(e)))
-                except:
-                    logger.warning('not writing corrupted xml cachefile')
-
-        # <opensearch:totalResults>442</opensearch:totalResults>\n
-        try:
-            count = int(root.find(".//totalResults").text)
-        except:
-            # there was an error in request
-            logger.error('response was:\n {}'.format(nice_string(root)))
-            if xml_cachefile is not None and os.path.exists(xml_cachefile):
-                os.unlink(xml_cachefile)
-            warnings.warn('invalid request %s ' % str_query, ScihubError)
-            break
-
-        # reset retry since last request is ok
-        retry = retry_init
-
-        # logger.debug("totalResults : %s" % root.find(".//totalResults").text )
-        logger.debug("%s" % root.find(".//subtitle").text)
-        # logger.debug("got %d entry starting at %d" % (len(root.findall(".//entry")),start))
-
-        if len(root.findall(".//entry")) > 0:
-            chunk_safes_df = pd.DataFrame(columns=answer_fields)
-            t = time.time()
-            for field in answer_fields:
-                if field.startswith('url'):
-                    if field == 'url':
-                        elts = [d for d in root.xpath(".//entry/link") if 'rel' not in d.attrib]
-                    else:
-                        rel = field.split('_')[1]
-                        elts = root.xpath(".//entry/link[@rel='%s']" % rel)
-                    tag = 'str'
-                    values = [d.attrib['href'] for d in elts]
-                else:
-                    elts = root.xpath(".//entry/*[@name='%s']" % field)
-                    if len(elts) != 0:
-                        tag = elts[0].tag  # ie str,int,date ..
-                        values = [d.text for d in elts]
-                    else:
-                        tag = None
-                        values = []
-                        logger.debug("Ignoring field %s (not found)." % field)
-                if len(values) >= 1:
-                    chunk_safes_df[field] = values
-                    if tag in decode_tags:
-                        chunk_safes_df[field] = chunk_safes_df[field].apply(decode_tags[tag])
-            try:
-                shp_footprints = chunk_safes_df['footprint'].apply(wkt.loads)
-            except:
-                pass
-            chunk_safes_df['footprint'] = shp_footprints
-            chunk_safes = gpd.GeoDataFrame(chunk_safes_df, geometry='footprint', crs=scihub_crs)
-            chunk_safes['footprint'] = chunk_safes.buffer(0)
-            start += len(chunk_safes)
-            logger.debug("xml parsed in %.2f secs" % (time.time() - t))
-
-            # remove cachefile if some safes are recents
-            if xml_cachefile is not None and os.path.exists(xml_cachefile):
-                dateage = (datetime.datetime.utcnow().replace(tzinfo=pytz.UTC) - chunk_safes[
-                    'beginposition'].max())  # used for cache age
-                if dateage < cacherefreshrecent:
-                    logger.debug("To recent answer. Removing cachefile %s" % xml_cachefile)
-                    os.unlink(xml_cachefile)
-            # sort by sensing date
-            safes = pd.concat([safes, chunk_safes], ignore_index=True, sort=False)
-            safes = safes.sort_values('beginposition')
-            safes.reset_index(drop=True, inplace=True)
-            safes = safes.set_geometry('footprint')
-
-        # safes['footprint'] = gpd.GeoSeries(safes['footprint'])
-        safes.crs = scihub_crs
+    if page_workers is None:
+        page_workers = default_page_workers
+    if cache_refresh is None:
+        cache_refresh = default_cache_refresh
+    if source is None:
+        source = default_source
+
+    query = ScihubQuery.parse(str_query)
+    gap_queries = None
+    if source != 'hub':
+        gap_queries = _catalog_gaps(str_query, query, source, cachedir)
+    if gap_queries is not None:
+        cache_status = True
+        for gap_query in gap_queries:
+            _, gap_cache_status = scihubQuery_raw(gap_query, user=user, password=password, cachedir=cachedir,
+                                                  cacherefreshrecent=cacherefreshrecent, return_cache_status=True,
+                                                  page_workers=page_workers, cache_refresh=cache_refresh,
+                                                  source='hub')
+            cache_status = cache_status and gap_cache_status
+        safes = _catalog_answer(query, cachedir)
+        return (safes, cache_status) if return_cache_status else safes
+
+    safes = _cached_answer(query, cachedir, cacherefreshrecent)
+    if safes is not None:
+        return (safes, True) if return_cache_status else safes
+
+    query_cache = _query_cache(cachedir, str_query, cache_refresh)
+    cached = _read_query_entry(query_cache)
+    update_entry = cached is None
+    fetched = None  # products asked to scihub
+    if cached is None:
+        safes, cache_status, complete, pages_fetched = _query_pages(str_query, user, password, cachedir,
+                                                                    cacherefreshrecent, page_workers)
+        fetched = safes if pages_fetched else None
+    else:
+        safes, watermark, refresh_time = cached
+        cache_status, complete = True, True
+        if _needs_refresh(query, refresh_time, cacherefreshrecent):
+            delta, delta_cache_status, complete, _ = _query_pages(
+                _delta_query(str_query, watermark), user, password, None, cacherefreshrecent, page_workers)
+            safes = _merge_delta(safes, delta)
+            fetched = delta
+            update_entry = True
+    _store_answer(query, safes, str_query, query_cache, cachedir, cacherefreshrecent, complete, update_entry,
+                  fetched)
 
     if return_cache_status:
         return safes, cache_status
@@ -587,16 +1139,58 @@ def scihubQuery_raw(str_query, user=None, password=None, cachedir=None, cacheref
         return safes
 
 
-def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_loop], progress=False):
+_footprints_lock = threading.Lock()
+
+
+def _projected_footprints(safes, crs, footprints_cache=None):
+    """
+    return safes footprints (GeoSeries) projected to crs.
+    footprints_cache is an optional dict uuid -> projected footprint, shared by all slices of a run (so with the same
+    crs): only footprints not already in cache are projected.
+    The cache may be shared by threads (ie async slices colocations): it is only accessed under `_footprints_lock`.
+    """
+    if footprints_cache is None or 'uuid' not in safes:
+        return safes.geometry.to_crs(crs)
+    uuids = safes['uuid'].values
+    projected = np.empty(len(uuids), dtype=object)
+    with _footprints_lock:
+        projected[:] = [footprints_cache.get(uuid) for uuid in uuids]
+    missing = np.array([footprint is None for footprint in projected], dtype=bool)
+    if missing.any():
+        new_footprints = np.asarray(safes.geometry[missing].to_crs(crs).values, dtype=object)
+        projected[missing] = new_footprints
+        with _footprints_lock:
+            footprints_cache.update(zip(uuids[missing], new_footprints))
+    return gpd.GeoSeries(projected, index=safes.index, crs=crs)
+
+
+def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_loop], progress=False, n_workers=1,
+                max_distance=None, footprints_cache=None, pairs=False, coloc_executor=None):
     """colocalize safes and gdf
     if crs is default and 'geometry_east' and 'geometry_west' exists in gdf,
     they will be used instead of .geometry (scihub mode)
     
     if crs is not default the crs will be used on .geometry for the coloc.
+
+    if n_workers > 1, the first coloc method is replaced by `geopandas_coloc.colocalize_parallel`,
+    with n_workers processes (others methods are still used as check). coloc_executor is an optional
+    processes pool, shared by many colocations (default to a new pool started with `default_mp_start_method`).
+
+    if max_distance is not None, safes closer than max_distance meters from gdf are colocated
+    (see `geopandas_coloc.colocalize_distance`), and the distance is returned in a 'coloc_distance' column.
+    Distances are computed in lon/lat, by a single process: crs, coloc and footprints_cache are not used,
+    and n_workers > 1 raises a ValueError.
+
+    footprints_cache is an optional dict of safes footprints projected to crs, by uuid (see `_projected_footprints`).
+
+    if pairs, a `ColocPairs` is returned instead of the joined safes.
     
     the returned safes will be returned in scihub crs (ie 4326 : not the user specified)
     """
 
+    if max_distance is not None and n_workers > 1:
+        raise ValueError("max_distance colocation is not parallelized (n_workers=%s)" % n_workers)
+
     # initialise an empty index for both gdf
     idx_safes = safes.index.delete(slice(None))
     idx_gdf = gdf.index.delete(slice(None))
@@ -604,6 +1198,8 @@ def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_lo
     if len(safes) == 0:
         # set same index as gdf, even if empty, to not throw an error on possible merge later 
         safes.index = idx_gdf
+        if pairs:
+            return ColocPairs.from_safes(safes)
         return safes
     gdf = gdf.copy()
     gdf['geometry'] = gdf.geometry
@@ -618,6 +1214,20 @@ def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_lo
 
     safes_crs = safes.copy()
 
+    if max_distance is not None:
+        # distances are computed on the sphere, in lon/lat
+        if gdf.crs is not None and not is_geographic(gdf.crs):
+            gdf = gdf.to_crs(scihub_crs)
+        idx_safes, idx_gdf, distance = geopandas_coloc.colocalize_distance(safes_crs, gdf, max_distance,
+                                                                           progress=progress)
+        return _coloc_result(safes, idx_safes, idx_gdf, pairs=pairs, coloc_distance=distance)
+
+    if n_workers > 1:
+        coloc = [functools.update_wrapper(
+            functools.partial(geopandas_coloc.colocalize_parallel, n_workers=n_workers, executor=coloc_executor,
+                              mp_context=multiprocessing.get_context(default_mp_start_method)),
+            geopandas_coloc.colocalize_parallel)] + list(coloc[1:])
+
     geometry_list = ['geometry']
     if is_geographic(crs) and 'geometry_east' in gdf and 'geometry_west' in gdf:
         # never reached. replaced with 'scihub_geometry_east_list'
@@ -630,8 +1240,11 @@ def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_lo
         geometry_list = ['geometry_east', 'geometry_west']
     elif not is_geographic(crs):
         gdf.set_geometry('geometry', inplace=True)
-        gdf.to_crs(crs, inplace=True)
-        safes_crs.to_crs(crs, inplace=True)
+        if gdf.crs is None or not gdf.crs.equals(crs):
+            # normalize_gdf keeps the user geometry, so gdf is usually already in crs
+            gdf.to_crs(crs, inplace=True)
+        safes_crs[safes_crs.geometry.name] = _projected_footprints(safes, crs, footprints_cache)
+        safes_crs.crs = crs
         safes_coloc.to_crs(crs, inplace=True)
 
     for geometry in geometry_list:
@@ -651,46 +1264,112 @@ def _colocalize(safes, gdf, crs=scihub_crs, coloc=[geopandas_coloc.colocalize_lo
                     idx_safes_cur.sort_values())):
                 raise RuntimeError('difference between colocation method')
 
+    return _coloc_result(safes, idx_safes, idx_gdf, pairs=pairs)
+
+
+def _coloc_result(safes, idx_safes, idx_gdf, pairs=False, **pair_columns):
+    """
+    return safes.loc[idx_safes] indexed by idx_gdf, with pair_columns (ie coloc_distance), in scihub crs.
+    if pairs, return a `ColocPairs` instead, so colocated safes are not copied for each colocation.
+    """
+    safes = safes.drop(['startdate', 'stopdate'], axis=1)
+    if pairs:
+        coloc_pairs = ColocPairs.from_index(safes, idx_safes, idx_gdf, **pair_columns)
+        coloc_pairs.products = coloc_pairs.products.to_crs(crs=scihub_crs)
+        return coloc_pairs
     safes_coloc = safes.loc[idx_safes]
     safes_coloc.index = idx_gdf
+    for col, values in pair_columns.items():
+        safes_coloc[col] = values
+    return safes_coloc.to_crs(crs=scihub_crs)
+
 
-    return safes_coloc.drop(['startdate', 'stopdate'], axis=1).to_crs(crs=scihub_crs)
+def _string_codes(strings, prefix_length):
+    """
+    integer codes of strings (a pandas Series), and of their `prefix_length` first chars, as a tuple of arrays.
+    ascii strings are compared as fixed width bytes, by 8 bytes words factorized one after the other,
+    so no prefix string is built.
+    """
+    try:
+        if strings.isna().any():
+            raise TypeError('missing strings')
+        chars = strings.to_numpy().astype(bytes)
+    except (TypeError, UnicodeEncodeError):
+        codes, uniques = pd.factorize(strings, use_na_sentinel=False)
+        prefix_codes, _ = pd.factorize(pd.Index(uniques).str.slice(0, prefix_length), use_na_sentinel=False)
+        return codes, prefix_codes[codes]
+
+    def combine(codes, ncodes, column):
+        column_codes, column_uniques = pd.factorize(column)
+        if ncodes * len(column_uniques) >= 2 ** 62:
+            codes, uniques = pd.factorize(codes)
+            ncodes = len(uniques)
+        return codes * len(column_uniques) + column_codes, ncodes * len(column_uniques)
+
+    nwords = -(-max(chars.itemsize, prefix_length) // 8)
+    words = chars.astype('S%d' % (nwords * 8)).view('<u8').reshape(-1, nwords)
+    prefix_words, prefix_bytes = divmod(prefix_length, 8)
+    codes, ncodes = np.zeros(len(words), dtype=np.int64), 1
+    for column in words.T[:prefix_words]:
+        codes, ncodes = combine(codes, ncodes, column)
+    prefix_codes = codes
+    if prefix_bytes:
+        # first bytes of a little endian word are its low bits
+        prefix_codes, _ = combine(codes, ncodes, words[:, prefix_words] & np.uint64(2 ** (8 * prefix_bytes) - 1))
+    for column in words.T[prefix_words:]:
+        codes, ncodes = combine(codes, ncodes, column)
+    return pd.factorize(codes)[0], pd.factorize(prefix_codes)[0]
 
 
 def remove_duplicates(safes_ori, keep_list=[]):
     """
     Remove duplicate safe (ie same footprint with same date, but different prodid)
+    For each filename radic (62 first chars), only safes with the latest ingestiondate are kept,
+    or with the ingestiondate of a safe from keep_list.
     """
     safes = safes_ori.copy()
     if not safes.empty:
         # remove duplicate safes
 
-        # add a temporary col with filename radic
-        safes['__filename_radic'] = [f[0:62] for f in safes['filename']]
-
-        uniques_radic = safes['__filename_radic'].unique()
-
-        for filename_radic in uniques_radic:
-            sames_safes = safes[safes['__filename_radic'] == filename_radic]
-            if len(sames_safes['filename'].unique()) > 1:
-                logger.debug("prodid count > 1: %s" % ([s for s in sames_safes['filename'].unique()]))
-                force_keep = list(set(sames_safes['filename']).intersection(keep_list))
-                to_keep = sames_safes[
-                    'ingestiondate'].max()  # warning : may induce late reprocessing (ODL link) . min() is safer, but not the best quality
+        # filename radic groups
+        filename_codes, radic_codes = _string_codes(safes['filename'], 62)
+        # prodid count > 1 (ie distinct filenames by radic)
+        filename_radics = np.empty(filename_codes.max() + 1, dtype=radic_codes.dtype)
+        filename_radics[filename_codes] = radic_codes
+        duplicated = pd.Series(np.bincount(filename_radics)[radic_codes] > 1, index=safes.index)
+        radic_codes = pd.Series(radic_codes, index=safes.index)
+        # warning : may induce late reprocessing (ODL link) . min() is safer, but not the best quality
+        to_keep = safes['ingestiondate'].groupby(radic_codes, sort=False).transform('max')
+
+        force_keep = safes['filename'].isin(keep_list) & duplicated
+        if force_keep.any():
+            forced = safes.loc[force_keep, 'ingestiondate'].groupby(radic_codes[force_keep], sort=False).first()
+            forced_to_keep = radic_codes.map(forced)
+            forced_radic = radic_codes.isin(forced.index)
+            for filename in safes.loc[force_keep & (forced_to_keep != to_keep), 'filename'].unique():
+                logger.warning('remove_duplicate : force keep safe %s' % filename)
+            to_keep = forced_to_keep.where(forced_radic, to_keep)
+
+        if duplicated.any():
+            logger.debug("prodid count > 1 for %d filename radics" % radic_codes[duplicated].nunique())
+        safes = safes[~duplicated | (safes['ingestiondate'] == to_keep)]
+    return safes
 
-                if force_keep:
-                    _to_keep = sames_safes[sames_safes['filename'] == force_keep[0]]['ingestiondate'].iloc[0]
-                    if _to_keep != to_keep:
-                        logger.warning('remove_duplicate : force keep safe %s' % force_keep[0])
-                        to_keep = _to_keep
-                logger.debug("only keep : %s " % set([f for f in safes[safes['ingestiondate'] == to_keep]['filename']]))
-                safes = safes[(safes['ingestiondate'] == to_keep) | (safes['__filename_radic'] != filename_radic)]
 
-        safes.drop('__filename_radic', axis=1, inplace=True)
-    return safes
+def _datatake_keys(filenames):
+    """DataFrame with filename radic (ie 'S1A_IW_GRDH_1SDV') and takeid of filenames"""
+    parts = filenames.str.split('_')
+    return pd.DataFrame({'safe_rad': parts.str[0:4].str.join('_'), 'takeid': parts.str[-2]}, index=filenames.index)
 
 
 def get_datatakes(safes, datatake=0, user=None, password=None, cachedir=None, cacherefreshrecent=None):
+    """
+    add to safes the adjacent safes (up to `datatake` before and after) from the same datatake (ie same takeid).
+    'datatake_index' column is the position in the datatake (by beginposition), relative to the safe from safes.
+    Added safes have the same index as their safe from safes.
+
+    datatakes are requested with OR-combined filename queries, shorter than `max_query_length`.
+    """
     # get default keywords values
     if user is None:
         user = default_user
@@ -702,43 +1381,101 @@ def get_datatakes(safes, datatake=0, user=None, password=None, cachedir=None, ca
         cacherefreshrecent = default_cacherefreshrecent
 
     safes['datatake_index'] = 0
-    for safe in list(safes['filename']):
-        safe_index = safes[safes['filename'] == safe].index[0]
-        takeid = safe.split('_')[-2]
-        safe_rad = "_".join(safe.split('_')[0:4])
-        safes_datatake = scihubQuery_raw('filename:%s_*_*_*_%s_*' % (safe_rad, takeid), user=user, password=password,
-                                         cachedir=cachedir, cacherefreshrecent=cacherefreshrecent)
-        # FIXME duplicate are removed, even if duplicate=True
-        safes_datatake = remove_duplicates(safes_datatake, keep_list=[safe])
-
-        try:
-            ifather = safes_datatake[safes_datatake['filename'] == safe].index[0]
-        except:
-            logger.warn('Father safe was not the most recent one (scihub bug ?)')
+    if safes.empty:
+        return safes
 
-        # ifather=safes_datatake.index.get_loc(father) # convert index to iloc
+    # one father safe by filename, in safes order
+    father_pos = np.flatnonzero(~safes['filename'].duplicated().values)
+    fathers = _datatake_keys(safes['filename'].iloc[father_pos].reset_index(drop=True))
+    fathers['filename'] = safes['filename'].values[father_pos]
+    fathers['father_pos'] = father_pos
+
+    # batch datatakes requests
+    clauses = ['filename:%s_*_*_*_%s_*' % key for key in
+               fathers[['safe_rad', 'takeid']].drop_duplicates().itertuples(index=False)]
+    batches = [[]]
+    length = 2
+    for clause in clauses:
+        if batches[-1] and length + len(' OR ') + len(clause) > max_query_length:
+            batches.append([])
+            length = 2
+        length += len(clause) + (len(' OR ') if batches[-1] else 0)
+        batches[-1].append(clause)
+    logger.debug("%d datatakes requested in %d queries" % (len(clauses), len(batches)))
+    answers = _merge_answers([scihubQuery_raw('(%s)' % ' OR '.join(batch), user=user, password=password,
+                                              cachedir=cachedir, cacherefreshrecent=cacherefreshrecent)
+                              for batch in batches])
+    # FIXME duplicate are removed, even if duplicate=True
+    answers = remove_duplicates(answers, keep_list=list(fathers['filename'])).reset_index(drop=True)
+    if answers.empty:
+        return safes
 
-        safes_datatake['datatake_index'] = safes_datatake.index - ifather
+    # position in datatake
+    answers_keys = _datatake_keys(answers['filename'])
+    answers_keys['datatake_rank'] = answers['beginposition'].groupby(
+        [answers_keys['safe_rad'], answers_keys['takeid']]).rank(method='first')
+    answers_keys['answer_pos'] = np.arange(len(answers))
+    father_rank = answers_keys['datatake_rank'].groupby(answers['filename'].values).first()
+    fathers['father_rank'] = fathers['filename'].map(father_rank)
+    if fathers['father_rank'].isna().any():
+        logger.warning('Father safe was not the most recent one (scihub bug ?): %s' % list(
+            fathers.loc[fathers['father_rank'].isna(), 'filename']))
+        fathers = fathers[fathers['father_rank'].notna()]
+
+    # get adjacent safes
+    candidates = fathers[['safe_rad', 'takeid', 'father_pos', 'father_rank']].merge(answers_keys,
+                                                                                   on=['safe_rad', 'takeid'])
+    candidates['datatake_index'] = (candidates['datatake_rank'] - candidates['father_rank']).astype(int)
+    candidates = candidates[candidates['datatake_index'].abs() <= datatake]
+    # remove datatake allready in safes (ie father and allready colocated ), and keep the first father
+    # FIXME take the lowest abs(datatake_index)
+    candidates = candidates[~answers['filename'].iloc[candidates['answer_pos'].values].isin(safes['filename']).values]
+    candidates = candidates.sort_values(['father_pos', 'datatake_rank'], kind='stable').drop_duplicates('answer_pos')
+
+    safes_datatake = answers.iloc[candidates['answer_pos'].values].copy()
+    safes_datatake['datatake_index'] = candidates['datatake_index'].values
+    # set same index as father safe
+    safes_datatake.index = safes.index.take(candidates['father_pos'].values)
+
+    return pd.concat([safes, safes_datatake], sort=False)
+
+
+def _floor_date(date, timedelta_slice):
+    """
+    floor date on a fixed calendar grid of timedelta_slice steps, starting a monday (ie weekly slices start on mondays).
+    """
+    return grid_origin + math.floor((date - grid_origin) / timedelta_slice) * timedelta_slice
 
-        # get adjacent safes
-        safes_datatake = safes_datatake[abs(safes_datatake['datatake_index']) <= datatake]
 
-        # set same index as father safe
-        safes_datatake.set_index(pd.Index([safe_index] * len(safes_datatake)), inplace=True)
+def _lon_margin(margin, lats):
+    """margin in degrees on the sphere, as a longitude margin at latitudes lats (up to 80 degrees)"""
+    if not margin:
+        return 0
+    lats = np.abs(np.asarray(lats, dtype=float))
+    lat = min(np.nanmax(lats), 80) if np.isfinite(lats).any() else 80
+    return margin / math.cos(math.radians(lat))
 
-        # remove datatake allready in safes (ie father and allready colocated )
-        for safe_datatake in safes_datatake['filename']:
-            if (safes['filename'] == safe_datatake).any():
-                # FIXME take the lowest abs(datatake_index)
-                safes_datatake = safes_datatake[safes_datatake['filename'] != safe_datatake]
 
-        safes = safes.append(safes_datatake, sort=False)
-    return safes
+def _is_track(gdf, check_order=True):
+    """
+    True if gdf is a track, ie time ordered Point or LineString rows (for ex a ship or drifter track).
+    if not check_order, only geometries types are checked.
+    """
+    if len(gdf) < 2 or not gdf.geometry.geom_type.isin(['Point', 'LineString']).all() or gdf.geometry.is_empty.any():
+        return False
+    if check_order:
+        return 'beginposition' in gdf and gdf['beginposition'].is_monotonic_increasing
+    return True
 
 
-def normalize_gdf(gdf, startdate=None, stopdate=None, date=None, dtime=None, timedelta_slice=None, progress=False):
+def normalize_gdf(gdf, startdate=None, stopdate=None, date=None, dtime=None, timedelta_slice=None, progress=False,
+                  align_slices=False, track=False, max_distance=None):
     """ return a normalized gdf list 
     start/stop date name will be 'beginposition' and 'endposition'
+    if align_slices, time slices are aligned on a fixed calendar grid (see `_floor_date`), instead of the first date.
+    if track (or 'auto' and gdf is a track, see `_is_track`), rows are not buffered one by one: a corridor
+    is computed for each slice by `_slice_query`.
+    if max_distance (meters) is not None, requests shapes are enlarged by max_distance.
     """
     t = time.time()
     if timedelta_slice is None:
@@ -781,62 +1518,6 @@ def normalize_gdf(gdf, startdate=None, stopdate=None, date=None, dtime=None, tim
         norm_gdf.geometry = norm_gdf.geometry.apply(geoshp.smallest_dlon)
         norm_gdf.crs = scihub_crs
 
-    # scihub requests are enlarged/simplified
-    if is_geographic(norm_gdf.crs):
-        buff = 2
-        simp = 1.9
-    else:
-        # assume meters
-        buff = 200 * 1000
-        simp = 190 * 1000
-
-    with warnings.catch_warnings():
-        # disable geographic warning
-        warnings.simplefilter("ignore")
-        norm_gdf['scihub_geometry'] = norm_gdf.geometry.buffer(buff).simplify(simp)
-    if crs_ori is None:
-        # re apply smallest dlon if needed
-        norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').apply(
-            lambda row: geoshp.smallest_dlon(row['scihub_geometry']) if row['wrap_dlon'] else GeometryCollection(
-                [row['scihub_geometry']]),
-            axis=1)
-
-    if not is_geographic(norm_gdf.crs):
-        # convert scihub geometry to lon/lat (original geometry untouched !)
-        norm_gdf_ori = norm_gdf.copy()
-        crs_ori = norm_gdf.crs
-        norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.apply(
-            lambda s: geoshp.split_shape_crs(s, crs=norm_gdf.crs))
-        norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.to_crs(scihub_crs)
-        # norm_gdf['scihub_geometry'] =
-
-        # check valid output geometry
-        if not all(norm_gdf.set_geometry('scihub_geometry').geometry.is_valid):
-            raise NotImplementedError("Internal error converting crs %s to %s" % (norm_gdf.crs, scihub_crs))
-            # an output geometry is invalid if it include 4326 singularity (ie pole) 
-            all_count = len(norm_gdf)
-            valid = norm_gdf.is_valid
-
-            # split into geometry collection that doesn't include singularity
-            corrected = norm_gdf_ori[~valid].geometry.apply(lambda s: geoshp.split_shape_crs(s, crs=norm_gdf_ori.crs))
-
-            norm_gdf.loc[~valid, norm_gdf.geometry.name] = corrected.to_crs(scihub_crs)
-            if not all(norm_gdf.is_valid):
-                raise ValueError("unable to convert to crs %s" % scihub_crs)
-
-            logging.error("Converted %s/%s problematic projection %s -> %s geometries " % (
-            len(corrected), all_count, crs_ori, scihub_crs))
-
-        # encapsulate geometry in collection to presereve large dlon
-        norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.apply(
-            lambda s: GeometryCollection([s]))
-
-    # else:
-    #    norm_gdf.geometry = norm_gdf.geometry.apply(smallest_dlon)
-    east, west = zip(*norm_gdf.set_geometry('scihub_geometry').geometry.apply(geoshp.split_east_west))
-    norm_gdf['scihub_geometry_east_list'] = list(east)
-    norm_gdf['scihub_geometry_west_list'] = list(west)
-
     if date in norm_gdf:
         if (startdate not in norm_gdf) and (stopdate not in norm_gdf):
             norm_gdf['beginposition'] = norm_gdf[date] - dtime
@@ -850,157 +1531,454 @@ def normalize_gdf(gdf, startdate=None, stopdate=None, date=None, dtime=None, tim
     if (stopdate in norm_gdf) and (stopdate != 'endposition'):
         norm_gdf['endposition'] = norm_gdf[stopdate]
 
+    if track == 'auto':
+        track = _is_track(norm_gdf)
+    elif track and not _is_track(norm_gdf, check_order=False):
+        raise ValueError("track mode needs Point or LineString geometries")
+    norm_gdf['scihub_track'] = bool(track)
+    # requests margin, in degrees on the sphere
+    norm_gdf['scihub_margin'] = 0. if max_distance is None else np.degrees(max_distance / geopandas_coloc.earth_radius)
+
+    if track:
+        # one corridor per slice will be computed by `_slice_query`
+        norm_gdf['scihub_geometry_east_list'] = [Polygon()] * len(norm_gdf)
+        norm_gdf['scihub_geometry_west_list'] = [Polygon()] * len(norm_gdf)
+    else:
+        # scihub requests are enlarged/simplified
+        if is_geographic(norm_gdf.crs):
+            buff = 2 + _lon_margin(norm_gdf['scihub_margin'].max(), norm_gdf.total_bounds[[1, 3]])
+            simp = 1.9
+        else:
+            # assume meters
+            buff = 200 * 1000 + (max_distance or 0)
+            simp = 190 * 1000
+
+        with warnings.catch_warnings():
+            # disable geographic warning
+            warnings.simplefilter("ignore")
+            norm_gdf['scihub_geometry'] = norm_gdf.geometry.buffer(buff).simplify(simp)
+        if crs_ori is None:
+            # re apply smallest dlon if needed
+            norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').apply(
+                lambda row: geoshp.smallest_dlon(row['scihub_geometry']) if row['wrap_dlon'] else GeometryCollection(
+                    [row['scihub_geometry']]),
+                axis=1)
+
+        if not is_geographic(norm_gdf.crs):
+            # convert scihub geometry to lon/lat (original geometry untouched !)
+            norm_gdf_ori = norm_gdf.copy()
+            crs_ori = norm_gdf.crs
+            norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.apply(
+                lambda s: geoshp.split_shape_crs(s, crs=norm_gdf.crs))
+            norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.to_crs(scihub_crs)
+            # norm_gdf['scihub_geometry'] =
+
+            # check valid output geometry
+            if not all(norm_gdf.set_geometry('scihub_geometry').geometry.is_valid):
+                raise NotImplementedError("Internal error converting crs %s to %s" % (norm_gdf.crs, scihub_crs))
+                # an output geometry is invalid if it include 4326 singularity (ie pole) 
+                all_count = len(norm_gdf)
+                valid = norm_gdf.is_valid
+
+                # split into geometry collection that doesn't include singularity
+                corrected = norm_gdf_ori[~valid].geometry.apply(lambda s: geoshp.split_shape_crs(s, crs=norm_gdf_ori.crs))
+
+                norm_gdf.loc[~valid, norm_gdf.geometry.name] = corrected.to_crs(scihub_crs)
+                if not all(norm_gdf.is_valid):
+                    raise ValueError("unable to convert to crs %s" % scihub_crs)
+
+                logging.error("Converted %s/%s problematic projection %s -> %s geometries " % (
+                len(corrected), all_count, crs_ori, scihub_crs))
+
+            # encapsulate geometry in collection to presereve large dlon
+            norm_gdf['scihub_geometry'] = norm_gdf.set_geometry('scihub_geometry').geometry.apply(
+                lambda s: GeometryCollection([s]))
+
+        # else:
+        #    norm_gdf.geometry = norm_gdf.geometry.apply(smallest_dlon)
+        east, west = zip(*norm_gdf.set_geometry('scihub_geometry').geometry.apply(geoshp.split_east_west))
+        norm_gdf['scihub_geometry_east_list'] = list(east)
+        norm_gdf['scihub_geometry_west_list'] = list(west)
+
     gdf_slices = norm_gdf
     # slice
     if timedelta_slice is not None:
         mindate = norm_gdf['beginposition'].min()
         maxdate = norm_gdf['endposition'].max()
-        # those index will need to be time expanded
-        idx_to_expand = norm_gdf.index[(norm_gdf['endposition'] - norm_gdf['beginposition']) > timedelta_slice]
         if maxdate > datetime.datetime.utcnow().replace(tzinfo=pytz.UTC):
             logger.info("%s is future. Truncating." % maxdate)
             maxdate = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC) + datetime.timedelta(days=1)
         if (mindate == mindate) and (maxdate == maxdate):  # non nan
-            gdf_slices = []
-            slice_begin = mindate
-            slice_end = slice_begin
-            islice = 0
-            nslices = math.ceil((maxdate - mindate) / timedelta_slice)
+            slice_origin = mindate
+            if align_slices:
+                slice_origin = _floor_date(mindate, timedelta_slice)
+            nslices = max(1, math.ceil((maxdate - slice_origin) / timedelta_slice))
             if nslices > 1:
                 logger.info("Slicing into %d chunks of %s ..." % (nslices, timedelta_slice))
-            while slice_end < maxdate:
-                islice += 1
-                slice_end = slice_begin + timedelta_slice
-                # this is time grouping
-                gdf_slice = norm_gdf[
-                    (norm_gdf['beginposition'] >= slice_begin) & (norm_gdf['endposition'] <= slice_end)]
-                # check if some slices needs to be expanded
-                # index of gdf_slice that where not grouped
-                not_grouped_index = pd.Index(set(idx_to_expand) - set(gdf_slice.index))
-                for to_expand in not_grouped_index:
-                    # missings index in gdf_slice.
-                    # check if there is time overlap.
-                    latest_start = max(norm_gdf.loc[to_expand].beginposition, slice_begin)
-                    earliest_end = min(norm_gdf.loc[to_expand].endposition, slice_end)
-                    overlap = (earliest_end - latest_start)
-                    if overlap >= datetime.timedelta(0):
-                        # logger.debug("Slicing time for %s : %s to %s" % (to_expand,latest_start,earliest_end))
-                        gdf_slice = pd.concat([gdf_slice, gpd.GeoDataFrame(norm_gdf.loc[to_expand]).T])
-                        gdf_slice.loc[to_expand, 'beginposition'] = latest_start
-                        gdf_slice.loc[to_expand, 'endposition'] = earliest_end
-                    # else:
-                    # logger.debug("no time slice for %s in range %s to %s" % (to_expand,slice_begin,slice_end))
-                logger.debug("Slice {islice:3d} : {ngeoms:3d} geometries".format(islice=islice, ngeoms=len(gdf_slice)))
-                if not gdf_slice.empty:
-                    gdf_slices.append(gdf_slice)
-                slice_begin = slice_end
-
+            gdf_slices = _time_slices(norm_gdf, slice_origin, timedelta_slice, nslices)
             if nslices > 1:
                 logger.info(
                     'Slicing done in %.1fs . %d/%d non empty slices.' % (time.time() - t, len(gdf_slices), nslices))
     return gdf_slices
 
 
-def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None, timedelta_slice=None, filename=None,
-                datatake=0, duplicate=False, query=None, user=None, password=None, min_sea_percent=None, fig=None,
-                cachedir=None, cacherefreshrecent=None, progress=True, verbose=False, full_fig=False, alt_path=None, download=False):
+def _time_slices(norm_gdf, slice_origin, timedelta_slice, nslices):
     """
-    
-    input:
-        gdf : 
-            None or geodataframe with geometry and date. gdf usually contain almost these cols:
-            index         : an index for the row (for ex area name, buoy id, etc ...)
-            beginposition : datetime object (startdate)
-            endposition   : datetime object (stopdate)
-            geometry      : shapely object (this one is optional for whole earth)
-        date: 
-            column name if gdf, or datetime object
-        dtime : 
-            if date is not None, dtime as timedelta object will be used to compute startdate and stopdate 
-        startdate : 
-            None or column  name in gdf , or datetime object . not used if date and dtime are defined. 
-            Default to 'beginposition'
-        stopdate : 
-            None or column  name in gdf , or datetime object . not used if date and dtime are defined. 
-            Default to 'endposition'
-        timedelta_slice:
-            Max time slicing : Scihub request will be grouped or sliced to this. 
-            Default to datetime.timedelta(weeks=1).
-            If None, no slicing is done.
-        duplicate : 
-            if True, will return duplicates safes (ie same safe with different prodid). Default to False
-        datatake : 
-            number of adjacent safes to return (ie 0 will return 1 safe, 1 return 3, 2 return 5, etc )
-        query : 
-            aditionnal query string, for ex '(platformname:Sentinel-1 AND sensoroperationalmode:WV)' 
-        cachedir : 
-            cache requests for speed up. 
-        cacherefreshrecent : 
-            timedelta from now. if requested stopdate is recent, will refresh the cache to let scihub ingest new data.
-            Default to datetime.timedelta(days=7).
-        fig : 
-            matplotlib fig handle ( default to None : no plot)
-        progress : True show progressbar
-        verbose  : False to silent messages
-        alt_path : None, str or list of str
-            search path in str or list of str to get safe path (columns 'path')
-            str is a path string, with optionnal wilcards like `/home/datawork-cersat-public/cache/project/mpc-sentinel1/data/esa/sentinel-${missionid}/L${LEVEL}/${BEAM}/${MISSIONID}_${BEAM}_${PRODUCT}${RESOLUTION}_${LEVEL}${CLASS}/${year}/${doy}/${SAFE}`,
-            or a simple path like '.' or '/tmp/scihub_download'
-            if list, search in the list until a path is found.
-        download : bool
-            imply get_path. default to False. If True, download safes to `alt_path` (if alt_path is a list, the first index is used)
-        download_wait : bool
-            if `download`, will wait for non online safe to be ready. default to False.
-    return :
-        a geodataframe with safes from scihub, colocated with input gdf (ie same index)
+    group norm_gdf rows into `nslices` time slices of `timedelta_slice`, starting at `slice_origin`.
+
+    A row is in the slice containing it. A row overlapping several slices is split in time clipped rows,
+    one per slice (in the slice, after the contained rows). Rows after the last slice are clipped or dropped.
+
+    return the list of non empty slices
     """
-    global default_user
-    global default_password
-    
-    if sys.gettrace():
-        logger.setLevel(logging.DEBUG)
-        progress = False
-        full_fig = True
-    if gdf is not None and len(gdf) == 0:
-        logger.warning("No coloc with an empty gdf")
-        return safes_empty
-    if not sys.stderr.isatty() and "tqdm.std" in str(tqdm):
-        progress = False
+    step = pd.Timedelta(timedelta_slice).value
+    origin = pd.Timestamp(slice_origin).value
+    begin = pd.to_datetime(norm_gdf['beginposition'], utc=True)
+    end = pd.to_datetime(norm_gdf['endposition'], utc=True)
+    valid = (begin.notna() & end.notna()).values
+    begin_ns = begin.values.astype('datetime64[ns]').view('int64')
+    end_ns = end.values.astype('datetime64[ns]').view('int64')
+
+    # first and last slice of each row
+    islice_begin = np.floor_divide(begin_ns - origin, step)
+    islice_end = np.maximum(islice_begin, -np.floor_divide(origin - end_ns, step) - 1)  # ceil - 1
+    split_row = islice_end > islice_begin
+    islice_end = np.minimum(islice_end, nslices - 1)
+    valid &= islice_begin <= islice_end
+
+    # one piece per row and slice
+    rows = np.flatnonzero(valid)
+    counts = (islice_end - islice_begin + 1)[rows]
+    pieces_row = np.repeat(rows, counts)
+    pieces_first = np.repeat(np.cumsum(counts) - counts, counts)
+    pieces_slice = islice_begin[pieces_row] + np.arange(len(pieces_row)) - pieces_first
+    pieces_split = split_row[pieces_row]
+
+    # contained rows first, then split rows, in norm_gdf order
+    order = np.lexsort((pieces_row, pieces_split, pieces_slice))
+    pieces_row = pieces_row[order]
+    pieces_slice = pieces_slice[order]
+    pieces_split = pieces_split[order]
+
+    pieces = norm_gdf.iloc[pieces_row].copy()
+    if pieces_split.any():
+        slice_begin = origin + pieces_slice * step
+        pieces_begin = np.where(pieces_split, np.maximum(begin_ns[pieces_row], slice_begin), begin_ns[pieces_row])
+        pieces_end = np.where(pieces_split, np.minimum(end_ns[pieces_row], slice_begin + step), end_ns[pieces_row])
+        pieces['beginposition'] = pd.to_datetime(pieces_begin, utc=True)
+        pieces['endposition'] = pd.to_datetime(pieces_end, utc=True)
+
+    bounds = np.flatnonzero(np.diff(pieces_slice)) + 1
+    gdf_slices = []
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(pieces)]):
+        if stop > start:
+            logger.debug("Slice {islice:3d} : {ngeoms:3d} geometries".format(islice=pieces_slice[start] + 1,
+                                                                              ngeoms=stop - start))
+            gdf_slices.append(pieces.iloc[start:stop])
+    return gdf_slices
 
-    # get default keywords values
-    if user is None:
-        user = default_user
-    if password is None:
-        password = default_password
-    # set default user/password
-    default_user = user
-    default_password = password
 
-    if cachedir is None:
-        cachedir = default_cachedir
-    if alt_path is None:
-        alt_path = default_alt_path
-    if cacherefreshrecent is None:
-        cacherefreshrecent = default_cacherefreshrecent
-    if timedelta_slice is None:
-        timedelta_slice = default_timedelta_slice
-    if filename is None:
-        filename = default_filename
+def _track_corridor(gdf_slice):
+    """
+    buffered corridor (lon/lat) around the time ordered points of a track slice (see `normalize_gdf` track mode).
+    longitudes are unwrapped, so the corridor may be in range -360 360.
 
-    gdflist = normalize_gdf(gdf, startdate=startdate, stopdate=stopdate, date=date, dtime=dtime,
-                            timedelta_slice=timedelta_slice)
-    safes_list = []  # final request
-    safes_not_colocalized_list = []  # raw request
-    safes_sea_ok_list = []
-    safes_sea_nok_list = []
-    scihub_shapes_chunk = []
-    user_shapes = []
+    return a tuple (shape_east, shape_west), like `geo_shapely.split_east_west`
+    """
+    geometry = gdf_slice.geometry
+    if geometry.crs is not None and not is_geographic(geometry.crs):
+        geometry = geometry.to_crs(scihub_crs)
+    order = np.argsort(gdf_slice['beginposition'].values, kind='stable')
+    coords = [shapely.get_coordinates(shape) for shape in geometry.values[order]]
+    coords = np.concatenate(coords)
+    if len(coords) == 0:
+        return Polygon(), Polygon()
+    lon = np.degrees(np.unwrap(np.radians(coords[:, 0])))
+    lat = coords[:, 1]
+    if lon.max() - lon.min() >= 360:
+        # track around the earth: latitude band
+        corridor = box(-180, lat.min(), 180, lat.max())
+    else:
+        # center on [-180, 180]
+        lon = lon - 360 * np.round(np.mean(lon) / 360)
+        # split the track on large steps (ie gaps or interleaved tracks)
+        steps = np.hypot(np.diff(lon), np.diff(lat))
+        parts = np.split(np.column_stack([lon, lat]), np.flatnonzero(steps > track_max_step) + 1)
+        corridor = MultiLineString([part if len(part) > 1 else np.repeat(part, 2, axis=0) for part in parts])
+    corridor = corridor.buffer(2 + _lon_margin(gdf_slice['scihub_margin'].max(), lat)).simplify(1.9)
+    return geoshp.split_east_west(corridor)
 
-    # user crs will be used for coloc
-    if gdf is None or gdf.crs is None:
-        crs = scihub_crs
+
+def _slice_query(gdf_slice, filename, query=None, envelope=False):
+    """
+    build the scihub query string for a normalized gdf slice.
+    if envelope, the query shapes are replaced by their envelope (ie shorter query).
+    if the slice is a track (see `normalize_gdf`), the query shape is a corridor around the track (see `_track_corridor`).
+
+    return a tuple (str_query, scihub_shapes), scihub_shapes being the list of shapes used in the query
+    """
+    q = []
+    footprint = ""
+    datePosition = ""
+    scihub_shapes = []
+
+    # get min/max date
+    mindate = gdf_slice['beginposition'].min()
+    maxdate = gdf_slice['endposition'].max()
+    if (mindate == mindate) and (maxdate == maxdate):  # non nan
+        datePosition = "beginPosition:[%s TO %s]" % (mindate.strftime(dateformat), maxdate.strftime(
+            dateformat))  # shorter request . endPosition is just few seconds in future
+        q.append(datePosition)
+
+    q.append("filename:%s" % filename)
+
+    if query:
+        q.append("(%s)" % query)
+
+    shape_east_list = list(filter(bool, gdf_slice['scihub_geometry_east_list']))
+    shape_west_list = list(filter(bool, gdf_slice['scihub_geometry_west_list']))
+
+    shape_east = Polygon()
+    shape_west = Polygon()
+
+    if 'scihub_track' in gdf_slice and gdf_slice['scihub_track'].all():
+        shape_east, shape_west = _track_corridor(gdf_slice)
+    if shape_east_list:
+        shape_east = ops.unary_union(gdf_slice['scihub_geometry_east_list']).buffer(2).simplify(1.9)
+    if shape_west_list:
+        shape_west = ops.unary_union(gdf_slice['scihub_geometry_west_list']).buffer(2).simplify(1.9)
+    if envelope:
+        shape_east = shape_east.envelope
+        shape_west = shape_west.envelope
+
+    wkt_shapes = []
+
+    for shape, plan in zip([shape_east, shape_west], [geoshp.plan_east, geoshp.plan_west]):
+        if not shape.is_empty:
+
+            # round the shape
+            scihub_shape_round = wkt.loads(wkt.dumps(shape, rounding_precision=rounding_precision))
+
+            # ensure valid coords after rounding
+            try:
+                scihub_shape = scihub_shape_round.intersection(plan)
+                wkt_shapes.append(wkt.dumps(scihub_shape, rounding_precision=rounding_precision))
+            except:
+                # no rounding
+                wkt_shapes.append(wkt.dumps(scihub_shape))
+
+            scihub_shapes.append(scihub_shape)
+
+    footprints = ['footprint:\"Intersects(%s)\" ' % wkt_shape for wkt_shape in wkt_shapes]
+
+    if footprints:
+        q.append('(%s)' % ' OR '.join(footprints))
+
+    str_query = ' AND '.join(q)
+    return str_query, scihub_shapes
+
+
+def _timed_query(str_query, **kwargs):
+    """
+    scihubQuery_raw with cache status, for a query or a list of queries (answers merged by uuid).
+    return a tuple (safes, cache_status, elapsed)
+    """
+    t = time.time()
+    if isinstance(str_query, str):
+        safes, cache_status = scihubQuery_raw(str_query, return_cache_status=True, **kwargs)
     else:
-        crs = gdf.crs
+        answers = [scihubQuery_raw(q, return_cache_status=True, **kwargs) for q in str_query]
+        safes = _merge_answers([answer for answer, _ in answers])
+        cache_status = all(answer_cache_status for _, answer_cache_status in answers)
+    return safes, cache_status, time.time() - t
+
+
+def _merge_answers(answers):
+    """merge scihubQuery_raw answers of overlapping queries (ie grid cells), by uuid"""
+    safes = _merge_pages(answers)
+    safes = safes.drop_duplicates('uuid')
+    safes.reset_index(drop=True, inplace=True)
+    return safes
+
+
+def _slice_time_filter(safes, gdf_slice, str_query):
+    """
+    remove safes out of gdf_slice time range, if str_query is a list of queries on wider time windows (grid planner).
+    (a single query from `_slice_query` has the slice time range)
+    """
+    if isinstance(str_query, str):
+        return safes
+    mindate = gdf_slice['beginposition'].min()
+    maxdate = gdf_slice['endposition'].max()
+    if (mindate == mindate) and (maxdate == maxdate):  # non nan
+        safes = safes[(safes['beginposition'] >= mindate) & (safes['beginposition'] <= maxdate)]
+        safes = safes.reset_index(drop=True)
+    return safes
+
+
+def _timed_colocalize(safes, gdf, crs=scihub_crs, n_workers=1, max_distance=None, footprints_cache=None, pairs=False,
+                      coloc_executor=None):
+    """
+    _colocalize (with n_workers, max_distance, footprints_cache, pairs and coloc_executor), return a tuple
+    (safes, elapsed).
+    track slices (see `normalize_gdf`) are colocalized with `geopandas_coloc.colocalize_track`
+    """
+    t = time.time()
+    coloc = [geopandas_coloc.colocalize_loop]
+    if 'scihub_track' in gdf and gdf['scihub_track'].all():
+        coloc = [geopandas_coloc.colocalize_track]
+    safes = _colocalize(safes, gdf, crs=crs, coloc=coloc, progress=False, n_workers=n_workers,
+                        max_distance=max_distance, footprints_cache=footprints_cache, pairs=pairs,
+                        coloc_executor=coloc_executor)
+    return safes, time.time() - t
+
+
+def _remove_buggy(safes, str_query):
+    if not isinstance(str_query, str):
+        str_query = ' AND '.join(str_query)
+    if 'filename:S1' in str_query:
+        # some buggy safes on scihub have stopdate < startdate : remove them
+        safes = safes[safes['endposition'] - safes['beginposition'] > datetime.timedelta(0)]
+    return safes
+
+
+def _slices_results(slices, colocalize=True, crs=scihub_crs, n_workers=1, coloc_workers=1, max_distance=None,
+                    pairs=False, **kwargs):
+    """
+    request and colocalize a list of (gdf_slice, str_query). str_query may be a list of queries (see `_timed_query`).
+
+    if n_workers > 1, requests are done in a threads pool, and colocations in a processes pool
+    (started with `default_mp_start_method`). At most 2 * n_workers slices are in flight.
+    a failing slice is then returned as an exception, instead of raising it.
+    each colocation uses coloc_workers processes, max_distance and pairs (see `_colocalize`).
+    if coloc_workers > 1, one processes pool of coloc_workers is shared by all slices colocations, that are
+    then waited in the threads pool (a processes pool can't be sent to others processes).
+    if crs is not geographic, projected safes footprints are cached by uuid for the whole run (only in the current
+    process: colocations in the processes pool don't share it).
+
+    yield, in slices order, tuples (gdf_slice, result).
+    result is a tuple (safes_unfiltered, cache_status, elapsed_request, safes, elapsed_coloc) (safes is None if not
+    colocalize), or the exception raised by the slice.
+    """
+
+    mp_context = multiprocessing.get_context(default_mp_start_method)
+    footprints_cache = None if is_geographic(crs) else {}
+    with contextlib.ExitStack() as pools:
+        coloc_executor = None
+        if colocalize and coloc_workers > 1:
+            coloc_executor = pools.enter_context(ProcessPoolExecutor(max_workers=coloc_workers, mp_context=mp_context))
+
+        if n_workers <= 1:
+            for gdf_slice, str_query in slices:
+                safes_unfiltered, cache_status, elapsed_request = _timed_query(str_query, **kwargs)
+                safes_unfiltered = _slice_time_filter(safes_unfiltered, gdf_slice, str_query)
+                safes, elapsed_coloc = None, 0
+                if colocalize:
+                    safes, elapsed_coloc = _timed_colocalize(_remove_buggy(safes_unfiltered, str_query), gdf_slice,
+                                                             crs=crs, n_workers=coloc_workers,
+                                                             max_distance=max_distance,
+                                                             footprints_cache=footprints_cache, pairs=pairs,
+                                                             coloc_executor=coloc_executor)
+                yield gdf_slice, (safes_unfiltered, cache_status, elapsed_request, safes, elapsed_coloc)
+            return
+
+        thread_pool = pools.enter_context(ThreadPoolExecutor(max_workers=n_workers))
+        if coloc_executor is None:
+            coloc_pool = pools.enter_context(ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context))
+            coloc_kwargs = dict(crs=crs, n_workers=coloc_workers, max_distance=max_distance, pairs=pairs)
+        else:
+            coloc_pool = thread_pool
+            coloc_kwargs = dict(crs=crs, n_workers=coloc_workers, max_distance=max_distance, pairs=pairs,
+                                footprints_cache=footprints_cache, coloc_executor=coloc_executor)
+        # only 2 * n_workers slices are in flight, so raw answers of done slices are not kept in memory
+        in_flight = collections.deque()
+        for gdf_slice, str_query in slices:
+            in_flight.append((gdf_slice, _submit_slice(thread_pool, coloc_pool, gdf_slice, str_query, colocalize,
+                                                       coloc_kwargs, kwargs)))
+            if len(in_flight) >= 2 * n_workers:
+                yield _slice_future_result(*in_flight.popleft())
+        while in_flight:
+            yield _slice_future_result(*in_flight.popleft())
+
+
+def _submit_slice(thread_pool, coloc_pool, gdf_slice, str_query, colocalize, coloc_kwargs, kwargs):
+    """
+    submit the request of a slice in thread_pool, then its colocation in coloc_pool as soon as the request is done.
+    return a Future of the slice result (see `_slices_results`)
+    """
+    slice_future = Future()
+
+    def requested(request_future):
+        try:
+            safes_unfiltered, cache_status, elapsed_request = request_future.result()
+            safes_unfiltered = _slice_time_filter(safes_unfiltered, gdf_slice, str_query)
+            if not colocalize:
+                slice_future.set_result((safes_unfiltered, cache_status, elapsed_request, None, 0))
+                return
+            coloc_future = coloc_pool.submit(_timed_colocalize, _remove_buggy(safes_unfiltered, str_query),
+                                             gdf_slice, **coloc_kwargs)
+        except Exception as e:
+            slice_future.set_exception(e)
+            return
+
+        def colocated(coloc_future):
+            try:
+                safes, elapsed_coloc = coloc_future.result()
+            except Exception as e:
+                slice_future.set_exception(e)
+                return
+            slice_future.set_result((safes_unfiltered, cache_status, elapsed_request, safes, elapsed_coloc))
+
+        coloc_future.add_done_callback(colocated)
+
+    thread_pool.submit(_timed_query, str_query, **kwargs).add_done_callback(requested)
+    return slice_future
+
+
+def _slice_future_result(gdf_slice, slice_future):
+    """wait for a slice Future from `_submit_slice`. return (gdf_slice, result), result being the exception if failed"""
+    try:
+        return gdf_slice, slice_future.result()
+    except Exception as e:
+        return gdf_slice, e
+
+
+def _spatial_clusters(gdf_slice):
+    """
+    split gdf_slice into spatial clusters: rows are in the same cluster if their scihub shapes (ie buffered
+    geometries) intersect, directly or through other rows.
+
+    return a list of gdf slices, ordered by begin date. gdf_slice is not split if a row has no shape (ie whole earth).
+    """
+    if len(gdf_slice) < 2:
+        return [gdf_slice]
+    shapes = [ops.unary_union([shape for shape in [east, west] if shape])
+              for east, west in zip(gdf_slice['scihub_geometry_east_list'], gdf_slice['scihub_geometry_west_list'])]
+    if any(shape.is_empty for shape in shapes):
+        return [gdf_slice]
+    left, right = shapely.STRtree(shapes).query(shapes, predicate='intersects')
+    # connected components, by min label propagation
+    labels = np.arange(len(shapes))
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, left, labels[right])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    clusters = [gdf_slice[labels == label] for label in np.unique(labels)]
+    return sorted(clusters, key=lambda cluster: cluster['beginposition'].min())
+
+
+def _build_slices(gdflist, filename, query=None):
+    """
+    build scihub requests from normalize_gdf output.
+    if `default_spatial_clustering`, there is one request per spatial cluster of each slice (see `_spatial_clusters`).
+
+    return a tuple (slices, scihub_shapes), slices being a list of tuples (gdf_slice, str_query)
+    """
+    slices = []
+    scihub_shapes_chunk = []
 
     # decide if loop is over dataframe or over rows
     if isinstance(gdflist, list):
@@ -1008,97 +1986,287 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
     else:
         iter_gdf = gdflist.itertuples()
 
-    idx = 0
-    pbar = tqdm(iter_gdf, total=len(gdflist), disable=not progress, leave=False)
-    ncolocs = 0  # coloc count, for tqdm
-    for gdf_slice in pbar:
-        idx += 1
+    for gdf_slice in iter_gdf:
         if isinstance(gdf_slice, tuple):
             gdf_slice = gpd.GeoDataFrame([gdf_slice], index=[gdf_slice.Index])  # .reindex_like(gdf) # only one row
 
         if gdf_slice.empty:
             continue
 
-        q = []
-        footprint = ""
-        datePosition = ""
+        clusters = [gdf_slice]
+        if default_spatial_clustering and not gdf_slice['scihub_track'].all():
+            clusters = _spatial_clusters(gdf_slice)
+            logger.debug("%d rows in %d spatial clusters" % (len(gdf_slice), len(clusters)))
 
-        # get min/max date
-        mindate = gdf_slice['beginposition'].min()
-        maxdate = gdf_slice['endposition'].max()
-        if (mindate == mindate) and (maxdate == maxdate):  # non nan
-            datePosition = "beginPosition:[%s TO %s]" % (mindate.strftime(dateformat), maxdate.strftime(
-                dateformat))  # shorter request . endPosition is just few seconds in future
-            q.append(datePosition)
+        for gdf_cluster in clusters:
+            str_query, scihub_shapes = _slice_query(gdf_cluster, filename, query=query)
+            logger.debug("query: %s" % str_query)
 
-        q.append("filename:%s" % filename)
+            if len(str_query) > max_query_length:
+                logger.warning('too long query (%s > %s). Using shapes envelope' % (len(str_query), max_query_length))
+                str_query, scihub_shapes = _slice_query(gdf_cluster, filename, query=query, envelope=True)
+            scihub_shapes_chunk.extend(scihub_shapes)
+            slices.append((gdf_cluster, str_query))
+    return slices, scihub_shapes_chunk
 
-        if query:
-            q.append("(%s)" % query)
 
-        shape_east_list = list(filter(bool, gdf_slice['scihub_geometry_east_list']))
-        shape_west_list = list(filter(bool, gdf_slice['scihub_geometry_west_list']))
+def _grid_cells(shapes, tile):
+    """
+    return the list of lon/lat grid cells (boxes of `tile` degrees, aligned on lon -180 and lat -90)
+    that intersects shapes.
+    """
+    cells = OrderedDict()
+    for shape in shapes:
+        if shape.is_empty:
+            continue
+        minx, miny, maxx, maxy = shape.bounds
+        for ilon in range(int(math.floor((minx + 180) / tile)), int(math.ceil((maxx + 180) / tile))):
+            for ilat in range(int(math.floor((miny + 90) / tile)), int(math.ceil((maxy + 90) / tile))):
+                if (ilon, ilat) in cells:
+                    continue
+                lon = ilon * tile - 180
+                lat = ilat * tile - 90
+                cell = box(lon, lat, min(lon + tile, 180), min(lat + tile, 90))
+                if cell.intersects(shape):
+                    cells[(ilon, ilat)] = cell
+    return [cells[key] for key in sorted(cells.keys())]
 
-        shape_east = Polygon()
-        shape_west = Polygon()
 
-        if shape_east_list:
-            shape_east = ops.unary_union(gdf_slice['scihub_geometry_east_list']).buffer(2).simplify(1.9)
-        if shape_west_list:
-            shape_west = ops.unary_union(gdf_slice['scihub_geometry_west_list']).buffer(2).simplify(1.9)
+def _build_grid_slices(gdflist, filename, query=None, timedelta_slice=None, tile=None):
+    """
+    build scihub requests from normalize_gdf output, on a fixed space/time grid:
+    each slice is requested by calendar time windows of `timedelta_slice` (see `_floor_date`)
+    and lon/lat cells of `tile` degrees (default to `default_grid_tile`).
+    Queries only depend on the grid, so they are shared (ie cached) by runs with overlapping inputs.
 
-        wkt_shapes = []
+    return a tuple (slices, scihub_shapes), slices being a list of tuples (gdf_slice, list of str_query)
+    """
+    if timedelta_slice is None:
+        timedelta_slice = default_timedelta_slice
+    if tile is None:
+        tile = default_grid_tile
+    slices = []
+    scihub_shapes_chunk = []
+    for gdf_slice in gdflist:
+        if gdf_slice.empty:
+            continue
+        mindate = gdf_slice['beginposition'].min()
+        maxdate = gdf_slice['endposition'].max()
+        windows = [None]
+        if (mindate == mindate) and (maxdate == maxdate):  # non nan
+            windows = []
+            window_begin = _floor_date(mindate, timedelta_slice)
+            while window_begin < maxdate or not windows:
+                windows.append((window_begin, window_begin + timedelta_slice))
+                window_begin = window_begin + timedelta_slice
+
+        shapes = [shape for shapes_list in ['scihub_geometry_east_list', 'scihub_geometry_west_list']
+                  for shape in gdf_slice[shapes_list] if shape]
+        cells = _grid_cells(shapes, tile)
+        footprints = [None]
+        if cells:
+            footprints = ['footprint:"Intersects(%s)"' % wkt.dumps(cell, trim=True) for cell in cells]
+
+        queries = []
+        for window in windows:
+            for footprint in footprints:
+                q = []
+                if window is not None:
+                    q.append("beginPosition:[%s TO %s]" % (window[0].strftime(dateformat), window[1].strftime(
+                        dateformat)))
+                q.append("filename:%s" % filename)
+                if query:
+                    q.append("(%s)" % query)
+                if footprint is not None:
+                    q.append(footprint)
+                queries.append(' AND '.join(q))
+        logger.debug("grid slice : %d windows x %d cells" % (len(windows), len(footprints)))
+        scihub_shapes_chunk.extend(cells)
+        slices.append((gdf_slice, queries))
+    return slices, scihub_shapes_chunk
+
+
+def _probe_count(str_query, user=None, password=None, cachedir=None, cacherefreshrecent=None, source=None):
+    """
+    return scihub totalResults for str_query (request with rows=0), or None if the request failed.
+    with 'local' source, products are counted in the local catalog (see `scihubQuery_raw`).
+    """
+    if (default_source if source is None else source) == 'local':
+        query = ScihubQuery.parse(str_query)
+        _catalog_gaps(str_query, query, 'local', cachedir)
+        return len(_catalog_answer(query, cachedir))
+    chunk_safes, count, cache_status = _scihub_page(str_query, 0, user, password, cachedir, cacherefreshrecent, rows=0)
+    return count
 
-        for shape, plan in zip([shape_east, shape_west], [geoshp.plan_east, geoshp.plan_west]):
-            if not shape.is_empty:
 
-                # round the shape
-                scihub_shape_round = wkt.loads(wkt.dumps(shape, rounding_precision=rounding_precision))
+def _split_slice(gdf_slice):
+    """
+    split gdf_slice in two halves: in time if possible, else in longitude.
+    A single row is split in two time clipped rows.
+    return a list of two gdf slices, or None if gdf_slice can't be split anymore.
+    """
+    if len(gdf_slice) > 1:
+        if gdf_slice['beginposition'].nunique() > 1:
+            order = np.argsort(gdf_slice['beginposition'].values, kind='stable')
+        else:
+            with warnings.catch_warnings():
+                # disable geographic warning
+                warnings.simplefilter("ignore")
+                order = np.argsort(gdf_slice.geometry.centroid.x.values, kind='stable')
+        half = len(gdf_slice) // 2
+        return [gdf_slice.iloc[order[:half]], gdf_slice.iloc[order[half:]]]
+    begin = gdf_slice['beginposition'].iloc[0]
+    end = gdf_slice['endposition'].iloc[0]
+    if not (begin == begin and end == end) or end - begin < min_slice_duration * 2:
+        return None
+    middle = begin + (end - begin) / 2
+    first = gdf_slice.copy()
+    first['endposition'] = middle
+    second = gdf_slice.copy()
+    second['beginposition'] = middle
+    return [first, second]
+
+
+def _build_adaptive_slices(gdflist, filename, query=None, max_results=None, **kwargs):
+    """
+    build scihub requests from normalize_gdf output, with sizes driven by scihub totalResults
+    (see `_probe_count`, with kwargs):
+    slices with more than `max_results` (default to `default_adaptive_max_results`) products, or with a too long
+    query, are split (see `_split_slice`). Then neighbour slices are merged while they stay under `max_results`.
+    No slice is dropped: a slice that can't be split is queried as is (with shapes envelope if query is too long).
 
-                # ensure valid coords after rounding
-                try:
-                    scihub_shape = scihub_shape_round.intersection(plan)
-                    wkt_shapes.append(wkt.dumps(scihub_shape, rounding_precision=rounding_precision))
-                except:
-                    # no rounding
-                    wkt_shapes.append(wkt.dumps(scihub_shape))
+    return a tuple (slices, scihub_shapes), slices being a list of tuples (gdf_slice, str_query)
+    """
+    if max_results is None:
+        max_results = default_adaptive_max_results
+    if not isinstance(gdflist, list):
+        gdflist = [gdflist]
+
+    # split
+    planned = []  # list of (gdf_slice, str_query, scihub_shapes, count)
+    todo = [gdf_slice for gdf_slice in gdflist if not gdf_slice.empty]
+    if default_spatial_clustering:
+        todo = [gdf_cluster for gdf_slice in todo for gdf_cluster in _spatial_clusters(gdf_slice)]
+    nprobes = 0
+    while todo:
+        gdf_slice = todo.pop(0)
+        str_query, scihub_shapes = _slice_query(gdf_slice, filename, query=query)
+        count = None
+        if len(str_query) <= max_query_length:
+            count = _probe_count(str_query, **kwargs)
+            nprobes += 1
+            if count is None or count <= max_results:
+                planned.append((gdf_slice, str_query, scihub_shapes, count))
+                continue
+        halves = _split_slice(gdf_slice)
+        if halves is None:
+            if len(str_query) > max_query_length:
+                logger.warning('too long query (%s > %s). Using shapes envelope' % (len(str_query),
+                                                                                     max_query_length))
+                str_query, scihub_shapes = _slice_query(gdf_slice, filename, query=query, envelope=True)
+            planned.append((gdf_slice, str_query, scihub_shapes, count))
+            continue
+        logger.debug('splitting slice (%s products, query length %d)' % (count, len(str_query)))
+        todo[0:0] = halves
+
+    # merge
+    merged = []
+    for gdf_slice, str_query, scihub_shapes, count in planned:
+        if merged:
+            prev_slice, prev_query, prev_shapes, prev_count = merged[-1]
+            if prev_count is not None and count is not None and prev_count + count <= max_results \
+                    and not prev_slice.index.isin(gdf_slice.index).any():
+                merged_slice = pd.concat([prev_slice, gdf_slice])
+                merged_query, merged_shapes = _slice_query(merged_slice, filename, query=query)
+                if len(merged_query) <= max_query_length:
+                    # count is an upper bound (ie products in both slices)
+                    merged[-1] = (merged_slice, merged_query, merged_shapes, prev_count + count)
+                    continue
+        merged.append((gdf_slice, str_query, scihub_shapes, count))
 
-                scihub_shapes_chunk.append(scihub_shape)
+    logger.info('adaptive planner: %d slices -> %d requests (%d probes)' % (len(gdflist), len(merged), nprobes))
+    slices = [(gdf_slice, str_query) for gdf_slice, str_query, scihub_shapes, count in merged]
+    scihub_shapes_chunk = [shape for gdf_slice, str_query, scihub_shapes, count in merged for shape in scihub_shapes]
+    return slices, scihub_shapes_chunk
 
-        footprints = ['footprint:\"Intersects(%s)\" ' % wkt_shape for wkt_shape in wkt_shapes]
 
-        if footprints:
-            q.append('(%s)' % ' OR '.join(footprints))
+def _plan_slices(gdf, filename, query=None, timedelta_slice=None, planner=None, user=None, password=None,
+                 cachedir=None, cacherefreshrecent=None, track=None, source=None, **kwargs):
+    """
+    normalize gdf (see `normalize_gdf`, with kwargs) and build scihub requests with `planner` (see `scihubQuery`).
+    user, password, cachedir, cacherefreshrecent and source are used by the 'adaptive' planner probes.
+    track mode (see `normalize_gdf`) is only available with the 'slice' planner.
 
-        str_query = ' AND '.join(q)
-        logger.debug("query: %s" % str_query)
+    return a tuple (gdflist, slices, scihub_shapes)
+    """
+    if planner is None:
+        planner = default_planner
+    if track is None:
+        track = default_track
+    if planner != 'slice':
+        if track is True:
+            raise ValueError("track mode is not available with planner %s" % planner)
+        track = False
+    if planner == 'slice':
+        gdflist = normalize_gdf(gdf, timedelta_slice=timedelta_slice, track=track, **kwargs)
+        slices, scihub_shapes_chunk = _build_slices(gdflist, filename, query=query)
+    elif planner == 'grid':
+        gdflist = normalize_gdf(gdf, timedelta_slice=timedelta_slice, align_slices=True, **kwargs)
+        if not isinstance(gdflist, list):
+            # not sliced
+            gdflist = [gdflist]
+        slices, scihub_shapes_chunk = _build_grid_slices(gdflist, filename, query=query,
+                                                         timedelta_slice=timedelta_slice)
+    elif planner == 'adaptive':
+        gdflist = normalize_gdf(gdf, timedelta_slice=timedelta_slice, **kwargs)
+        slices, scihub_shapes_chunk = _build_adaptive_slices(gdflist, filename, query=query, user=user,
+                                                             password=password, cachedir=cachedir,
+                                                             cacherefreshrecent=cacherefreshrecent, source=source)
+    else:
+        raise ValueError("Unknown planner %s" % planner)
+    return gdflist, slices, scihub_shapes_chunk
 
-        if len(str_query) > 8000: # (https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/OpenSearchAPI#Discover_the_products_over_a_pre)
-            logger.error("query: %s" % str_query)
-            logger.error('skipping to long query (%s > 8000)' % len(str_query))
-            continue
 
-        t = time.time()
-        safes_unfiltered, cache_status = scihubQuery_raw(str_query, user=user, password=password, cachedir=cachedir,
-                                                         cacherefreshrecent=cacherefreshrecent,
-                                                         return_cache_status=True)
-        elapsed_request = time.time() - t
+def _collect_slices(slices_results, nslices, gdf, gdflist, crs, scihub_shapes_chunk, duplicate=False, datatake=0,
+                    user=None, password=None, cachedir=None, cacherefreshrecent=None, min_sea_percent=None, fig=None,
+                    full_fig=False, progress=True, verbose=False, alt_path=None, download=False, pairs=False):
+    """
+    gather slices results from `_slices_results` into the final scihubQuery geodataframe
+    (duplicates, datatakes, sea percent, figure, paths and download)
+
+    if pairs, slices results are `ColocPairs`, and a `ColocPairs` is returned: duplicates, sea percent, paths
+    and download are done on its products.
+    """
+    safes_list = []  # final request
+    safes_not_colocalized_list = []  # raw request
+    safes_sea_ok_list = []
+    safes_sea_nok_list = []
+
+    idx = 0
+    failed_slices = 0
+    pbar = tqdm(slices_results, total=nslices, disable=not progress, leave=False)
+    ncolocs = 0  # coloc count, for tqdm
+    for gdf_slice, slice_result in pbar:
+        idx += 1
+        if isinstance(slice_result, BaseException):
+            failed_slices += 1
+            logger.error('slice %d failed (%s to %s): %s' % (
+                idx, gdf_slice['beginposition'].min(), gdf_slice['endposition'].max(), str(slice_result)))
+            warnings.warn('slice %d failed: %s' % (idx, str(slice_result)), ScihubError)
+            continue
+        safes_unfiltered, cache_status, elapsed_request, safes, elapsed_coloc = slice_result
         safes_unfiltered_count = len(safes_unfiltered)
         logger.debug("requested safes from scihub : %s (%.2f secs)" % (safes_unfiltered_count, elapsed_request))
 
-        elapsed_coloc = 0
         if gdf is not None:
-            t = time.time()
-            if 'filename:S1' in str_query:
-                # some buggy safes on scihub have stopdate < startdate : remove them
-                safes_unfiltered = safes_unfiltered[safes_unfiltered['endposition'] - safes_unfiltered['beginposition'] > datetime.timedelta(0)]
-            logger.info('safes_unfiltered : %s',safes_unfiltered)
-            safes = _colocalize(safes_unfiltered, gdf_slice, crs=crs, progress=False)
-            elapsed_coloc = time.time() - t
             logger.debug("colocated with user query : %s SAFES in %.1f secs" % (len(safes), elapsed_coloc))
         else:
             # no geometry, so whole earth, and no index from gdf
             safes = safes_unfiltered.copy()
+        if pairs:
+            # work on products, pairs are selected at the end
+            coloc_pairs = safes if gdf is not None else ColocPairs.from_safes(safes)
+            safes = coloc_pairs.products
         safes_not_colocalized = safes_unfiltered[~safes_unfiltered['filename'].isin(safes['filename'])]
         del safes_unfiltered
 
@@ -1111,8 +2279,16 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
         if datatake != 0:
             logger.debug("Asking for same datatakes")
             nsafes = len(safes)
-            safes = get_datatakes(safes, datatake=datatake, user=user, password=password, cachedir=cachedir,
-                                  cacherefreshrecent=cacherefreshrecent)
+            if pairs:
+                # datatakes are indexed like their first colocated safe
+                coloc_pairs = coloc_pairs.select(safes)
+                safes = get_datatakes(coloc_pairs.first_pairs(), datatake=datatake, user=user, password=password,
+                                      cachedir=cachedir, cacherefreshrecent=cacherefreshrecent)
+                coloc_pairs = coloc_pairs.extend(safes)
+                safes = coloc_pairs.products
+            else:
+                safes = get_datatakes(safes, datatake=datatake, user=user, password=password, cachedir=cachedir,
+                                      cacherefreshrecent=cacherefreshrecent)
             logger.debug("added %s datatakes" % (len(safes) - nsafes))
 
             if not duplicate:
@@ -1131,6 +2307,10 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
 
         # sort by sensing date  
         safes = safes.sort_values('beginposition')
+        ncoloc = len(safes)
+        if pairs:
+            coloc_pairs = coloc_pairs.select(safes)
+            ncoloc = len(coloc_pairs)
         if gdf is not None:
             if cache_status:
                 cache_str = "cache"
@@ -1144,25 +2324,33 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
 
             status_msg = "Req {ireq:3d}/{nreq:3d} ( {chunk_size:3d} items ) : {nsafes_ok:3d}/{nsafes:3d} SAFES ({cache_status}) -> {ncoloc:4d} colocs. {time_str}".format(
                 chunk_size=len(gdf_slice),
-                ireq=idx, nreq=len(gdflist), nsafes_ok=len(safes['filename'].unique()),
+                ireq=idx, nreq=nslices, nsafes_ok=len(safes['filename'].unique()),
                 cache_status=cache_str,
-                nsafes=safes_unfiltered_count, ncoloc=len(safes['filename']),
+                nsafes=safes_unfiltered_count, ncoloc=ncoloc,
                 time_str=time_str)
-            ncolocs += len(safes)
+            ncolocs += ncoloc
             pbar.set_description("coloc : %04d" % ncolocs)
             if verbose:
                 tqdm.write(status_msg, file=sys.stderr)
             else:
                 logger.debug(status_msg)
 
-        safes_list.append(safes)
+        safes_list.append(coloc_pairs if pairs else safes)
         if full_fig:
             safes_not_colocalized_list.append(safes_not_colocalized)
             if min_sea_percent is not None:
                 safes_sea_ok_list.append(safes_sea_ok)
                 safes_sea_nok_list.append(safes_sea_nok)
     pbar.close()
-    safes = pd.concat(safes_list, sort=False)
+    if failed_slices:
+        logger.error('%d/%d slices failed' % (failed_slices, nslices))
+    if not safes_list:
+        safes_list = [_empty_result('pairs' if pairs else 'safes')]
+    if pairs:
+        coloc_pairs = ColocPairs.concat(safes_list)
+        safes = coloc_pairs.products
+    else:
+        safes = pd.concat(safes_list, sort=False)
     safes = safes.sort_values('beginposition')
     if full_fig:
         safes_not_colocalized = pd.concat(safes_not_colocalized_list, sort=False)
@@ -1174,7 +2362,8 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
         srs = crs.srs
     except:
         srs = crs['init']  # should be deprecated
-    logger.info("Total : %s SAFES colocated with %s (%s uniques)." % (len(safes), srs, len(safes['filename'].unique())))
+    logger.info("Total : %s SAFES colocated with %s (%s uniques)." % (len(coloc_pairs) if pairs else len(safes), srs,
+                                                                     len(safes['filename'].unique())))
 
     if fig is not None:
         uniques_safes = safes.drop_duplicates('filename')
@@ -1277,7 +2466,533 @@ def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None,
     if download:
         safes = download_from_df(safes, destination=cachedir, progress=progress)
 
+    if pairs:
+        coloc_pairs.products = safes
+        return coloc_pairs
     return safes
 
 
+def _empty_result(output='safes'):
+    """empty scihubQuery result, for output 'safes' or 'pairs'"""
+    if output == 'pairs':
+        return ColocPairs.from_safes(safes_empty)
+    return safes_empty
+
+
+
+def scihubQuery(gdf=None, startdate=None, stopdate=None, date=None, dtime=None, timedelta_slice=None, filename=None,
+                datatake=0, duplicate=False, query=None, user=None, password=None, min_sea_percent=None, fig=None,
+                cachedir=None, cacherefreshrecent=None, progress=True, verbose=False, full_fig=False, alt_path=None, download=False,
+                n_workers=1, planner=None, track=None, source=None, coloc_workers=1, max_distance=None, output='safes',
+                page_workers=None, cache_refresh=None):
+    """
+    
+    input:
+        gdf : 
+            None or geodataframe with geometry and date. gdf usually contain almost these cols:
+            index         : an index for the row (for ex area name, buoy id, etc ...)
+            beginposition : datetime object (startdate)
+            endposition   : datetime object (stopdate)
+            geometry      : shapely object (this one is optional for whole earth)
+        date: 
+            column name if gdf, or datetime object
+        dtime : 
+            if date is not None, dtime as timedelta object will be used to compute startdate and stopdate 
+        startdate : 
+            None or column  name in gdf , or datetime object . not used if date and dtime are defined. 
+            Default to 'beginposition'
+        stopdate : 
+            None or column  name in gdf , or datetime object . not used if date and dtime are defined. 
+            Default to 'endposition'
+        timedelta_slice:
+            Max time slicing : Scihub request will be grouped or sliced to this. 
+            Default to datetime.timedelta(weeks=1).
+            If None, no slicing is done.
+        duplicate : 
+            if True, will return duplicates safes (ie same safe with different prodid). Default to False
+        datatake : 
+            number of adjacent safes to return (ie 0 will return 1 safe, 1 return 3, 2 return 5, etc )
+        query : 
+            aditionnal query string, for ex '(platformname:Sentinel-1 AND sensoroperationalmode:WV)' 
+        cachedir : 
+            cache requests for speed up. 
+        cacherefreshrecent : 
+            timedelta from now. if requested stopdate is recent, will refresh the cache to let scihub ingest new data.
+            Default to datetime.timedelta(days=7).
+        cache_refresh : str or None
+            'page' or 'incremental' (see `scihubQuery_raw`). Default to `default_cache_refresh`.
+        page_workers : int or None
+            number of threads fetching the pages of each request (see `scihubQuery_raw`).
+            Default to `default_page_workers`.
+        fig : 
+            matplotlib fig handle ( default to None : no plot)
+        progress : True show progressbar
+        verbose  : False to silent messages
+        alt_path : None, str or list of str
+            search path in str or list of str to get safe path (columns 'path')
+            str is a path string, with optionnal wilcards like `/home/datawork-cersat-public/cache/project/mpc-sentinel1/data/esa/sentinel-${missionid}/L${LEVEL}/${BEAM}/${MISSIONID}_${BEAM}_${PRODUCT}${RESOLUTION}_${LEVEL}${CLASS}/${year}/${doy}/${SAFE}`,
+            or a simple path like '.' or '/tmp/scihub_download'
+            if list, search in the list until a path is found.
+        download : bool
+            imply get_path. default to False. If True, download safes to `alt_path` (if alt_path is a list, the first index is used)
+        download_wait : bool
+            if `download`, will wait for non online safe to be ready. default to False.
+        n_workers : int
+            number of slices processed concurrently (requests in threads, colocations in processes).
+            Default to 1 (sequential). If > 1, a failing slice is reported as a ScihubError warning,
+            and the others slices are still returned. Colocation processes are started with
+            `default_mp_start_method` ('forkserver' or 'spawn'), so scripts must guard their main code with
+            `if __name__ == '__main__':`.
+        coloc_workers : int
+            number of processes used by each slice colocation (time partitions, see
+            `geopandas_coloc.colocalize_parallel`), in one processes pool for the whole run. Default to 1.
+        max_distance : float or None
+            if not None, safes closer than max_distance meters from gdf rows are returned, with the distance
+            in a 'coloc_distance' column (needs scikit-learn, see `geopandas_coloc.colocalize_distance`).
+            Scihub requests are enlarged by max_distance. Distances are computed in lon/lat, whatever the gdf crs,
+            and can't be used with coloc_workers > 1.
+        planner : str
+            'slice' : one request per time slice, with the union of the slice footprints.
+            'grid' : requests on fixed calendar time windows (of timedelta_slice) and lon/lat cells
+            (of `default_grid_tile` degrees), filtered back to gdf by colocation. Requests are then shared
+            by runs with overlapping inputs, and cached.
+            'adaptive' : slices are split or merged, so each request has at most `default_adaptive_max_results`
+            products (probed with a rows=0 request), and a query shorter than `max_query_length`.
+            Default to `default_planner`.
+        track : bool or 'auto'
+            if True, gdf is a track (time ordered Point or LineString rows, like a ship or drifter track):
+            there is one buffered corridor per time slice, instead of one shape per row, and each safe is only
+            colocalized with the track points inside its time window. 'auto' will detect a track.
+            Only with planner 'slice'. Default to `default_track`.
+        source : str
+            'hub', 'local' or 'hybrid' (see `scihubQuery_raw`). 'local' and 'hybrid' answer requests from
+            the product catalog of cachedir. Default to `default_source`.
+        output : str
+            'safes' : return the joined geodataframe (one safe row per colocation).
+            'pairs' : return a `ColocPairs`, with colocated (gdf index, uuid) pairs, and the colocated products
+            once each. The joined geodataframe is built by `ColocPairs.join`. Default to 'safes'.
+    return :
+        a geodataframe with safes from scihub, colocated with input gdf (ie same index), or a `ColocPairs`
+    """
+    global default_user
+    global default_password
+    
+    if output not in ['safes', 'pairs']:
+        raise ValueError("output must be 'safes' or 'pairs', not %s" % output)
+    if max_distance is not None and coloc_workers > 1:
+        raise ValueError("coloc_workers > 1 can't be used with max_distance")
+    if sys.gettrace():
+        logger.setLevel(logging.DEBUG)
+        progress = False
+        full_fig = True
+    if gdf is not None and len(gdf) == 0:
+        logger.warning("No coloc with an empty gdf")
+        return _empty_result(output)
+    if not sys.stderr.isatty() and "tqdm.std" in str(tqdm):
+        progress = False
+
+    # get default keywords values
+    if user is None:
+        user = default_user
+    if password is None:
+        password = default_password
+    # set default user/password
+    default_user = user
+    default_password = password
+
+    if cachedir is None:
+        cachedir = default_cachedir
+    if alt_path is None:
+        alt_path = default_alt_path
+    if cacherefreshrecent is None:
+        cacherefreshrecent = default_cacherefreshrecent
+    if timedelta_slice is None:
+        timedelta_slice = default_timedelta_slice
+    if filename is None:
+        filename = default_filename
+
+    gdflist, slices, scihub_shapes_chunk = _plan_slices(gdf, filename, query=query, timedelta_slice=timedelta_slice,
+                                                        planner=planner, user=user, password=password,
+                                                        cachedir=cachedir, cacherefreshrecent=cacherefreshrecent,
+                                                        track=track, source=source, startdate=startdate,
+                                                        stopdate=stopdate, date=date, dtime=dtime,
+                                                        max_distance=max_distance)
+
+    # user crs will be used for coloc
+    if gdf is None or gdf.crs is None:
+        crs = scihub_crs
+    else:
+        crs = gdf.crs
+
+    slices_results = _slices_results(slices, colocalize=gdf is not None, crs=crs, n_workers=n_workers, user=user,
+                                     password=password, cachedir=cachedir, cacherefreshrecent=cacherefreshrecent,
+                                     source=source, coloc_workers=coloc_workers, max_distance=max_distance,
+                                     pairs=output == 'pairs', page_workers=page_workers, cache_refresh=cache_refresh)
+
+    return _collect_slices(slices_results, len(slices), gdf, gdflist, crs, scihub_shapes_chunk, duplicate=duplicate,
+                           datatake=datatake, user=user, password=password, cachedir=cachedir,
+                           cacherefreshrecent=cacherefreshrecent, min_sea_percent=min_sea_percent, fig=fig,
+                           full_fig=full_fig, progress=progress, verbose=verbose, alt_path=alt_path, download=download,
+                           pairs=output == 'pairs')
+
+async def _get_async(http_session, semaphore, url, **kwargs):
+    """
+    aiohttp get, with the retry policy of the shared ScihubSession.
+    return the answer content
+    """
+    policy = get_session()
+    retry = 0
+    while True:
+        try:
+            async with semaphore:
+                async with http_session.get(url, **kwargs) as response:
+                    status = response.status
+                    content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if retry >= policy.max_retries:
+                raise_from(ConnectionError("Unable to connect to %s" % url), None)
+            reason = str(e)
+        else:
+            if status in policy.retry_status:
+                reason = 'http status %d' % status
+            elif scihub_timeout_message in content:
+                reason = 'scihub timeout'
+            else:
+                return content
+            if retry >= policy.max_retries:
+                return content
+        sleep = policy.backoff(retry)
+        retry += 1
+        logger.warning('retry %d/%d in %.1fs for %s : %s' % (retry, policy.max_retries, sleep, url, reason))
+        await asyncio.sleep(sleep)
+
+
+async def _blocking(func, *args, **kwargs):
+    """
+    run func (cache index, catalog, parquet/xml files, parsing ...) in the default executor,
+    so the event loop is only used by aiohttp requests
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _aiohttp_session():
+    """new aiohttp session, with the timeouts and pool size of the shared ScihubSession"""
+    if aiohttp is None:
+        raise ImportError("async api needs aiohttp. Consider 'pip install aiohttp'")
+    policy = get_session()
+    timeout = aiohttp.ClientTimeout(sock_connect=policy.connect_timeout, sock_read=policy.read_timeout)
+    return aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(
+        limit_per_host=policy.pool_maxsize))
+
+
+async def _scihub_page_async(http_session, semaphore, str_query, start, user, password, cachedir, cacherefreshrecent):
+    """async version of _scihub_page"""
+    params = OrderedDict([("start", start), ("rows", page_rows), ("q", str_query)])
+    cache = await _blocking(_page_cache, cachedir, params)
+    page = await _blocking(_read_cached_page, cache, params)
+    cache_status = page is not None
+    if page is None:
+        # request not cached
+        content = await _get_async(http_session, semaphore, urlapi, auth=aiohttp.BasicAuth(user, password),
+                                   params=[(k, str(v)) for k, v in params.items()])
+        if scihub_timeout_message in content:
+            logger.warning('Timeout while processing request : %s' % str_query)
+            warnings.warn('Giving up trying to connect %s ' % urlapi, ScihubError)
+            return None, None, False
+        page = await _blocking(_page_from_answer, content, str_query, cache, params)
+
+    chunk_safes, count = page
+    await _blocking(_refresh_recent, chunk_safes, cache, cacherefreshrecent, str_query)
+    return chunk_safes, count, cache_status
+
+
+async def _query_pages_async(http_session, semaphore, str_query, user, password, cachedir, cacherefreshrecent):
+    """async version of _query_pages"""
+    page = functools.partial(_scihub_page_async, http_session, semaphore, str_query, user=user, password=password,
+                             cachedir=cachedir, cacherefreshrecent=cacherefreshrecent)
+
+    chunk_safes, count, cache_status = await page(start=0)
+    chunks = [chunk_safes]
+    complete = count is not None
+    fetched = not cache_status
+
+    if chunk_safes is not None and count is not None and count > len(chunk_safes):
+        pages = await asyncio.gather(*[page(start=start) for start in range(page_rows, count, page_rows)])
+        for chunk_safes, page_count, page_cache_status in pages:
+            if page_count is None:
+                logger.warning('missing page in answer for %s' % str_query)
+                complete = False
+            chunks.append(chunk_safes)
+            cache_status = cache_status or page_cache_status
+            fetched = fetched or not page_cache_status
+
+    return await _blocking(_merge_pages, chunks), cache_status, complete, fetched
+
+
+async def scihubQuery_raw_async(str_query, user=None, password=None, cachedir=None, cacherefreshrecent=None,
+                                return_cache_status=False, semaphore=None, http_session=None, cache_refresh=None,
+                                source=None):
+    """
+    async version of `scihubQuery_raw`, using aiohttp.
+
+    semaphore: asyncio.Semaphore or None
+        limit the number of requests in flight. Default to a new semaphore of `default_async_concurrency`
+    http_session: aiohttp.ClientSession or None
+        session to use. Default to a new session, closed on return.
+    """
+
+    # get default keywords values
+    if user is None:
+        user = default_user
+    if password is None:
+        password = default_password
+    if cachedir is None:
+        cachedir = default_cachedir
+    if cacherefreshrecent is None:
+        cacherefreshrecent = default_cacherefreshrecent
+    if cache_refresh is None:
+        cache_refresh = default_cache_refresh
+    if source is None:
+        source = default_source
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(default_async_concurrency)
+    if http_session is None:
+        async with _aiohttp_session() as http_session:
+            return await scihubQuery_raw_async(str_query, user=user, password=password, cachedir=cachedir,
+                                               cacherefreshrecent=cacherefreshrecent,
+                                               return_cache_status=return_cache_status, semaphore=semaphore,
+                                               http_session=http_session, cache_refresh=cache_refresh, source=source)
+
+    query_pages = functools.partial(_query_pages_async, http_session, semaphore, user=user, password=password,
+                                    cacherefreshrecent=cacherefreshrecent)
+    query = ScihubQuery.parse(str_query)
+    gap_queries = None
+    if source != 'hub':
+        gap_queries = await _blocking(_catalog_gaps, str_query, query, source, cachedir)
+    if gap_queries is not None:
+        answers = await asyncio.gather(*[
+            scihubQuery_raw_async(gap_query, user=user, password=password, cachedir=cachedir,
+                                  cacherefreshrecent=cacherefreshrecent, return_cache_status=True, semaphore=semaphore,
+                                  http_session=http_session, cache_refresh=cache_refresh, source='hub')
+            for gap_query in gap_queries])
+        cache_status = all(gap_cache_status for _, gap_cache_status in answers)
+        safes = await _blocking(_catalog_answer, query, cachedir)
+        return (safes, cache_status) if return_cache_status else safes
+
+    safes = await _blocking(_cached_answer, query, cachedir, cacherefreshrecent)
+    if safes is not None:
+        return (safes, True) if return_cache_status else safes
+
+    query_cache = await _blocking(_query_cache, cachedir, str_query, cache_refresh)
+    cached = await _blocking(_read_query_entry, query_cache)
+    update_entry = cached is None
+    fetched = None  # products asked to scihub
+    if cached is None:
+        safes, cache_status, complete, pages_fetched = await query_pages(str_query, cachedir=cachedir)
+        fetched = safes if pages_fetched else None
+    else:
+        safes, watermark, refresh_time = cached
+        cache_status, complete = True, True
+        if _needs_refresh(query, refresh_time, cacherefreshrecent):
+            delta, delta_cache_status, complete, _ = await query_pages(_delta_query(str_query, watermark),
+                                                                       cachedir=None)
+            safes = await _blocking(_merge_delta, safes, delta)
+            fetched = delta
+            update_entry = True
+    await _blocking(_store_answer, query, safes, str_query, query_cache, cachedir, cacherefreshrecent, complete,
+                    update_entry, fetched)
+
+    if return_cache_status:
+        return safes, cache_status
+    else:
+        return safes
+
+
+async def _queue_put_async(results, item, collect):
+    """put item in results queue, waiting (without blocking the loop) for the collect future to get it"""
+    while True:
+        try:
+            results.put_nowait(item)
+            return
+        except queue.Full:
+            if collect.done():
+                # collector failed: raise its exception
+                collect.result()
+                return
+            await asyncio.sleep(0.01)
+
+
+async def _collect_slice_async(results, pending_slice, collect):
+    """
+    wait for a pending (gdf_slice, slice task), and put (gdf_slice, result) in results queue for the collector.
+    result is the exception if the slice failed. A cancelled slice cancels the whole query.
+    """
+    gdf_slice, slice_task = pending_slice
+    try:
+        result = await slice_task
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result = e
+    await _queue_put_async(results, (gdf_slice, result), collect)
+
+
+async def _slice_result_async(gdf_slice, str_query, colocalize=True, crs=scihub_crs, coloc_workers=1, max_distance=None,
+                              footprints_cache=None, pairs=False, coloc_executor=None, **kwargs):
+    """
+    async version of one `_slices_results` item. colocation is done in the default executor,
+    with footprints_cache and coloc_executor shared by all slices (see `_colocalize`)
+    """
+    t = time.time()
+    if isinstance(str_query, str):
+        safes_unfiltered, cache_status = await scihubQuery_raw_async(str_query, return_cache_status=True, **kwargs)
+    else:
+        answers = await asyncio.gather(*[
+            scihubQuery_raw_async(q, return_cache_status=True, **kwargs) for q in str_query])
+        safes_unfiltered = await _blocking(_merge_answers, [answer for answer, _ in answers])
+        cache_status = all(answer_cache_status for _, answer_cache_status in answers)
+    safes_unfiltered = await _blocking(_slice_time_filter, safes_unfiltered, gdf_slice, str_query)
+    elapsed_request = time.time() - t
+    safes, elapsed_coloc = None, 0
+    if colocalize:
+        safes, elapsed_coloc = await _blocking(
+            lambda: _timed_colocalize(_remove_buggy(safes_unfiltered, str_query), gdf_slice, crs=crs,
+                                      n_workers=coloc_workers, max_distance=max_distance,
+                                      footprints_cache=footprints_cache, pairs=pairs, coloc_executor=coloc_executor))
+    return safes_unfiltered, cache_status, elapsed_request, safes, elapsed_coloc
+
+
+async def scihubQuery_async(gdf=None, startdate=None, stopdate=None, date=None, dtime=None, timedelta_slice=None,
+                            filename=None, datatake=0, duplicate=False, query=None, user=None, password=None,
+                            min_sea_percent=None, fig=None, cachedir=None, cacherefreshrecent=None, progress=True,
+                            verbose=False, full_fig=False, alt_path=None, download=False, semaphore=None,
+                            http_session=None, planner=None, track=None, source=None, coloc_workers=1,
+                            max_distance=None, output='safes', cache_refresh=None):
+    """
+    async version of `scihubQuery`, using aiohttp. Slices and pages requests are done concurrently
+    in the running event loop, with at most `default_async_slices` slices in flight.
+
+    same input as `scihubQuery`, with:
+        semaphore: asyncio.Semaphore or None
+            limit the number of requests in flight. Default to a new semaphore of `default_async_concurrency`
+        http_session: aiohttp.ClientSession or None
+            session to use. Default to a new session, closed on return.
+    (pages are fetched concurrently, limited by semaphore: there is no page_workers)
+
+    colocations and final processing (datatakes, figure, download ...) are done in the default executor.
+    A failing slice is reported as a ScihubError warning, and the others slices are still returned.
+
+    return :
+        a geodataframe with safes from scihub, colocated with input gdf (ie same index), or a `ColocPairs`
+    """
+    global default_user
+    global default_password
+
+    if output not in ['safes', 'pairs']:
+        raise ValueError("output must be 'safes' or 'pairs', not %s" % output)
+    if max_distance is not None and coloc_workers > 1:
+        raise ValueError("coloc_workers > 1 can't be used with max_distance")
+    if gdf is not None and len(gdf) == 0:
+        logger.warning("No coloc with an empty gdf")
+        return _empty_result(output)
+    if not sys.stderr.isatty() and "tqdm.std" in str(tqdm):
+        progress = False
+
+    # get default keywords values
+    if user is None:
+        user = default_user
+    if password is None:
+        password = default_password
+    # set default user/password
+    default_user = user
+    default_password = password
+
+    if cachedir is None:
+        cachedir = default_cachedir
+    if alt_path is None:
+        alt_path = default_alt_path
+    if cacherefreshrecent is None:
+        cacherefreshrecent = default_cacherefreshrecent
+    if timedelta_slice is None:
+        timedelta_slice = default_timedelta_slice
+    if filename is None:
+        filename = default_filename
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(default_async_concurrency)
+    if http_session is None:
+        async with _aiohttp_session() as http_session:
+            return await scihubQuery_async(gdf=gdf, startdate=startdate, stopdate=stopdate, date=date, dtime=dtime,
+                                           timedelta_slice=timedelta_slice, filename=filename, datatake=datatake,
+                                           duplicate=duplicate, query=query, user=user, password=password,
+                                           min_sea_percent=min_sea_percent, fig=fig, cachedir=cachedir,
+                                           cacherefreshrecent=cacherefreshrecent, progress=progress,
+                                           verbose=verbose, full_fig=full_fig, alt_path=alt_path, download=download,
+                                           semaphore=semaphore, http_session=http_session, planner=planner,
+                                           track=track, source=source, coloc_workers=coloc_workers,
+                                           max_distance=max_distance, output=output, cache_refresh=cache_refresh)
+
+    loop = asyncio.get_running_loop()
+    gdflist, slices, scihub_shapes_chunk = await loop.run_in_executor(None, functools.partial(
+        _plan_slices, gdf, filename, query=query, timedelta_slice=timedelta_slice, planner=planner, user=user,
+        password=password, cachedir=cachedir, cacherefreshrecent=cacherefreshrecent, track=track, source=source,
+        startdate=startdate, stopdate=stopdate, date=date, dtime=dtime, max_distance=max_distance))
+
+    # user crs will be used for coloc
+    if gdf is None or gdf.crs is None:
+        crs = scihub_crs
+    else:
+        crs = gdf.crs
+    # projected footprints and processes pool, shared by slices colocations
+    footprints_cache = None if is_geographic(crs) else {}
+    coloc_executor = None
+    if gdf is not None and coloc_workers > 1:
+        coloc_executor = ProcessPoolExecutor(max_workers=coloc_workers,
+                                             mp_context=multiprocessing.get_context(default_mp_start_method))
+
+    # slices results are collected in the default executor while next slices are requested
+    slices_results = queue.Queue(maxsize=1)
+    collect = loop.run_in_executor(None, functools.partial(
+        _collect_slices, iter(slices_results.get, None), len(slices), gdf, gdflist, crs, scihub_shapes_chunk,
+        duplicate=duplicate, datatake=datatake, user=user, password=password, cachedir=cachedir,
+        cacherefreshrecent=cacherefreshrecent, min_sea_percent=min_sea_percent, fig=fig, full_fig=full_fig,
+        progress=progress, verbose=verbose, alt_path=alt_path, download=download, pairs=output == 'pairs'))
+
+    # at most default_async_slices slices in flight, in slices order
+    pending = collections.deque()
+    try:
+        for gdf_slice, str_query in slices:
+            pending.append((gdf_slice, asyncio.ensure_future(_slice_result_async(
+                gdf_slice, str_query, colocalize=gdf is not None, crs=crs, user=user, password=password,
+                cachedir=cachedir, cacherefreshrecent=cacherefreshrecent, semaphore=semaphore,
+                http_session=http_session, source=source, coloc_workers=coloc_workers, max_distance=max_distance,
+                footprints_cache=footprints_cache, pairs=output == 'pairs', cache_refresh=cache_refresh,
+                coloc_executor=coloc_executor))))
+            if len(pending) >= default_async_slices:
+                await _collect_slice_async(slices_results, pending.popleft(), collect)
+        while pending:
+            await _collect_slice_async(slices_results, pending.popleft(), collect)
+        await _queue_put_async(slices_results, None, collect)
+    except BaseException:
+        for gdf_slice, slice_task in pending:
+            slice_task.cancel()
+        # stop the collector
+        while not collect.done():
+            try:
+                slices_results.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    slices_results.get_nowait()
+                except queue.Empty:
+                    pass
+        raise
+    finally:
+        if coloc_executor is not None:
+            # all colocations are done (or cancelled): processes exit without blocking the loop
+            coloc_executor.shutdown(wait=False, cancel_futures=True)
+
+    return await collect
+
+
 scihubQuery_new = scihubQuery
@@ -2,9 +2,13 @@ import datetime
 import pandas as pd
 import geopandas as gpd
 import numpy as np
+import shapely
+import os
 import sys
 from tqdm.auto import tqdm
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import logging
 from builtins import isinstance
@@ -15,6 +19,22 @@ logger.setLevel(logging.INFO)
 if sys.gettrace():
     logger.setLevel(logging.DEBUG)
 
+# mean earth radius, in meters (colocalize_distance)
+earth_radius = 6371008.8
+# colocalize_distance densify lines so segments are shorter than max_distance / distance_densify
+# (but not shorter than distance_min_step meters)
+distance_densify = 4
+distance_min_step = 1000
+# start method of colocalize_parallel processes (not 'fork': the caller may have threads)
+default_mp_start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _take(index, positions):
+    """index labels at positions (a list of positions arrays), as a single index"""
+    if not positions:
+        return index.delete(slice(None))
+    return index.take(np.concatenate(positions).astype(np.int64))
+
 
 def colocalize_apply(gdf1, gdf2, progress=False):
     """colocalize gdf1 and gdf2
@@ -26,16 +46,14 @@ def colocalize_apply(gdf1, gdf2, progress=False):
     if not sys.stderr.isatty() and "tqdm.std" in  str(tqdm):
         progress = False
     def row_coloc(gdf_item,gdf2,gdf_geometry_name='geometry'):
-        timeok_gdf2 = gdf2[gdf2_date_interval.overlaps(gdf_item.date_interval__)]
+        time_ok = np.flatnonzero(gdf2_date_interval.overlaps(gdf_item.date_interval__))
+        timeok_gdf2 = gdf2.iloc[time_ok]
             
         if hasattr(gdf_item,gdf1_geometry_name) and hasattr(gdf2,'geometry'):
             intersect_gdf2_ok = timeok_gdf2.contains(getattr(gdf_item,gdf1_geometry_name)) |  timeok_gdf2.intersects(getattr(gdf_item,gdf1_geometry_name)) | timeok_gdf2.geometry.within(getattr(gdf_item,gdf1_geometry_name))
-        else:
-            # if the user gave no geometry : all index
-            intersect_gdf2_ok = slice(None)
-            
-        intersect_gdf2_idx = timeok_gdf2[intersect_gdf2_ok].index
-        return timeok_gdf2[intersect_gdf2_ok].index
+            return time_ok[intersect_gdf2_ok.values]
+        # if the user gave no geometry : all index
+        return time_ok
      
      
     if not 'date_interval__' in gdf1:
@@ -51,22 +69,14 @@ def colocalize_apply(gdf1, gdf2, progress=False):
     gdf1_geometry_name = gdf1.geometry.name
     gdf2_geometry_name = gdf2.geometry.name
     
-    # empty index to store colocalization results
-    idx1=gdf1.index.delete(slice(None))
-    idx2=gdf2.index.delete(slice(None))
-    
-    if isinstance(gdf1.index,pd.MultiIndex):
-        indexer1 = pd.MultiIndex.from_tuples
-    else:
-        indexer1 = pd.Index
-    
     tqdm.pandas(disable = not progress, leave=False)
-    gdf2_coloc_idx = gdf1.progress_apply(lambda row : row_coloc(row, gdf2,gdf_geometry_name=gdf1.geometry.name),axis=1)
-    for gdf1_idx , gdf2_idx_serie in gdf2_coloc_idx.items():
-        for gdf2_idx in  gdf2_idx_serie:
-            idx1 = idx1.append(indexer1([gdf1_idx]))
-            idx2 = idx2.append(indexer1([gdf2_idx]))
-    return idx1,idx2
+    gdf2_coloc_pos = []
+    if len(gdf1) != 0:
+        gdf2_coloc_pos = list(gdf1.progress_apply(lambda row : row_coloc(row, gdf2,gdf_geometry_name=gdf1.geometry.name),axis=1))
+    # colocated positions, converted to index once
+    pos1 = [np.full(len(pos2), ipos1) for ipos1, pos2 in enumerate(gdf2_coloc_pos)]
+    return _take(gdf1.index, pos1), _take(gdf2.index, gdf2_coloc_pos)
+
 
 def colocalize_loop(gdf1, gdf2, progress=False):
     """colocalize gdf1 and gdf2
@@ -93,177 +103,388 @@ def colocalize_loop(gdf1, gdf2, progress=False):
     gdf1_geometry_name = gdf1.geometry.name
     gdf2_geometry_name = gdf2.geometry.name
     
-    # empty index to store colocalization results
-    idx1=gdf1.index.delete(slice(None))
-    idx2=gdf2.index.delete(slice(None))
-    
-    if isinstance(gdf1.index,pd.MultiIndex):
-        indexer1 = pd.MultiIndex.from_tuples
-    else:
-        indexer1 = pd.Index
+    # colocated positions, converted to index once at the end
+    pos1 = []
+    pos2 = []
     
     # a for loop is faster than an apply loop
-    for gdf_item in tqdm(gdf1.itertuples(),total=len(gdf1),disable = not progress,leave=False):
-        timeok_gdf2 = gdf2[gdf2_date_interval.overlaps(gdf_item.date_interval__)]
+    for ipos1, gdf_item in enumerate(tqdm(gdf1.itertuples(),total=len(gdf1),disable = not progress,leave=False)):
+        time_ok = np.flatnonzero(gdf2_date_interval.overlaps(gdf_item.date_interval__))
+        timeok_gdf2 = gdf2.iloc[time_ok]
             
         if hasattr(gdf_item,gdf1_geometry_name) and hasattr(gdf2,'geometry'):
             intersect_gdf2_ok = timeok_gdf2.contains(getattr(gdf_item,gdf1_geometry_name)) |  timeok_gdf2.intersects(getattr(gdf_item,gdf1_geometry_name)) | timeok_gdf2.geometry.within(getattr(gdf_item,gdf1_geometry_name))
+            intersect_gdf2_pos = time_ok[intersect_gdf2_ok.values]
         else:
             # if the user gave no geometry : all index
-            intersect_gdf2_ok = slice(None)
-            
-        intersect_gdf2_idx = timeok_gdf2[intersect_gdf2_ok].index
+            intersect_gdf2_pos = time_ok
         
-        if intersect_gdf2_idx.size != 0:
-            # idx1 must have same size as idx2. duplicate gdf_item.Index as needed
-            idx1 = idx1.append(indexer1([gdf_item.Index] * len(intersect_gdf2_idx)))
-            idx2 = idx2.append(intersect_gdf2_idx)
+        if intersect_gdf2_pos.size != 0:
+            # pos1 must have same size as pos2. duplicate gdf_item position as needed
+            pos1.append(np.full(intersect_gdf2_pos.size, ipos1))
+            pos2.append(intersect_gdf2_pos)
     
     if drop1:
         # remove column if it was not present
         gdf1.drop(columns=['date_interval__'],inplace=True)    
-    return idx1,idx2   
+    return _take(gdf1.index, pos1), _take(gdf2.index, pos2)   
+
+def _dates_ns(dates):
+    """dates serie as int64 nanoseconds (NaT is min int64)"""
+    return pd.to_datetime(dates, utc=True).values.astype('datetime64[ns]').view('int64')
+
+
+def _time_overlaps(gdf1, gdf2, pos1, pos2):
+    """
+    mask of pairs (gdf1 positions pos1, gdf2 positions pos2) with time overlaps
+    (start1 < stop2 and start2 < stop1, like `pd.IntervalIndex.overlaps`). NaT never overlaps.
+    """
+    start1 = _dates_ns(gdf1['startdate'])
+    stop1 = _dates_ns(gdf1['stopdate'])
+    start2 = _dates_ns(gdf2['startdate'])
+    stop2 = _dates_ns(gdf2['stopdate'])
+    nat = np.iinfo(np.int64).min
+    valid1 = (start1 != nat) & (stop1 != nat)
+    valid2 = (start2 != nat) & (stop2 != nat)
+    return valid1[pos1] & valid2[pos2] & (start1[pos1] < stop2[pos2]) & (start2[pos2] < stop1[pos1])
+
+
+def colocalize_index(gdf1, gdf2, progress=False):
+    """colocalize gdf1 and gdf2, with bulk queries.
+
+    candidates pairs are found at once with a STRtree on gdf2 geometries (bounding boxes),
+    then filtered with vectorized time overlaps (start1 < stop2 and start2 < stop1, like `pd.IntervalIndex.overlaps`)
+    and one vectorized intersects predicate.
+
+    return:
+      2 pandas Index idx1 and idx2, of the same size. idx1 are colocated index from gdf1 that colocalize with idx2 from gdf2
+      (note that index may not be unique if some are colocated more than once.
+    """
+    geoms1 = gdf1.geometry.values
+    geoms2 = gdf2.geometry.values
+    pos1, pos2 = shapely.STRtree(geoms2).query(geoms1)
+
+    time_ok = _time_overlaps(gdf1, gdf2, pos1, pos2)
+    pos1, pos2 = pos1[time_ok], pos2[time_ok]
+
+    ok = shapely.intersects(geoms1[pos1], geoms2[pos2])
+    pos1, pos2 = pos1[ok], pos2[ok]
+    order = np.lexsort((pos2, pos1))
+    return gdf1.index[pos1[order]], gdf2.index[pos2[order]]
+
+
+def _densified_vertices(geoms, step):
+    """
+    vertices of geoms (lon/lat), with lines and polygons rings densified so segments are shorter than step (degrees).
+
+    return a tuple (coords, geometry position, line number) of arrays, one item per vertex.
+    consecutive vertices with the same line number are a segment.
+    """
+    parts, parts_pos = shapely.get_parts(geoms, return_index=True)
+    polygons = shapely.get_type_id(parts) == shapely.GeometryType.POLYGON
+    rings, rings_part = shapely.get_rings(parts[polygons], return_index=True)
+    lines = np.concatenate([parts[~polygons], rings])
+    lines_pos = np.concatenate([parts_pos[~polygons], parts_pos[polygons][rings_part]])
+    coords, coords_line = shapely.get_coordinates(shapely.segmentize(lines, step), return_index=True)
+    return coords, lines_pos[coords_line], coords_line
+
+
+def _unit_vectors(coords):
+    """lon/lat coords to unit vectors on the sphere"""
+    lon, lat = np.radians(coords[:, 0]), np.radians(coords[:, 1])
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _angle(u, v):
+    """angles (radians) between unit vectors u and v"""
+    return np.arctan2(np.linalg.norm(np.cross(u, v), axis=1), np.einsum('ij,ij->i', u, v))
+
+
+def _segment_angle(p, a, b):
+    """angular distances (radians) from unit vectors p to great circle segments [a, b]"""
+    angle = np.minimum(_angle(p, a), _angle(p, b))
+    normal = np.cross(a, b)
+    norm = np.linalg.norm(normal, axis=1)
+    ok = norm > 1e-15
+    normal = normal[ok] / norm[ok, None]
+    p, a, b = p[ok], a[ok], b[ok]
+    sin_cross = np.einsum('ij,ij->i', p, normal)
+    # projection of p on the segment great circle
+    c = p - sin_cross[:, None] * normal
+    inside = (np.einsum('ij,ij->i', np.cross(a, c), normal) >= 0) & (np.einsum('ij,ij->i', np.cross(c, b), normal) >= 0)
+    cross_track = np.abs(np.arcsin(np.clip(sin_cross, -1, 1)))
+    angle[ok] = np.where(inside, np.minimum(angle[ok], cross_track), angle[ok])
+    return angle
+
+
+def _near_segments_angle(p, near, vectors, vertex_line):
+    """
+    angular distances (radians) from unit vectors p to vertices `near` of vectors,
+    and to the segments before and after them
+    """
+    angle = _angle(p, vectors[near])
+    for neighbour in [near - 1, near + 1]:
+        neighbour = np.clip(neighbour, 0, max(len(vectors) - 1, 0))
+        segment = vertex_line[neighbour] == vertex_line[near]
+        angle[segment] = np.minimum(angle[segment], _segment_angle(
+            p[segment], vectors[near[segment]], vectors[neighbour[segment]]))
+    return angle
+
+
+def colocalize_distance(gdf1, gdf2, max_distance, progress=False):
+    """colocalize gdf1 and gdf2 (lon/lat) with a distance tolerance: geometries closer than max_distance meters
+    on the sphere are colocated (no buffer is computed).
+
+    gdf1 and gdf2 lines and polygons boundaries are densified (segments shorter than step = max_distance /
+    `distance_densify`, or `distance_min_step`), and gdf1 vertices are indexed in a haversine BallTree
+    (needs scikit-learn). gdf2 vertices closer than max_distance + step are searched in the tree, and the
+    distance of each found vertices pair is refined to the great circle segments next to them, in both directions.
+    As the closest points of two segments include an end of one of them, this is the exact distance between
+    the densified boundaries, so step only changes the number of candidates (and how lon/lat segments are
+    approximated by great circle arcs). Intersecting geometries are at distance 0.
+
+    return:
+      idx1, idx2, distance. idx1 and idx2 are pandas Index (like others colocalize methods), and distance
+      a numpy array of distances in meters
+    """
+    try:
+        from sklearn.neighbors import BallTree
+    except ImportError:
+        raise ImportError("colocalize_distance needs scikit-learn")
+
+    step = max(max_distance / distance_densify, distance_min_step)
+    geoms1 = gdf1.geometry.values
+    geoms2 = gdf2.geometry.values
+
+    # intersecting geometries
+    inter1, inter2 = shapely.STRtree(geoms2).query(geoms1, predicate='intersects')
+
+    coords1, vertex_pos1, vertex_line1 = _densified_vertices(geoms1, np.degrees(step / earth_radius))
+    coords2, vertex_pos2, vertex_line2 = _densified_vertices(geoms2, np.degrees(step / earth_radius))
+    near1 = np.array([], dtype=int)
+    near2 = np.array([], dtype=int)
+    if len(coords1) and len(coords2):
+        tree = BallTree(np.radians(coords1[:, ::-1]), metric='haversine')
+        # the closest points of segments closer than max_distance are at most step / 2 from a vertex
+        found = tree.query_radius(np.radians(coords2[:, ::-1]), r=(max_distance + step) / earth_radius)
+        near2 = np.repeat(np.arange(len(coords2)), [len(vertices) for vertices in found])
+        near1 = np.concatenate(found).astype(int) if len(near2) else near1
+    time_ok = _time_overlaps(gdf1, gdf2, vertex_pos1[near1], vertex_pos2[near2])
+    near1, near2 = near1[time_ok], near2[time_ok]
+
+    # distance to segments before and after near vertices, from gdf2 vertices to gdf1 segments and reverse
+    vectors1 = _unit_vectors(coords1) if len(coords1) else np.empty((0, 3))
+    vectors2 = _unit_vectors(coords2) if len(coords2) else np.empty((0, 3))
+    angle = np.minimum(_near_segments_angle(vectors2[near2], near1, vectors1, vertex_line1),
+                       _near_segments_angle(vectors1[near1], near2, vectors2, vertex_line2))
+    distance = angle * earth_radius
+    close = distance <= max_distance
+
+    time_ok = _time_overlaps(gdf1, gdf2, inter1, inter2)
+    pos1 = np.concatenate([inter1[time_ok], vertex_pos1[near1[close]]])
+    pos2 = np.concatenate([inter2[time_ok], vertex_pos2[near2[close]]])
+    distance = np.concatenate([np.zeros(time_ok.sum()), distance[close]])
+
+    # min distance for each pair
+    pairs, inverse = np.unique(np.column_stack([pos1, pos2]), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    pair_distance = np.full(len(pairs), np.inf)
+    np.minimum.at(pair_distance, inverse, distance)
+    pairs = pairs.reshape(-1, 2)
+    return gdf1.index[pairs[:, 0]], gdf2.index[pairs[:, 1]], pair_distance
 
-def remove_overlaps(gdf):
-    """ remove overlaps """
+
+def colocalize_track(gdf1, gdf2, progress=False):
+    """colocalize gdf1 and gdf2, gdf2 being a dense time serie (ie a track of points).
+
+    gdf2 is sorted by time, and each gdf1 row is only compared with the gdf2 rows inside its own time window
+    (found with searchsorted), with one vectorized intersects.
+
+    return:
+      2 pandas Index idx1 and idx2, of the same size. idx1 are colocated index from gdf1 that colocalize with idx2 from gdf2
+      (note that index may not be unique if some are colocated more than once.
+    """
+    if not sys.stderr.isatty() and "tqdm.std" in  str(tqdm):
+        progress = False
+
+    order2 = np.argsort(_dates_ns(gdf2['startdate']), kind='stable')
+    start2 = _dates_ns(gdf2['startdate'])[order2]
+    stop2 = _dates_ns(gdf2['stopdate'])[order2]
+    # lower bound for searchsorted on stop dates, if they are not sorted
+    stop2_max = np.maximum.accumulate(stop2) if len(stop2) else stop2
+    geoms2 = gdf2.geometry.values[order2]
+    start1 = _dates_ns(gdf1['startdate'])
+    stop1 = _dates_ns(gdf1['stopdate'])
+    geoms1 = gdf1.geometry.values
+
+    # time windows : intervals overlaps (s1 < e2 and s2 < e1)
+    first = np.searchsorted(stop2_max, start1, side='right')
+    last = np.searchsorted(start2, stop1, side='left')
+
+    pos1 = []
+    pos2 = []
+    for i1 in tqdm(range(len(gdf1)), disable=not progress, leave=False):
+        if last[i1] <= first[i1]:
+            continue
+        window = np.arange(first[i1], last[i1])
+        window = window[stop2[window] > start1[i1]]
+        if len(window) == 0:
+            continue
+        ok = window[geoms2[window].intersects(geoms1[i1])]
+        pos1.append(np.full(len(ok), i1))
+        pos2.append(ok)
+
+    if pos1:
+        pos1 = np.concatenate(pos1)
+        pos2 = order2[np.concatenate(pos2)]
+    else:
+        pos1 = np.array([], dtype=int)
+        pos2 = np.array([], dtype=int)
+    return gdf1.index[pos1], gdf2.index[pos2]
+
+def _expand_ranges(lo, hi):
+    """for ranges [lo, hi), return a tuple (range number, value) of arrays, for all values in ranges"""
+    counts = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(lo)), counts)
+    values = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    return rows, values
+
+
+def _interval_join(start1, stop1, start2, stop2):
+    """
+    sweep line join of intervals (int64 nanoseconds arrays), with time overlaps like `pd.IntervalIndex.overlaps`
+    (start1 < stop2 and start2 < stop1). Overlapping intervals in the same array are handled.
+
+    return a tuple (pos1, pos2) of positions arrays of all overlapping pairs
+    """
+    nat = np.iinfo(np.int64).min
+    valid1 = np.flatnonzero((start1 != nat) & (stop1 != nat))
+    valid2 = np.flatnonzero((start2 != nat) & (stop2 != nat))
+    order1 = valid1[np.argsort(start1[valid1], kind='stable')]
+    order2 = valid2[np.argsort(start2[valid2], kind='stable')]
+    start1, stop1 = start1[order1], stop1[order1]
+    start2, stop2 = start2[order2], stop2[order2]
+
+    # intervals 2 starting inside intervals 1 (start1 <= start2 < stop1)
+    rows1, cols2 = _expand_ranges(np.searchsorted(start2, start1, side='left'),
+                                  np.searchsorted(start2, stop1, side='left'))
+    # empty intervals 2 at start1 don't overlap
+    ok = stop2[cols2] > start1[rows1]
+    rows1, cols2 = rows1[ok], cols2[ok]
+    # intervals 1 starting inside intervals 2 (start2 < start1 < stop2)
+    rows2, cols1 = _expand_ranges(np.searchsorted(start1, start2, side='right'),
+                                  np.searchsorted(start1, stop2, side='left'))
+
+    pos1 = order1[np.concatenate([rows1, cols1])]
+    pos2 = order2[np.concatenate([cols2, rows2])]
+    return pos1, pos2
+
+
+def colocalize_iter(gdf1, gdf2, progress=False):
+    """colocalize gdf1 and gdf2, with a sweep line join on time, then one vectorized intersects on candidates pairs.
+
+    This method is fast on very long gdf, overlapping or not.
+
+    return:
+      2 pandas Index idx1 and idx2, of the same size. idx1 are colocated index from gdf1 that colocalize with idx2 from gdf2
+      (note that index may not be unique if some are colocated more than once.
+    """
     t = time.time()
-    gdf['next_date_interval__'] = gdf['date_interval__'].shift(fill_value=pd.Interval(pd.Timestamp(0),pd.Timestamp(0)))
-    overlaps = gdf[['date_interval__','next_date_interval__']].apply(lambda x : x.date_interval__.overlaps(x.next_date_interval__),axis=1)
-    gdf.drop(columns=['next_date_interval__'],inplace=True)
-    if pd.IntervalIndex(gdf[~overlaps]['date_interval__']).is_overlapping:
-        raise RuntimeError('still overlapping. need to implement loop')
-    logger.debug('remove_overlaps done in %.1fs' % (time.time()-t))
-    return gdf[~overlaps] , gdf[overlaps]
-
-def _normalise_iter(gdf):
-    _gdf = gdf.copy() 
-    if 'date_interval__' not in _gdf: 
-        _gdf = _gdf[['startdate','stopdate',_gdf.geometry.name]]
-        _gdf.rename(columns={_gdf.geometry.name: "geometry"},inplace=True)
-        _gdf.set_geometry('geometry',inplace=True)
-        _gdf['date_interval__'] = pd.IntervalIndex.from_arrays(_gdf['startdate'],_gdf['stopdate'])
-        _gdf.drop(columns=['startdate','stopdate'],inplace=True)
-        # ensure sorted
-        if not _gdf['date_interval__'].is_monotonic_increasing:
-            _gdf.sort_values(['date_interval__'],inplace=True)
-    return _gdf
-
-
-def colocalize_iter(gdf1, gdf2, progress=False,_level=0):
+    pos1, pos2 = _interval_join(_dates_ns(gdf1['startdate']), _dates_ns(gdf1['stopdate']),
+                                _dates_ns(gdf2['startdate']), _dates_ns(gdf2['stopdate']))
+    logger.debug('%d time candidates pairs in %.1fs' % (len(pos1), time.time() - t))
+    ok = shapely.intersects(gdf1.geometry.values[pos1], gdf2.geometry.values[pos2])
+    pos1, pos2 = pos1[ok], pos2[ok]
+    order = np.lexsort((pos2, pos1))
+    return gdf1.index[pos1[order]], gdf2.index[pos2[order]]
+
+def _colocalize_wkb(pos1, start1, stop1, wkb1, pos2, start2, stop2, wkb2):
+    """
+    colocalize a time partition (see `colocalize_parallel`), given as positions, int64 dates and wkb arrays.
+    return a tuple (pos1, pos2) of colocated positions arrays
     """
-      2 pandas Index idx1 and idx2, of the same size. idx1 are colocated index from _gdf1 that colocalize with idx2 from _gdf2
+    join1, join2 = _interval_join(start1, stop1, start2, stop2)
+    ok = shapely.intersects(shapely.from_wkb(wkb1[join1]), shapely.from_wkb(wkb2[join2]))
+    return pos1[join1[ok]], pos2[join2[ok]]
+
+
+def colocalize_parallel(gdf1, gdf2, progress=False, n_workers=None, partitions_per_worker=4, executor=None,
+                        mp_context=None):
+    """colocalize gdf1 and gdf2 in a processes pool.
+
+    gdf1 is split into time partitions (of the same size). Each partition is colocalized with gdf2 rows in
+    the partition time range, with a margin of the longest gdf1 interval (see `colocalize_iter`).
+    Partitions are sent to processes as dates and wkb arrays. Each gdf1 row is in only one partition,
+    so there is no duplicate pairs.
+
+    n_workers: int or None
+        number of processes. Default to os.cpu_count()
+    executor: concurrent.futures.ProcessPoolExecutor or None
+        processes pool to use, so it can be shared by many calls (not shut down on return).
+        Default to a new pool of n_workers processes, started with mp_context
+    mp_context: multiprocessing context or None
+        Default to the `default_mp_start_method` context
+
+    return:
+      2 pandas Index idx1 and idx2, of the same size. idx1 are colocated index from gdf1 that colocalize with idx2 from gdf2
       (note that index may not be unique if some are colocated more than once.
-      
-      This method is fast on very long non overlapping gdf, but can be very slow if there is
-      some overlapping. A fallback to colocalize_loop is done in such cases. 
     """
     if not sys.stderr.isatty() and "tqdm.std" in  str(tqdm):
         progress = False
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    nparts = min(n_workers * partitions_per_worker, len(gdf1))
+    if n_workers <= 1 or nparts <= 1 or len(gdf2) == 0:
+        return colocalize_iter(gdf1, gdf2, progress=progress)
+
+    start1 = _dates_ns(gdf1['startdate'])
+    stop1 = _dates_ns(gdf1['stopdate'])
+    start2 = _dates_ns(gdf2['startdate'])
+    stop2 = _dates_ns(gdf2['stopdate'])
+    wkb1 = shapely.to_wkb(gdf1.geometry.values)
+    wkb2 = shapely.to_wkb(gdf2.geometry.values)
+
+    nat = np.iinfo(np.int64).min
+    valid1 = np.flatnonzero((start1 != nat) & (stop1 != nat))
+    order1 = valid1[np.argsort(start1[valid1], kind='stable')]
+    margin = (stop1[order1] - start1[order1]).max(initial=0)
+
     t = time.time()
-    
-    _gdf1 = _normalise_iter(gdf1)
-    _gdf2 = _normalise_iter(gdf2)
-    
-    _gdf1_is_overlapping = pd.IntervalIndex(_gdf1['date_interval__']).is_overlapping
-    _gdf2_is_overlapping = pd.IntervalIndex(_gdf2['date_interval__']).is_overlapping
-    logger.debug('gdf1 : %d , gdf2 : %d , level : %d. init in %.1fs' % (len(gdf1),len(gdf2),_level,time.time()-t))
-    
-    if _gdf1_is_overlapping and _gdf2_is_overlapping:
-        logger.debug('both gdf are overlapping. Falling back to colocalize_loop')
-        return colocalize_loop(gdf1, gdf2, progress=progress)
-    
-    # empty index to store colocalization results
-    idx1=_gdf1.index.delete(slice(None))
-    idx2=_gdf2.index.delete(slice(None))
-     
-    # check non overlaps
-    if _gdf1_is_overlapping:
-        _gdf1_no_overlaps, _gdf1_remain = remove_overlaps(_gdf1)
-        overlapping1_rate = len(_gdf1_remain) / (len(_gdf1)) * 100
-        if overlapping1_rate > 0:
-            if overlapping1_rate < 10:
-                logger.debug('gdf1 overlapping : %d%% of %d . using recursion %d with gdf2 len %d' % (overlapping1_rate,len(_gdf1),_level+1,len(_gdf2)))
-                # we invert order of coloc to make gdf2 be checked first for overlaps
-                idx2_rec,idx1_rec = colocalize_iter(_gdf2,_gdf1_remain,_level=_level+1)
-            else:
-                logger.debug('gdf1 overlapping : %d%% of %d . fallback to coloc_loop with gdf2 len %d' % (overlapping1_rate,len(_gdf1),len(_gdf2)))
-                idx1_rec,idx2_rec = colocalize_loop(_gdf1_remain, _gdf2, progress=False)
-            idx1 = idx1.append(idx1_rec)
-            idx2 = idx2.append(idx2_rec)
-            # continue with non overlapping
-            _gdf1 = _gdf1_no_overlaps
-
-    if _gdf2_is_overlapping:
-        _gdf2_no_overlaps, _gdf2_remain = remove_overlaps(_gdf2)
-        overlapping2_rate = len(_gdf2_remain) / (len(_gdf2)) * 100
-        
-        if overlapping2_rate > 0:
-            if overlapping2_rate < 10:
-                logger.debug('gdf2 overlapping : %d%% of %d . using recursion %d with gdf1 len %d' % (overlapping2_rate,len(_gdf2),_level+1,len(_gdf1)))
-                idx2_rec,idx1_rec = colocalize_iter(_gdf2_remain,_gdf1,_level=_level+1)
-            else:
-                logger.debug('gdf2 overlapping : %d%% of %d . fallback to coloc_loop with gdf1 len %d' % (overlapping2_rate,len(_gdf2),len(_gdf1)))
-                idx1_rec,idx2_rec = colocalize_loop(_gdf1, _gdf2_remain, progress=False)
-            idx1 = idx1.append(idx1_rec)
-            idx2 = idx2.append(idx2_rec)
-            # continue with no overlaps
-            _gdf2 = _gdf2_no_overlaps
-    # get the way to add index    
-    if isinstance(_gdf1.index,pd.MultiIndex):
-        indexer1 = pd.MultiIndex.from_tuples
-    else:
-        indexer1 = pd.Index
+    own_executor = executor is None
+    if own_executor:
+        if mp_context is None:
+            mp_context = multiprocessing.get_context(default_mp_start_method)
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context)
+    futures = []
+    try:
+        for part1 in np.array_split(order1, nparts):
+            if len(part1) == 0:
+                continue
+            part_start = start1[part1[0]]
+            part_stop = start1[part1[-1]] + margin
+            part2 = np.flatnonzero((start2 < part_stop) & (stop2 > part_start) & (start2 != nat))
+            if len(part2) == 0:
+                continue
+            futures.append(executor.submit(_colocalize_wkb, part1, start1[part1], stop1[part1], wkb1[part1],
+                                           part2, start2[part2], stop2[part2], wkb2[part2]))
+        results = [future.result() for future in tqdm(futures, disable=not progress, leave=False)]
+    finally:
+        # partitions not started yet are not computed if a partition failed
+        for future in futures:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
+    logger.debug('%d partitions colocalized in %.1fs with %d workers' % (len(futures), time.time() - t, n_workers))
 
-    if isinstance(_gdf2.index,pd.MultiIndex):
-        indexer2 = pd.MultiIndex.from_tuples
+    if results:
+        pos1 = np.concatenate([part_pos1 for part_pos1, _ in results])
+        pos2 = np.concatenate([part_pos2 for _, part_pos2 in results])
     else:
-        indexer2 = pd.Index
-    
-    it1 = _gdf1.itertuples()
-    it2 = _gdf2.itertuples()
-    row1 = next(it1)
-    row2 = next(it2)
-    
-    # compute total from progress bar from non overlaping interval
-    if not _gdf1_is_overlapping:
-        total = len(_gdf1)
-    elif not _gdf2_is_overlapping:
-        total = len(gdf2)
-    else:
-        progress = False
-    with tqdm(total=total,disable=not progress) as pbar:
-        while True:
-            try:
-                if row2.date_interval__.right < row1.date_interval__.left:
-                    # no overlap. r2 before r1. advance it2
-                    row2 = next(it2)
-                    if not _gdf2_is_overlapping:
-                        pbar.update(1)
-                elif row1.date_interval__.right < row2.date_interval__.left:
-                    # no overlap. r1 before r2. advance it1
-                    row1 = next(it1)
-                    if not _gdf1_is_overlapping:
-                        pbar.update(1)
-                else:
-                    if row1.geometry.contains(row2.geometry) |  row1.geometry.intersects(row2.geometry) | row1.geometry.within(row2.geometry):
-                        idx1 = idx1.append(indexer1([row1.Index]))
-                        idx2 = idx2.append(indexer2([row2.Index]))
-                    # determine whether to advance it1 or it2
-                    if row1.date_interval__.right < row2.date_interval__.right:
-                        # advance it1
-                        row1 = next(it1)
-                        if not _gdf1_is_overlapping:
-                            pbar.update(1)
-                    else:
-                        # advance it2
-                        row2 = next(it2)
-                        if not _gdf2_is_overlapping:
-                            pbar.update(1)
-            except StopIteration:
-                break
-            
-        pbar.update(total)
-    return idx1,idx2
+        pos1 = np.array([], dtype=int)
+        pos2 = np.array([], dtype=int)
+    order = np.lexsort((pos2, pos1))
+    return gdf1.index[pos1[order]], gdf2.index[pos2[order]]
+
 
 # default method
 colocalize = colocalize_loop
\ No newline at end of file
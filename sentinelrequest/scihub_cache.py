@@ -0,0 +1,480 @@
+import os
+import atexit
+import json
+import time
+import datetime
+import tempfile
+import threading
+import contextlib
+import sqlite3
+import logging
+from collections import OrderedDict
+import pandas as pd
+import geopandas as gpd
+import pyproj
+
+logger = logging.getLogger("scihub_cache")
+logger.addHandler(logging.NullHandler())
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    logger.info("pyarrow not found. Consider 'pip install pyarrow' for a faster cache.")
+    pa = None
+    pq = None
+
+# key in parquet schema metadata for sentinelrequest metadata
+metadata_key = b'sentinelrequest'
+
+
+def write_parquet(path, gdf, metadata=None):
+    """
+    write gdf as geoparquet to path, with optional `metadata` dict (json serializable).
+    The file is written atomically (ie a reader will never see a partial file).
+    """
+    geometry = gdf.geometry.name
+    df = pd.DataFrame(gdf)
+    df[geometry] = gdf.geometry.to_wkb().values
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    geo = {
+        'version': '1.0.0',
+        'primary_column': geometry,
+        'columns': {
+            geometry: {
+                'encoding': 'WKB',
+                'geometry_types': [],
+                'crs': gdf.crs.to_json_dict() if gdf.crs is not None else None
+            }
+        }
+    }
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[b'geo'] = json.dumps(geo).encode('utf-8')
+    schema_metadata[metadata_key] = json.dumps(metadata or {}).encode('utf-8')
+    table = table.replace_schema_metadata(schema_metadata)
+
+    dirname = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(suffix='.tmp', dir=dirname, delete=False) as handle:
+        tmpfile = handle.name
+    try:
+        pq.write_table(table, tmpfile)
+        os.replace(tmpfile, path)
+    except:
+        os.unlink(tmpfile)
+        raise
+
+
+def read_parquet(path):
+    """
+    read a geoparquet written by `write_parquet`.
+
+    return a tuple (gdf, metadata)
+    """
+    table = pq.read_table(path)
+    schema_metadata = table.schema.metadata or {}
+    geo = json.loads(schema_metadata[b'geo'])
+    metadata = json.loads(schema_metadata.get(metadata_key, b'{}'))
+    geometry = geo['primary_column']
+    crs = geo['columns'][geometry].get('crs')
+    if crs is not None:
+        crs = pyproj.CRS.from_json_dict(crs)
+    df = table.to_pandas()
+    df[geometry] = gpd.GeoSeries.from_wkb(df[geometry], index=df.index)
+    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs=crs)
+    return gdf, metadata
+
+
+class CacheIndex(object):
+    """
+    sqlite index of a cache directory.
+
+    Each entry is a cached page, identified by the md5 `key` of its request, with its query, start offset,
+    fetch time, last access time, size in bytes, max beginposition, hit count, and cache tiers files.
+    Lookups only use the index, so a cached page is never searched on the filesystem.
+
+    The index is created in `cachedir/index.sqlite`. If it doesn't exist, existing cache files are indexed.
+
+    Hits and access times are kept in memory, and written to the index by batches of `flush_accesses`
+    lookups (or by `flush`), so a lookup is a read only transaction.
+    Total entries and size are tracked by `over_limits`, so the cache is only pruned when needed.
+
+    Parameters
+    ----------
+    cachedir: str
+    timeout: float
+        sqlite lock timeout, in seconds
+    """
+
+    index_filename = 'index.sqlite'
+    tiers = ('xml', 'parquet')
+    flush_accesses = 256
+
+    def __init__(self, cachedir, timeout=60):
+        self.cachedir = cachedir
+        self.timeout = timeout
+        self.path = os.path.join(cachedir, self.index_filename)
+        self._lock = threading.Lock()
+        self._accesses = {}  # key -> (hits, last access time) not yet written
+        self._totals = None  # [entries, bytes], read from the index on first use
+        os.makedirs(cachedir, exist_ok=True)
+        is_new = not os.path.exists(self.path)
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                query TEXT,
+                start INTEGER,
+                fetch_time REAL,
+                last_access REAL,
+                size INTEGER,
+                max_beginposition TEXT,
+                hits INTEGER DEFAULT 0,
+                tiers TEXT)""")
+            con.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        if is_new:
+            self.reindex()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """sqlite connection, as a transaction"""
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def cachefile(self, key, tier):
+        """path of cache file for `key` in `tier`"""
+        return os.path.join(self.cachedir, tier, key[:2], '%s.%s' % (key[2:], tier))
+
+    def lookup(self, key):
+        """
+        return the list of cached tiers for key (possibly empty), and count a hit.
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT tiers FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return []
+        with self._lock:
+            hits, last_access = self._accesses.get(key, (0, None))
+            self._accesses[key] = (hits + 1, time.time())
+            flush = len(self._accesses) >= self.flush_accesses
+        if flush:
+            self.flush()
+        return [tier for tier in row[0].split(',') if tier]
+
+    def flush(self):
+        """write pending hits and access times to the index"""
+        with self._lock:
+            accesses, self._accesses = self._accesses, {}
+        if not accesses:
+            return
+        with self._connect() as con:
+            con.executemany("UPDATE entries SET hits=hits+?, last_access=MAX(last_access, ?) WHERE key=?",
+                            [(hits, last_access, key) for key, (hits, last_access) in accesses.items()])
+
+    def _update_totals(self, entries, size):
+        """update tracked totals (if already read) by entries and size"""
+        with self._lock:
+            if self._totals is not None:
+                self._totals[0] += entries
+                self._totals[1] += size
+
+    def over_limits(self, max_bytes=None, max_entries=None):
+        """
+        True if the cache is over `max_bytes` or `max_entries`.
+        Totals are read from the index on first call, and then tracked by `add`, `remove` and `prune`
+        (so entries added by other processes are only seen after a prune).
+        """
+        with self._lock:
+            totals = self._totals
+        if totals is None:
+            with self._connect() as con:
+                entries, size = con.execute("SELECT COUNT(*), SUM(size) FROM entries").fetchone()
+            totals = [entries, size or 0]
+            with self._lock:
+                self._totals = totals
+        return (max_entries is not None and totals[0] > max_entries) \
+            or (max_bytes is not None and totals[1] > max_bytes)
+
+    def add(self, key, tiers, query=None, start=None, max_beginposition=None):
+        """index cache files in `tiers` for key (files must exist)"""
+        size = 0
+        for tier in tiers:
+            try:
+                size += os.path.getsize(self.cachefile(key, tier))
+            except OSError:
+                pass
+        if max_beginposition is not None:
+            max_beginposition = str(max_beginposition)
+        now = time.time()
+        with self._connect() as con:
+            row = con.execute("SELECT fetch_time, hits, size FROM entries WHERE key=?", (key,)).fetchone()
+            fetch_time, hits, old_size = row if row is not None else (now, 0, None)
+            con.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, query, start, fetch_time, now, size, max_beginposition, hits, ','.join(tiers)))
+        self._update_totals(int(row is None), size - (old_size or 0))
+
+    def query_entries(self):
+        """return a list of (key, query) for query level entries (ie whole query answers, without start offset)"""
+        with self._connect() as con:
+            return con.execute("SELECT key, query FROM entries WHERE start IS NULL AND query IS NOT NULL").fetchall()
+
+    def remove(self, key):
+        """remove cache files and index entry for key"""
+        for tier in self.tiers:
+            cachefile = self.cachefile(key, tier)
+            try:
+                os.unlink(cachefile)
+            except OSError:
+                pass
+        with self._lock:
+            self._accesses.pop(key, None)
+        with self._connect() as con:
+            row = con.execute("SELECT size FROM entries WHERE key=?", (key,)).fetchone()
+            con.execute("DELETE FROM entries WHERE key=?", (key,))
+        if row is not None:
+            self._update_totals(-1, -(row[0] or 0))
+
+    def rename(self, key, new_key, query=None, start=None):
+        """
+        move cache files and index entry of key to new_key (ie a new key scheme), if new_key is not already cached.
+        query and start are set if given.
+
+        return the list of moved tiers (possibly empty)
+        """
+        with self._connect() as con:
+            row = con.execute("SELECT tiers, query, start FROM entries WHERE key=?", (key,)).fetchone()
+            if row is None or con.execute("SELECT 1 FROM entries WHERE key=?", (new_key,)).fetchone() is not None:
+                return []
+            tiers = [tier for tier in row[0].split(',') if tier]
+            moved = []
+            for tier in tiers:
+                try:
+                    os.makedirs(os.path.dirname(self.cachefile(new_key, tier)), exist_ok=True)
+                    os.replace(self.cachefile(key, tier), self.cachefile(new_key, tier))
+                    moved.append(tier)
+                except OSError as e:
+                    logger.warning('unable to move cache file %s : %s' % (self.cachefile(key, tier), str(e)))
+            con.execute("UPDATE entries SET key=?, query=?, start=?, tiers=? WHERE key=?",
+                        (new_key, query if query is not None else row[1], start if start is not None else row[2],
+                         ','.join(moved), key))
+        with self._lock:
+            if key in self._accesses:
+                self._accesses[new_key] = self._accesses.pop(key)
+        logger.debug('cache entry %s moved to %s' % (key, new_key))
+        return moved
+
+    def reindex(self):
+        """
+        scan cachedir and index cache files not yet in the index.
+        Legacy cache files (ie `cachedir/<md5>.xml`) are moved to the xml tier.
+
+        return the number of new entries
+        """
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.cachedir):
+            for filename in filenames:
+                name, ext = os.path.splitext(filename)
+                tier = ext[1:]
+                if tier not in self.tiers:
+                    continue
+                if dirpath == self.cachedir and tier == 'xml' and len(name) == 32:
+                    # legacy stuff that might be removed in few months (now 202012)
+                    logger.debug('migrating old legacy cache file %s' % filename)
+                    key = name
+                    os.makedirs(os.path.dirname(self.cachefile(key, tier)), exist_ok=True)
+                    os.rename(os.path.join(dirpath, filename), self.cachefile(key, tier))
+                elif os.path.dirname(dirpath) == os.path.join(self.cachedir, tier) and len(name) == 30:
+                    key = os.path.basename(dirpath) + name
+                else:
+                    continue
+                found.setdefault(key, []).append(tier)
+        with self._connect() as con:
+            indexed = set(row[0] for row in con.execute("SELECT key FROM entries"))
+        new = 0
+        for key, tiers in found.items():
+            if key not in indexed:
+                self.add(key, sorted(tiers, key=self.tiers.index))
+                new += 1
+        logger.debug('%d cache files indexed' % new)
+        return new
+
+    def stats(self):
+        """
+        return a dict with 'entries', 'bytes', 'hits', 'oldest_fetch' and 'last_access' (as datetimes)
+        """
+        self.flush()
+        with self._connect() as con:
+            entries, size, hits, oldest, last = con.execute(
+                "SELECT COUNT(*), SUM(size), SUM(hits), MIN(fetch_time), MAX(last_access) FROM entries").fetchone()
+        to_date = lambda t: datetime.datetime.fromtimestamp(t) if t is not None else None
+        return {
+            'entries': entries,
+            'bytes': size or 0,
+            'hits': hits or 0,
+            'oldest_fetch': to_date(oldest),
+            'last_access': to_date(last)
+        }
+
+    def prune(self, max_bytes=None, max_entries=None, max_age=None):
+        """
+        evict least recently used entries until cache is under `max_bytes` and `max_entries`,
+        and entries fetched more than `max_age` (datetime.timedelta) ago.
+
+        return the number of evicted entries
+        """
+        evict = []
+        self.flush()
+        with self._connect() as con:
+            rows = con.execute("SELECT key, size, fetch_time FROM entries ORDER BY last_access DESC").fetchall()
+        with self._lock:
+            self._totals = [len(rows), sum(size or 0 for key, size, fetch_time in rows)]
+        total_bytes = 0
+        oldest_fetch = time.time() - max_age.total_seconds() if max_age is not None else None
+        for ientry, (key, size, fetch_time) in enumerate(rows):
+            total_bytes += size or 0
+            if (max_entries is not None and ientry >= max_entries) \
+                    or (max_bytes is not None and total_bytes > max_bytes) \
+                    or (oldest_fetch is not None and fetch_time < oldest_fetch):
+                evict.append(key)
+                total_bytes -= size or 0
+        for key in evict:
+            self.remove(key)
+        if evict:
+            logger.info('%d cache entries evicted from %s' % (len(evict), self.cachedir))
+        return len(evict)
+
+
+
+class MemoryCache(object):
+    """
+    in memory LRU cache of query answers (geodataframes), thread safe.
+    Entries are copied on put and get, so cached geodataframes can't be modified by callers.
+
+    Parameters
+    ----------
+    max_entries: int
+        max number of cached answers. 0 disable the cache.
+    max_rows: int
+        max total number of rows of cached answers (ie bounded memory). Bigger answers are not cached.
+    """
+
+    def __init__(self, max_entries=256, max_rows=500000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self._entries = OrderedDict()  # key -> (gdf, expire time, meta)
+        self._rows = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def _pop(self, key):
+        gdf, expire, meta = self._entries.pop(key)
+        self._rows -= len(gdf)
+
+    def _expired(self, key):
+        """remove key if expired, and return True"""
+        expire = self._entries[key][1]
+        if expire is not None and time.time() > expire:
+            self._pop(key)
+            self.expired += 1
+            return True
+        return False
+
+    def get(self, key):
+        """return a copy of cached gdf for key, or None if not cached or expired"""
+        with self._lock:
+            if key not in self._entries or self._expired(key):
+                self.misses += 1
+                return None
+            item = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            gdf = item[0]
+        return gdf.copy()
+
+    def find(self, match):
+        """
+        return a copy of the most recently used gdf whose entry `meta` satisfies `match(meta)`, or None.
+        A found entry is counted as a hit, but not found entries are not counted as misses.
+        """
+        with self._lock:
+            for key in reversed(list(self._entries.keys())):
+                if self._expired(key):
+                    continue
+                meta = self._entries[key][2]
+                if meta is not None and match(meta):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    gdf = self._entries[key][0]
+                    break
+            else:
+                return None
+        return gdf.copy()
+
+    def put(self, key, gdf, ttl=None, meta=None):
+        """
+        cache a copy of gdf for key. ttl is the entry lifetime in seconds (None for no expiration).
+        meta is an optional object used by `find`.
+        """
+        if self.max_entries <= 0 or len(gdf) > self.max_rows:
+            return
+        gdf = gdf.copy()
+        expire = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (gdf, expire, meta)
+            self._rows += len(gdf)
+            while len(self._entries) > self.max_entries or self._rows > self.max_rows:
+                self._pop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+    def stats(self):
+        """return a dict with 'entries', 'rows', 'hits', 'misses', 'evictions' and 'expired' counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'rows': self._rows,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expired': self.expired
+            }
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(cachedir):
+    """return the CacheIndex for cachedir (created on first call)"""
+    cachedir = os.path.abspath(cachedir)
+    with _indexes_lock:
+        if cachedir not in _indexes:
+            _indexes[cachedir] = CacheIndex(cachedir)
+            # pending hits and access times are written at exit
+            atexit.register(_indexes[cachedir].flush)
+        return _indexes[cachedir]
+
+
+def cache_stats(cachedir):
+    """return cache statistics for cachedir (see `CacheIndex.stats`)"""
+    return get_index(cachedir).stats()
+
+
+def cache_prune(cachedir, max_bytes=None, max_entries=None, max_age=None):
+    """
+    evict least recently used entries from cachedir cache (see `CacheIndex.prune`).
+
+    return the number of evicted entries
+    """
+    return get_index(cachedir).prune(max_bytes=max_bytes, max_entries=max_entries, max_age=max_age)
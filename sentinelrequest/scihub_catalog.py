@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.wkb as wkb
+from .scihub_query import ScihubQuery
+
+logger = logging.getLogger("scihub_catalog")
+logger.addHandler(logging.NullHandler())
+
+dateformat = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def _to_ns(dates):
+    """utc dates (Timestamp or Series) to int64 nanoseconds"""
+    if isinstance(dates, pd.Series):
+        return dates.values.astype('datetime64[ns]').view('int64')
+    return pd.Timestamp(dates).value
+
+
+def _from_ns(value):
+    return pd.Timestamp(value, tz='UTC')
+
+
+class ProductCatalog(object):
+    """
+    persistent sqlite catalog of scihub products.
+
+    Each product is stored once (by uuid), with its scihub fields as str (the way they are found in scihub
+    answers), its footprint as wkb, a spatial index (rtree on footprint bounds) and a time index (on beginposition).
+
+    The catalog also records its coverage: time ranges of (filename, footprint) queries that were fully answered
+    by scihub. A query inside the coverage can be answered from the catalog, without http request (see `gaps`).
+
+    The catalog is created in `cachedir/catalog.sqlite`.
+
+    Parameters
+    ----------
+    cachedir: str
+    timeout: float
+        sqlite lock timeout, in seconds
+    """
+
+    catalog_filename = 'catalog.sqlite'
+
+    def __init__(self, cachedir, timeout=60):
+        self.timeout = timeout
+        self.path = os.path.join(cachedir, self.catalog_filename)
+        os.makedirs(cachedir, exist_ok=True)
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS products (
+                id INTEGER PRIMARY KEY,
+                uuid TEXT UNIQUE,
+                filename TEXT,
+                beginposition INTEGER,
+                endposition INTEGER,
+                minlon REAL, maxlon REAL, minlat REAL, maxlat REAL,
+                footprint BLOB,
+                record TEXT)""")
+            con.execute("CREATE INDEX IF NOT EXISTS products_beginposition ON products (beginposition)")
+            con.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS products_rtree USING rtree (
+                id, minlon, maxlon, minlat, maxlat)""")
+            con.execute("""CREATE TABLE IF NOT EXISTS coverage (
+                filename TEXT,
+                footprint BLOB,
+                range_begin INTEGER,
+                range_end INTEGER,
+                fetch_time REAL)""")
+            con.execute("CREATE INDEX IF NOT EXISTS coverage_range_begin ON coverage (range_begin)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """sqlite connection, as a transaction"""
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def upsert(self, safes):
+        """
+        insert or update products from safes (a scihubQuery_raw answer).
+
+        return the number of products upserted
+        """
+        safes = safes[safes['uuid'].notna() & safes['beginposition'].notna()]
+        if safes.empty:
+            return 0
+        records = pd.DataFrame(index=safes.index)
+        for field in safes.columns.drop(safes.geometry.name):
+            values = safes[field]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                values = values.dt.strftime(dateformat)
+            records[field] = values.astype(object).where(values.notna(), None)
+        records = [json.dumps({field: None if value is None else str(value) for field, value in record.items()})
+                   for record in records.to_dict('records')]
+        footprints = safes.geometry.values
+        bounds = shapely.bounds(footprints)
+        # products without footprint are everywhere
+        bounds[np.isnan(bounds).any(axis=1)] = [-180, -90, 180, 90]
+        rows = zip(safes['uuid'], safes['filename'], _to_ns(safes['beginposition']), _to_ns(safes['endposition']),
+                   bounds[:, 0], bounds[:, 2], bounds[:, 1], bounds[:, 3],
+                   [None if footprint is None else wkb.dumps(footprint) for footprint in footprints], records)
+        with self._connect() as con:
+            con.executemany("""INSERT INTO products
+                (uuid, filename, beginposition, endposition, minlon, maxlon, minlat, maxlat, footprint, record)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(uuid) DO UPDATE SET
+                filename=excluded.filename, beginposition=excluded.beginposition, endposition=excluded.endposition,
+                minlon=excluded.minlon, maxlon=excluded.maxlon, minlat=excluded.minlat, maxlat=excluded.maxlat,
+                footprint=excluded.footprint, record=excluded.record""",
+                            [(uuid, filename, int(begin), int(end), float(minlon), float(maxlon), float(minlat),
+                              float(maxlat), footprint, record)
+                             for uuid, filename, begin, end, minlon, maxlon, minlat, maxlat, footprint, record in rows])
+            con.executemany("""INSERT OR REPLACE INTO products_rtree
+                SELECT id, minlon, maxlon, minlat, maxlat FROM products WHERE uuid=?""",
+                            [(uuid,) for uuid in safes['uuid']])
+        return len(safes)
+
+    def search(self, begin, end, footprint=None):
+        """
+        return a list of (record, footprint) of products with beginposition in [begin, end],
+        and footprint bounds intersecting footprint bounds (if not None).
+        record is a dict of str fields (without footprint), and footprint is wkb (or None).
+        Records must be filtered by the caller for exact footprint intersection.
+        """
+        sql = "SELECT record, footprint FROM products WHERE beginposition BETWEEN ? AND ?"
+        args = [_to_ns(begin), _to_ns(end)]
+        if footprint is not None and not footprint.is_empty:
+            # one box per part, so antimeridian parts don't select the whole earth
+            parts = shapely.get_parts(footprint)
+            boxes = []
+            for minlon, minlat, maxlon, maxlat in shapely.bounds(parts):
+                boxes.append("(maxlon >= ? AND minlon <= ? AND maxlat >= ? AND minlat <= ?)")
+                args.extend([minlon, maxlon, minlat, maxlat])
+            sql += " AND id IN (SELECT id FROM products_rtree WHERE %s)" % ' OR '.join(boxes)
+        with self._connect() as con:
+            return [(json.loads(record), footprint) for record, footprint in con.execute(sql, args)]
+
+    def add_coverage(self, query, begin=None, end=None):
+        """
+        record that scihub_query.ScihubQuery `query` was fully answered by scihub (and its products upserted),
+        for range [begin, end] (default to query range). Overlapping ranges of the same query are merged.
+        """
+        begin = query.begin if begin is None else begin
+        end = query.end if end is None else end
+        begin, end = _to_ns(begin), _to_ns(end)
+        if end < begin:
+            return
+        footprint = None if query.footprint is None else wkb.dumps(shapely.normalize(query.footprint))
+        with self._connect() as con:
+            rows = con.execute("""SELECT rowid, range_begin, range_end FROM coverage
+                WHERE filename IS ? AND footprint IS ? AND range_begin <= ? AND range_end >= ?""",
+                               (query.filename, footprint, end, begin)).fetchall()
+            for rowid, row_begin, row_end in rows:
+                begin, end = min(begin, row_begin), max(end, row_end)
+            con.executemany("DELETE FROM coverage WHERE rowid=?", [(rowid,) for rowid, _, _ in rows])
+            con.execute("INSERT INTO coverage VALUES (?, ?, ?, ?, ?)", (query.filename, footprint, begin, end,
+                                                                       time.time()))
+
+    def gaps(self, query):
+        """
+        return the list of (begin, end) time ranges of scihub_query.ScihubQuery `query`
+        that are not covered by the catalog (see `add_coverage`).
+        """
+        begin, end = _to_ns(query.begin), _to_ns(query.end)
+        with self._connect() as con:
+            rows = con.execute("""SELECT filename, footprint, range_begin, range_end FROM coverage
+                WHERE range_begin <= ? AND range_end >= ?""", (end, begin)).fetchall()
+        covered = []
+        for filename, footprint, row_begin, row_end in rows:
+            row_query = ScihubQuery(filename=filename, footprint=None if footprint is None else wkb.loads(footprint))
+            if row_query.covers(ScihubQuery(filename=query.filename, footprint=query.footprint)):
+                covered.append((row_begin, row_end))
+        gaps = []
+        for row_begin, row_end in sorted(covered):
+            if row_begin > begin:
+                gaps.append((begin, row_begin))
+            begin = max(begin, row_end)
+        if begin < end:
+            gaps.append((begin, end))
+        return [(_from_ns(gap_begin), _from_ns(gap_end)) for gap_begin, gap_end in gaps]
+
+    def stats(self):
+        """return a dict with 'products' count, 'coverage' ranges count, and 'bytes' (catalog file size)"""
+        with self._connect() as con:
+            products = con.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+            coverage = con.execute("SELECT COUNT(*) FROM coverage").fetchone()[0]
+        return {'products': products, 'coverage': coverage, 'bytes': os.path.getsize(self.path)}
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(cachedir):
+    """return the ProductCatalog for cachedir (created on first call)"""
+    cachedir = os.path.abspath(cachedir)
+    with _catalogs_lock:
+        if cachedir not in _catalogs:
+            _catalogs[cachedir] = ProductCatalog(cachedir)
+        return _catalogs[cachedir]
@@ -0,0 +1,91 @@
+import logging
+import pandas as pd
+
+logger = logging.getLogger("scihub_pairs")
+logger.addHandler(logging.NullHandler())
+
+
+class ColocPairs(object):
+    """
+    compact colocation result (see `scihubQuery` with output='pairs').
+
+    Each colocated product is stored once, and colocations are stored as (gdf index, product uuid) pairs,
+    instead of one full product row per colocation.
+
+    Parameters
+    ----------
+    pairs: pandas.DataFrame
+        one row per colocation, indexed like the user gdf, with a 'uuid' column (product id),
+        and optional other colocation columns (ie 'coloc_distance').
+    products: geopandas.GeoDataFrame
+        colocated products, once each (unique 'uuid')
+    """
+
+    def __init__(self, pairs, products):
+        self.pairs = pairs
+        self.products = products
+
+    @classmethod
+    def from_index(cls, safes, idx_safes, idx_gdf, **pair_columns):
+        """
+        ColocPairs from colocated index: safes.loc[idx_safes] colocate with gdf.loc[idx_gdf]
+        (see `geopandas_coloc` engines). pair_columns are arrays of the same size (ie coloc_distance).
+        """
+        pairs = pd.DataFrame(dict(uuid=safes['uuid'].loc[idx_safes].values, **pair_columns), index=idx_gdf)
+        products = safes.loc[idx_safes.unique()].reset_index(drop=True)
+        return cls(pairs, products)
+
+    @classmethod
+    def from_safes(cls, safes):
+        """ColocPairs from a joined geodataframe, as returned by `scihubQuery` (ie with output='safes')"""
+        pair_columns = ['uuid'] + [col for col in ['coloc_distance'] if col in safes]
+        pairs = pd.DataFrame({col: safes[col].values for col in pair_columns}, index=safes.index)
+        products = safes.drop(columns=pair_columns[1:]).drop_duplicates('uuid').reset_index(drop=True)
+        return cls(pairs, products)
+
+    @classmethod
+    def concat(cls, coloc_pairs_list):
+        """concat ColocPairs (ie from different slices). A product found in many slices is kept once."""
+        pairs = pd.concat([coloc_pairs.pairs for coloc_pairs in coloc_pairs_list], sort=False)
+        products = pd.concat([coloc_pairs.products for coloc_pairs in coloc_pairs_list], sort=False)
+        return cls(pairs, products.drop_duplicates('uuid').reset_index(drop=True))
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __repr__(self):
+        return '<ColocPairs: %d pairs, %d products>' % (len(self.pairs), len(self.products))
+
+    def select(self, products):
+        """return a ColocPairs with products (a subset of self.products), and their pairs"""
+        return ColocPairs(self.pairs[self.pairs['uuid'].isin(products['uuid']).values], products)
+
+    def first_pairs(self):
+        """products, indexed by their first colocated gdf index"""
+        first = self.pairs.drop_duplicates('uuid')
+        products = self.products.set_index(self.products['uuid'].values)
+        products = products.loc[first['uuid'].values]
+        products.index = first.index
+        return products
+
+    def extend(self, safes):
+        """
+        return a ColocPairs with products from safes, a joined geodataframe indexed like pairs (ie from
+        `first_pairs`, extended by `get_datatakes`). Products not already in self are added with their safes index.
+        """
+        new_safes = safes[~safes['uuid'].isin(self.products['uuid']).values]
+        pairs = pd.concat([self.pairs, pd.DataFrame({'uuid': new_safes['uuid'].values}, index=new_safes.index)],
+                          sort=False)
+        return ColocPairs(pairs, safes.drop_duplicates('uuid').reset_index(drop=True))
+
+    def join(self):
+        """
+        return the full joined geodataframe (one product row per colocation, indexed like gdf),
+        as returned by `scihubQuery` with output='safes'
+        """
+        products = self.products.set_index(self.products['uuid'].values)
+        safes = products.loc[self.pairs['uuid'].values]
+        safes.index = self.pairs.index
+        for col in self.pairs.columns.drop('uuid'):
+            safes[col] = self.pairs[col].values
+        return safes.sort_values('beginposition')
@@ -0,0 +1,173 @@
+import re
+import fnmatch
+import logging
+import pandas as pd
+import shapely
+import shapely.wkt as wkt
+import shapely.ops as ops
+
+logger = logging.getLogger("scihub_query")
+logger.addHandler(logging.NullHandler())
+
+dateformat = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+_begin_re = re.compile(r'^beginposition:\[\s*(\S+)\s+TO\s+(\S+)\s*\]$', re.IGNORECASE)
+_filename_re = re.compile(r'^filename:(\S+)$', re.IGNORECASE)
+_footprint_re = re.compile(r'^footprint:"Intersects\((.*)\)"$', re.IGNORECASE)
+
+
+def _split(str_query, operator):
+    """split str_query on `operator` (ie ' AND '), outside parenthesis and quotes"""
+    parts = []
+    depth = 0
+    quoted = False
+    current = 0
+    i = 0
+    while i < len(str_query):
+        c = str_query[i]
+        if c == '"':
+            quoted = not quoted
+        elif not quoted and c == '(':
+            depth += 1
+        elif not quoted and c == ')':
+            depth -= 1
+        elif not quoted and depth == 0 and str_query.startswith(operator, i):
+            parts.append(str_query[current:i])
+            i += len(operator)
+            current = i
+            continue
+        i += 1
+    parts.append(str_query[current:])
+    return [part.strip() for part in parts]
+
+
+def _unparen(clause):
+    """remove enclosing parenthesis, if they enclose the whole clause"""
+    while clause.startswith('(') and clause.endswith(')'):
+        depth = 0
+        for i, c in enumerate(clause):
+            depth += {'(': 1, ')': -1}.get(c, 0)
+            if depth == 0 and i < len(clause) - 1:
+                return clause
+        clause = clause[1:-1].strip()
+    return clause
+
+
+def _parse_date(value):
+    """parse a scihub date. return None for relative dates (ie 'NOW')"""
+    if 'NOW' in value.upper():
+        return None
+    return pd.to_datetime(value, utc=True)
+
+
+class ScihubQuery(object):
+    """
+    canonical form of a scihub query string, ie 'beginPosition:[...] AND filename:... AND (footprint:...)'.
+
+    The query is split in top level AND clauses. beginPosition range, filename pattern and footprint
+    are parsed, other clauses are kept as normalized strings.
+    Queries with top level OR, or relative dates, are only kept as clauses.
+
+    Parameters
+    ----------
+    begin, end: pandas.Timestamp or None
+        beginPosition range
+    filename: str or None
+        filename pattern
+    footprint: shapely geometry or None
+        union of 'Intersects' footprints
+    clauses: frozenset of str
+        other clauses
+    """
+
+    def __init__(self, begin=None, end=None, filename=None, footprint=None, clauses=frozenset()):
+        self.begin = begin
+        self.end = end
+        self.filename = filename
+        self.footprint = footprint
+        self.clauses = frozenset(clauses)
+
+    @classmethod
+    def parse(cls, str_query):
+        """return a ScihubQuery from str_query"""
+        str_query = ' '.join(str_query.split())
+        query = cls()
+        clauses = set()
+        if len(_split(str_query, ' OR ')) > 1:
+            clauses.add(str_query)
+            query.clauses = frozenset(clauses)
+            return query
+        todo = _split(str_query, ' AND ')
+        while todo:
+            clause = _unparen(todo.pop(0))
+            nested = _split(clause, ' AND ')
+            if len(nested) > 1 and len(_split(clause, ' OR ')) == 1:
+                # '(a AND b)' is 'a AND b'
+                todo.extend(nested)
+                continue
+            begin_match = _begin_re.match(clause)
+            filename_match = _filename_re.match(clause)
+            if begin_match and query.begin is None and query.end is None:
+                begin, end = [_parse_date(value) for value in begin_match.groups()]
+                if begin is not None and end is not None:
+                    query.begin, query.end = begin, end
+                    continue
+            elif filename_match and query.filename is None:
+                query.filename = filename_match.group(1)
+                continue
+            elif query.footprint is None:
+                footprints = [_footprint_re.match(_unparen(part)) for part in _split(clause, ' OR ')]
+                if all(footprints):
+                    try:
+                        query.footprint = ops.unary_union([wkt.loads(footprint.group(1)) for footprint in footprints])
+                        continue
+                    except Exception as e:
+                        logger.debug('unable to parse footprint %s : %s' % (clause, str(e)))
+            clauses.add(clause)
+        query.clauses = frozenset(clauses)
+        return query
+
+    def key(self):
+        """canonical string for the query. Same queries (ie with clauses in another order) have the same key"""
+        key = []
+        if self.begin is not None:
+            key.append('beginPosition:[%s TO %s]' % (self.begin.strftime(dateformat), self.end.strftime(dateformat)))
+        if self.filename is not None:
+            key.append('filename:%s' % self.filename)
+        if self.footprint is not None:
+            key.append('footprint:"Intersects(%s)"' % wkt.dumps(shapely.normalize(self.footprint), trim=True,
+                                                                 rounding_precision=6))
+        key.extend('(%s)' % clause for clause in sorted(self.clauses))
+        return ' AND '.join(key)
+
+    def _filename_covers(self, other):
+        if self.filename is None or self.filename == other.filename:
+            return True
+        if other.filename is None:
+            return False
+        # 'S1*' covers 'S1A_IW*'
+        prefix = self.filename[:-1]
+        return self.filename.endswith('*') and not re.search(r'[*?\[]', prefix) and other.filename.startswith(prefix)
+
+    def covers(self, other):
+        """True if answer to `other` query is a subset of answer to this query (ie can be filtered by `filter`)"""
+        if self.clauses != other.clauses:
+            return False
+        if self.begin is not None and (other.begin is None or other.begin < self.begin or other.end > self.end):
+            return False
+        if not self._filename_covers(other):
+            return False
+        if self.footprint is not None and (other.footprint is None or not self.footprint.covers(other.footprint)):
+            return False
+        return True
+
+    def filter(self, safes):
+        """return safes (answer of a query that covers this one) that match this query"""
+        mask = pd.Series(True, index=safes.index)
+        if self.begin is not None:
+            mask &= (safes['beginposition'] >= self.begin) & (safes['beginposition'] <= self.end)
+        if self.filename is not None:
+            mask &= safes['filename'].str.match(fnmatch.translate(self.filename), flags=re.IGNORECASE)
+        if self.footprint is not None:
+            mask &= safes.geometry.intersects(self.footprint)
+        return safes[mask].reset_index(drop=True)
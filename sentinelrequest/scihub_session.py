@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("scihub_session")
+logger.addHandler(logging.NullHandler())
+
+
+class ScihubSession(object):
+    """
+    pooled http session shared by all scihub calls.
+
+    Connections are kept alive and limited per host. Each request has connect/read timeouts,
+    and is retried with exponential backoff and full jitter on connection errors, on `retry_status`
+    http status, or if the answer contains `retry_on` (ie scihub 'Timeout occured' message).
+
+    Parameters
+    ----------
+    pool_connections: int
+        number of hosts pools to keep
+    pool_maxsize: int
+        max connections per host. Requests will wait for a free connection (pool is blocking).
+    connect_timeout: float
+        connect timeout in seconds
+    read_timeout: float
+        read timeout in seconds (ie max time between bytes)
+    max_retries: int
+        max retries for one request
+    backoff_factor: float
+        sleep before retry `n` is a random value in [0, backoff_factor * 2 ** n]
+    backoff_max: float
+        max sleep before retry
+    retry_status: tuple of int
+        http status that will be retried
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, connect_timeout=10, read_timeout=300, max_retries=5,
+                 backoff_factor=1, backoff_max=120, retry_status=(429, 500, 502, 503, 504)):
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.retry_status = retry_status
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._lock = threading.Lock()
+        self._retries = 0
+        # counters of host pools discarded by the pool manager (ie more hosts than pool_connections)
+        self._discarded_requests = 0
+        self._discarded_connections = 0
+        pools = self.adapter.poolmanager.pools
+        dispose = pools.dispose_func
+
+        def dispose_pool(pool):
+            with self._lock:
+                self._discarded_requests += pool.num_requests
+                self._discarded_connections += pool.num_connections
+            if dispose is not None:
+                dispose(pool)
+
+        pools.dispose_func = dispose_pool
+
+    def backoff(self, retry):
+        """sleep time before retry number `retry` (exponential, full jitter)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * 2 ** retry))
+
+    def get(self, url, retry_on=None, **kwargs):
+        """
+        like `requests.get`, with pooled connection, timeouts and retries.
+
+        Parameters
+        ----------
+        url: str
+        retry_on: bytes or None
+            if not None, and the answer content contains `retry_on`, the request is retried.
+            Not used if `stream` is True.
+        kwargs:
+            passed to `requests.Session.get`
+
+        Returns
+        -------
+        requests.Response
+            last answer. If retries were exhausted, it may be an error answer.
+            With `stream`, the caller must close it (ie `with session.get(url, stream=True) as response:`),
+            so the connection goes back to the (blocking) pool.
+        """
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        retry = 0
+        while True:
+            try:
+                response = self.session.get(url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if retry >= self.max_retries:
+                    raise
+                reason = str(e)
+            else:
+                if response.status_code in self.retry_status:
+                    reason = 'http status %d' % response.status_code
+                elif retry_on is not None and not kwargs.get('stream', False) and retry_on in response.content:
+                    reason = retry_on.decode('utf-8', 'replace')
+                else:
+                    return response
+                if retry >= self.max_retries:
+                    logger.warning('giving up after %d retries on %s' % (retry, url))
+                    return response
+                # release the connection to the pool (needed for streamed answers)
+                response.close()
+
+            sleep = self.backoff(retry)
+            retry += 1
+            with self._lock:
+                self._retries += 1
+            logger.warning('retry %d/%d in %.1fs for %s : %s' % (retry, self.max_retries, sleep, url, reason))
+            time.sleep(sleep)
+
+    def stats(self):
+        """
+        return a dict with session counters:
+        'requests', 'new_connections', 'reused_connections', 'retries'.
+        Counters are cumulative: they include host pools discarded by the pool manager.
+        """
+        with self._lock:
+            requests_count = self._discarded_requests
+            new_connections = self._discarded_connections
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            try:
+                pool = pools[key]
+            except KeyError:
+                # pool was discarded meanwhile
+                continue
+            requests_count += pool.num_requests
+            new_connections += pool.num_connections
+        return {
+            'requests': requests_count,
+            'new_connections': new_connections,
+            'reused_connections': requests_count - new_connections,
+            'retries': self._retries
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """return the shared ScihubSession (created with default values on first call)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = ScihubSession()
+        return _session
+
+
+def configure_session(**kwargs):
+    """
+    replace the shared ScihubSession by a new one, configured with kwargs (see `ScihubSession`).
+
+    return the new session
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = ScihubSession(**kwargs)
+        return _session
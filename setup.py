@@ -10,6 +10,6 @@ setup(name='sentinelrequest',
       use_scm_version=True,
       setup_requires=['setuptools_scm'],
       zip_safe=False,
-      scripts=['bin/sentinelrequest', 'bin/sentinel1_path'],
+      scripts=['bin/sentinelrequest', 'bin/sentinel1_path', 'bin/sentinelrequest_cache'],
       install_requires=['packaging', 'future','geopandas', 'requests',  'lxml',  'fiona' , 'html2text',  'tqdm' ]
 )
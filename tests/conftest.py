@@ -0,0 +1,19 @@
+import pytest
+
+import sentinelrequest
+from fake_hub import FakeHub, make_products
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    """a `FakeHub` with 537 products (6 pages), replacing the http session get. In memory answers are cleared."""
+    fake_hub = FakeHub(make_products(537))
+    monkeypatch.setattr(sentinelrequest.get_session().session, 'get', fake_hub.get)
+    sentinelrequest.query_memo.clear()
+    yield fake_hub
+    sentinelrequest.query_memo.clear()
+
+
+@pytest.fixture
+def cachedir(tmp_path):
+    return str(tmp_path / 'cache')
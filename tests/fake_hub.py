@@ -0,0 +1,121 @@
+"""synthetic scihub opensearch backend, to run queries without network (see `FakeHub`)"""
+import datetime
+import fnmatch
+import re
+import threading
+import time
+import uuid as _uuid
+
+NS = 'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" xmlns="http://www.w3.org/2005/Atom"'
+
+
+def make_products(n, t0=datetime.datetime(2020, 1, 1), step=datetime.timedelta(minutes=37), first=0):
+    """
+    n synthetic S1 products, one every `step` from t0, with 2x2 degrees footprints spread on the globe.
+    5 consecutive products share the same datatake. `first` is the number of the first product (for uuids).
+    """
+    products = []
+    for i in range(first, first + n):
+        begin = t0 + (i - first) * step
+        end = begin + datetime.timedelta(seconds=25)
+        lon = (i * 7.3) % 340 - 170
+        lat = (i * 3.1) % 140 - 70
+        takeid = '%06X' % (i // 5)
+        filename = 'S1A_IW_GRDH_1SDV_%s_%s_%06d_%s_%04X.SAFE' % (
+            begin.strftime('%Y%m%dT%H%M%S'), end.strftime('%Y%m%dT%H%M%S'), 30000 + i, takeid, i % 0x10000)
+        products.append(dict(
+            uuid=str(_uuid.UUID(int=i + 1)), filename=filename, beginposition=begin, endposition=end,
+            ingestiondate=begin + datetime.timedelta(hours=3),
+            footprint='POLYGON ((%s %s,%s %s,%s %s,%s %s,%s %s))' % (lon, lat, lon + 2, lat, lon + 2, lat + 2,
+                                                                    lon, lat + 2, lon, lat),
+            orbitnumber=30000 + i, relativeorbitnumber=i % 175, missiondatatakeid=i // 5, slicenumber=i % 5 + 1))
+    return products
+
+
+def _date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _entry(product):
+    return ('<entry><title>%(f)s</title><link href="https://x/odata/v1/Products(\'%(u)s\')/$value"/>'
+            '<link rel="alternative" href="https://x/odata/v1/Products(\'%(u)s\')/"/>'
+            '<link rel="icon" href="https://x/odata/v1/Products(\'%(u)s\')/Products(\'Quicklook\')/$value"/>'
+            '<id>%(u)s</id><summary>s</summary>'
+            '<date name="ingestiondate">%(ing)s</date><date name="beginposition">%(b)s</date>'
+            '<date name="endposition">%(e)s</date>'
+            '<int name="orbitnumber">%(o)d</int><int name="relativeorbitnumber">%(r)d</int>'
+            '<int name="missiondatatakeid">%(m)d</int><int name="slicenumber">%(s)d</int>'
+            '<str name="footprint">%(fp)s</str><str name="filename">%(f)s</str><str name="identifier">%(id)s</str>'
+            '<str name="platformname">Sentinel-1</str><str name="producttype">GRD</str><str name="size">1.6 GB</str>'
+            '<str name="orbitdirection">ASCENDING</str><str name="uuid">%(u)s</str></entry>') % dict(
+        f=product['filename'], u=product['uuid'], ing=_date(product['ingestiondate']),
+        b=_date(product['beginposition']), e=_date(product['endposition']), o=product['orbitnumber'],
+        r=product['relativeorbitnumber'], m=product['missiondatatakeid'], s=product['slicenumber'],
+        fp=product['footprint'], id=product['filename'][:-5])
+
+
+def _page(products, start, rows):
+    chunk = products[start:start + rows]
+    return ('<?xml version="1.0" encoding="utf-8"?><feed %s><title>Sentinels Scientific Data Hub search results</title>'
+            '<subtitle>Displaying %d results. Request done in 0.01 seconds.</subtitle>'
+            '<opensearch:totalResults>%d</opensearch:totalResults><opensearch:startIndex>%d</opensearch:startIndex>'
+            '<opensearch:itemsPerPage>%d</opensearch:itemsPerPage>%s</feed>') % (
+        NS, len(chunk), len(products), start, rows, ''.join(_entry(product) for product in chunk))
+
+
+def _parse_date(date):
+    return datetime.datetime.strptime(date[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content.encode()
+        self.text = content
+        self.status_code = status_code
+        self.headers = {}
+
+
+class FakeHub:
+    """
+    synthetic scihub, answering a small subset of the solr syntax: beginPosition range, OR-combined filename
+    globs and ingestiondate lower bound.
+
+    `get` replaces the http session get. Requests params are recorded in `calls`, and the maximum number of
+    concurrent requests in `max_in_flight`. Each request lasts at least `delay` seconds.
+    """
+
+    def __init__(self, products, delay=0):
+        self.products = products
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def select(self, str_query):
+        products = self.products
+        match = re.search(r'beginPosition:\[(\S+) TO (\S+)\]', str_query)
+        if match:
+            begin, end = _parse_date(match.group(1)), _parse_date(match.group(2))
+            products = [product for product in products if begin <= product['beginposition'] <= end]
+        filenames = re.findall(r'filename:(\S+?)(?:\)| |$)', str_query)
+        if filenames:
+            products = [product for product in products
+                        if any(fnmatch.fnmatch(product['filename'], filename) for filename in filenames)]
+        match = re.search(r'ingestiondate:\[(\S+) TO NOW\]', str_query)
+        if match:
+            ingested = _parse_date(match.group(1))
+            products = [product for product in products if product['ingestiondate'] >= ingested]
+        return products
+
+    def get(self, url, params=None, **kwargs):
+        with self._lock:
+            self.calls.append(dict(params))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            return FakeResponse(_page(self.select(params['q']), int(params['start']), int(params['rows'])))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
@@ -0,0 +1,99 @@
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, box
+
+from sentinelrequest import geopandas_coloc
+
+t0 = datetime.datetime(2020, 1, 1)
+
+
+def random_gdf(n, seed, prefix, hours=6, size=8):
+    rng = np.random.default_rng(seed)
+    lon = rng.uniform(-60, 60, n)
+    lat = rng.uniform(-60, 60, n)
+    width = rng.uniform(0.5, size, n)
+    start = [t0 + datetime.timedelta(minutes=int(m)) for m in rng.integers(0, 60 * 24 * 10, n)]
+    stop = [s + datetime.timedelta(minutes=int(m)) for s, m in zip(start, rng.integers(1, 60 * hours, n))]
+    return gpd.GeoDataFrame({'startdate': start, 'stopdate': stop},
+                            geometry=[box(x, y, x + w, y + w) for x, y, w in zip(lon, lat, width)],
+                            index=['%s%03d' % (prefix, i) for i in range(n)], crs='epsg:4326')
+
+
+def track_gdf(n):
+    """dense time serie of points, one every 10 minutes"""
+    start = [t0 + datetime.timedelta(minutes=10 * i) for i in range(n)]
+    stop = [s + datetime.timedelta(minutes=10) for s in start]
+    geometry = [Point(-60 + 120 * i / n, 40 * np.sin(i / 50)) for i in range(n)]
+    return gpd.GeoDataFrame({'startdate': start, 'stopdate': stop}, geometry=geometry,
+                            index=['t%04d' % i for i in range(n)], crs='epsg:4326')
+
+
+def pairs(idx):
+    return sorted(zip(*idx))
+
+
+@pytest.fixture(scope='module')
+def gdfs():
+    return random_gdf(300, 0, 'a'), random_gdf(200, 1, 'b')
+
+
+@pytest.fixture(scope='module')
+def expected(gdfs):
+    gdf1, gdf2 = gdfs
+    expected = pairs(geopandas_coloc.colocalize_loop(gdf1.copy(), gdf2.copy()))
+    assert expected
+    return expected
+
+
+@pytest.mark.parametrize('colocalize', [geopandas_coloc.colocalize_index, geopandas_coloc.colocalize_iter,
+                                        geopandas_coloc.colocalize_track])
+def test_engine_like_loop(gdfs, expected, colocalize):
+    gdf1, gdf2 = gdfs
+    assert pairs(colocalize(gdf1, gdf2)) == expected
+
+
+def test_engines_no_time_overlap(gdfs):
+    gdf1, gdf2 = gdfs
+    gdf2 = gdf2.assign(startdate=gdf2['startdate'] + pd.Timedelta(days=100),
+                       stopdate=gdf2['stopdate'] + pd.Timedelta(days=100))
+    for colocalize in [geopandas_coloc.colocalize_index, geopandas_coloc.colocalize_iter,
+                       geopandas_coloc.colocalize_track, geopandas_coloc.colocalize_parallel]:
+        assert pairs(colocalize(gdf1, gdf2)) == []
+
+
+def test_track_like_loop(gdfs):
+    gdf1, _ = gdfs
+    track = track_gdf(1000)
+    expected = pairs(geopandas_coloc.colocalize_loop(gdf1.copy(), track.copy()))
+    assert expected
+    assert pairs(geopandas_coloc.colocalize_track(gdf1, track)) == expected
+    assert pairs(geopandas_coloc.colocalize_iter(gdf1, track)) == expected
+
+
+def test_parallel_like_loop(gdfs, expected):
+    gdf1, gdf2 = gdfs
+    assert pairs(geopandas_coloc.colocalize_parallel(gdf1, gdf2, n_workers=2)) == expected
+    # shared executor, not shut down by colocalize_parallel
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as executor:
+        for _ in range(2):
+            assert pairs(geopandas_coloc.colocalize_parallel(gdf1, gdf2, n_workers=2, executor=executor)) == expected
+
+
+def test_distance_includes_intersecting(gdfs, expected):
+    pytest.importorskip('sklearn')
+    gdf1, gdf2 = gdfs
+    idx1, idx2, distance = geopandas_coloc.colocalize_distance(gdf1, gdf2, 50000)
+    found = dict(zip(zip(idx1, idx2), distance))
+    assert len(found) == len(idx1)
+    assert all(found.get(pair) == 0 for pair in expected)
+    assert (distance <= 50000).all()
+    # others pairs are not intersecting, but closer than max_distance
+    near = [pair for pair in found if found[pair] > 0]
+    assert all(not gdf1.geometry[a].intersects(gdf2.geometry[b]) for a, b in near)
+    assert all(gdf1.geometry[a].distance(gdf2.geometry[b]) < 1 for a, b in near)
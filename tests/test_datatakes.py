@@ -0,0 +1,95 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import sentinelrequest
+
+
+def baseline_remove_duplicates(safes, keep_list=[]):
+    """remove_duplicates, as it was before being vectorized (one filter by filename radic)"""
+    safes = safes.copy()
+    if safes.empty:
+        return safes
+    safes['__filename_radic'] = [f[0:62] for f in safes['filename']]
+    for filename_radic in safes['__filename_radic'].unique():
+        sames_safes = safes[safes['__filename_radic'] == filename_radic]
+        if len(sames_safes['filename'].unique()) > 1:
+            force_keep = list(set(sames_safes['filename']).intersection(keep_list))
+            to_keep = sames_safes['ingestiondate'].max()
+            if force_keep:
+                to_keep = sames_safes[sames_safes['filename'] == force_keep[0]]['ingestiondate'].iloc[0]
+            safes = safes[(safes['ingestiondate'] == to_keep) | (safes['__filename_radic'] != filename_radic)]
+    return safes.drop('__filename_radic', axis=1)
+
+
+def baseline_get_datatakes(safes, datatake=0, **kwargs):
+    """get_datatakes, as it was before being batched (one request by safe)"""
+    safes = safes.copy()
+    safes['datatake_index'] = 0
+    for safe in list(safes['filename']):
+        safe_index = safes[safes['filename'] == safe].index[0]
+        takeid = safe.split('_')[-2]
+        safe_rad = "_".join(safe.split('_')[0:4])
+        safes_datatake = sentinelrequest.scihubQuery_raw('filename:%s_*_*_*_%s_*' % (safe_rad, takeid), **kwargs)
+        safes_datatake = baseline_remove_duplicates(safes_datatake, keep_list=[safe])
+        ifather = safes_datatake[safes_datatake['filename'] == safe].index[0]
+        safes_datatake['datatake_index'] = safes_datatake.index - ifather
+        safes_datatake = safes_datatake[abs(safes_datatake['datatake_index']) <= datatake]
+        safes_datatake = safes_datatake.set_index(pd.Index([safe_index] * len(safes_datatake)))
+        safes_datatake = safes_datatake[~safes_datatake['filename'].isin(safes['filename'])]
+        safes = pd.concat([safes, safes_datatake], sort=False)
+    return safes
+
+
+def random_safes(rng, n, nradics):
+    radics = rng.integers(0, nradics, n)
+    prodids = rng.integers(0, 3, n)
+    filenames = ['S1A_IW_GRDH_1SDV_20200101T%06d_20200101T000025_030000_000000_%04X.SAFE' % (radic, prodid)
+                 for radic, prodid in zip(radics, prodids)]
+    ingestiondate = pd.to_datetime('2020-01-01', utc=True) + pd.to_timedelta(
+        prodids * 3600 + rng.integers(0, 2, n), unit='s')
+    return pd.DataFrame({'filename': filenames, 'ingestiondate': ingestiondate, 'x': np.arange(n)},
+                        index=rng.permutation(n) * 2)
+
+
+def test_remove_duplicates_like_baseline():
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        safes = random_safes(rng, rng.integers(1, 60), rng.integers(1, 20))
+        keep_list = list(rng.choice(safes['filename'].unique(), rng.integers(0, 2)))
+        if rng.integers(0, 4) == 0:
+            # filenames shorter than the radic, or not ascii
+            safes['filename'] = safes['filename'].str.slice(rng.integers(20, 60))
+        elif rng.integers(0, 4) == 0:
+            safes.loc[safes.index[0], 'filename'] = 'é' + safes['filename'].iloc[0]
+        keep_list = [filename for filename in keep_list if filename in set(safes['filename'])]
+        pd.testing.assert_frame_equal(sentinelrequest.remove_duplicates(safes, keep_list=keep_list),
+                                      baseline_remove_duplicates(safes, keep_list=keep_list))
+
+
+def test_remove_duplicates_empty():
+    safes = pd.DataFrame({'filename': [], 'ingestiondate': []})
+    assert sentinelrequest.remove_duplicates(safes).empty
+
+
+def key(safes):
+    return sorted(zip(safes.index.astype(str), safes['filename'], safes['datatake_index'].astype(int)))
+
+
+@pytest.mark.parametrize('datatake', [1, 2, 4])
+def test_get_datatakes_like_baseline(hub, cachedir, datatake):
+    kwargs = dict(cachedir=cachedir, cacherefreshrecent=datetime.timedelta(days=1))
+    products = sentinelrequest.scihubQuery_raw(
+        'beginPosition:[2020-01-02T00:00:00.000Z TO 2020-01-04T00:00:00.000Z] AND filename:S1*', **kwargs)
+    # a few safes, some from the same datatake
+    safes = products.iloc[[0, 1, 7, 20, 33, 34]].set_axis(['r%d' % i for i in range(6)])
+    expected = baseline_get_datatakes(safes, datatake=datatake, **kwargs)
+    assert len(expected) > len(safes)
+    ncalls = len(hub.calls)
+    datatakes = sentinelrequest.get_datatakes(safes.copy(), datatake=datatake, **kwargs)
+    assert key(datatakes) == key(expected)
+    assert list(datatakes.columns) == list(expected.columns)
+    # one batched request for all datatakes
+    assert len(hub.calls) - ncalls <= 1
@@ -0,0 +1,74 @@
+import datetime
+
+import pandas as pd
+
+import sentinelrequest
+from fake_hub import make_products
+
+month = 'beginPosition:[2020-01-01T00:00:00.000Z TO 2020-01-31T00:00:00.000Z] AND filename:S1*'
+days = 'beginPosition:[2020-01-03T00:00:00.000Z TO 2020-01-05T00:00:00.000Z] AND filename:S1*'
+old = datetime.timedelta(days=1)
+
+
+def uuids(safes):
+    return list(safes['uuid'])
+
+
+def test_pages_fetched_concurrently(hub):
+    hub.delay = 0.05
+    safes = sentinelrequest.scihubQuery_raw(month, page_workers=4)
+    assert uuids(safes) == [product['uuid'] for product in hub.products]
+    assert len(hub.calls) == 6
+    assert 1 < hub.max_in_flight <= 4
+
+    sentinelrequest.query_memo.clear()
+    hub.max_in_flight = 0
+    serial = sentinelrequest.scihubQuery_raw(month, page_workers=1)
+    assert hub.max_in_flight == 1
+    pd.testing.assert_frame_equal(pd.DataFrame(safes), pd.DataFrame(serial))
+
+
+def test_cache_reuse(hub, cachedir):
+    safes = sentinelrequest.scihubQuery_raw(month, cachedir=cachedir, cacherefreshrecent=old)
+    ncalls = len(hub.calls)
+    sentinelrequest.query_memo.clear()
+    cached, cache_status = sentinelrequest.scihubQuery_raw(month, cachedir=cachedir, cacherefreshrecent=old,
+                                                           return_cache_status=True)
+    assert cache_status
+    assert len(hub.calls) == ncalls
+    assert uuids(cached) == uuids(safes)
+
+
+def test_superset_filtering(hub, cachedir):
+    sentinelrequest.scihubQuery_raw(month, cachedir=cachedir, cacherefreshrecent=old, cache_refresh='incremental')
+    ncalls = len(hub.calls)
+    for clear_memo in [False, True]:
+        # from the in memory answer, then from the query cache entry
+        if clear_memo:
+            sentinelrequest.query_memo.clear()
+        subset = sentinelrequest.scihubQuery_raw(days, cachedir=cachedir, cacherefreshrecent=old,
+                                                 cache_refresh='incremental')
+        assert len(hub.calls) == ncalls
+        assert sorted(uuids(subset)) == sorted(product['uuid'] for product in hub.select(days))
+
+
+def test_incremental_refresh(hub, cachedir):
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    hub.products = make_products(50, t0=now - datetime.timedelta(days=1), step=datetime.timedelta(minutes=10))
+    recent = 'beginPosition:[%s TO %s] AND filename:S1*' % (
+        (now - datetime.timedelta(days=2)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        (now + datetime.timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+    kwargs = dict(cachedir=cachedir, cacherefreshrecent=datetime.timedelta(days=7), cache_refresh='incremental')
+
+    assert len(sentinelrequest.scihubQuery_raw(recent, **kwargs)) == 50
+    ncalls = len(hub.calls)
+
+    # new products, ingested later: only them are asked to the hub
+    hub.products = hub.products + make_products(20, t0=now, step=datetime.timedelta(minutes=10), first=50)
+    for product in hub.products[50:]:
+        product['ingestiondate'] = now + datetime.timedelta(days=1)
+    sentinelrequest.query_memo.clear()
+    safes = sentinelrequest.scihubQuery_raw(recent, **kwargs)
+    assert sorted(uuids(safes)) == sorted(product['uuid'] for product in hub.products)
+    delta_calls = hub.calls[ncalls:]
+    assert delta_calls and all('ingestiondate:[' in params['q'] for params in delta_calls)